@@ -0,0 +1,249 @@
+import argparse
+import copy
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import torch
+
+import dataset
+import event_record
+from model import NESA, get_metrics
+from synthetic import BenchConfig, make_dictionary, write_calendar_csv
+from utils import Histogram, PROFILER
+
+
+def time_calls(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    hist = Histogram()
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        fn()
+        hist.record(time.perf_counter_ns() - start)
+    return hist.summary()
+
+
+def bench_process_data(nets_dataset, path, repeat):
+    def run():
+        # process_data caps events per user across calls
+        nets_dataset.user_event_cnt = dict()
+        nets_dataset.process_data(path)
+    return time_calls(run, repeat, warmup=0)
+
+
+def bench_vectorize(vectorized, batch_size, repeat, prefix=''):
+    results = dict()
+    n_examples = len(vectorized)
+
+    def get_items():
+        for idx in range(n_examples):
+            vectorized[idx]
+    summary = time_calls(get_items, repeat)
+    summary['per_example_us'] = summary['mean'] * 1000. / n_examples
+    results[prefix + 'vectorize_getitem'] = summary
+
+    batches = [[vectorized[idx] for idx in range(s, min(s + batch_size,
+                                                        n_examples))]
+               for s in range(0, n_examples, batch_size)]
+
+    def batchify_all():
+        for batch in batches:
+            dataset.NETSDataset.batchify(batch)
+    summary = time_calls(batchify_all, repeat)
+    summary['per_batch_us'] = summary['mean'] * 1000. / len(batches)
+    results[prefix + 'batchify_bs%d' % batch_size] = summary
+    return results
+
+
+def get_batches(vectorized, batch_size, n_batches, device):
+    sampler = dataset.SortedBatchSampler(vectorized.lengths(), batch_size,
+                                         shuffle=False)
+    loader = torch.utils.data.DataLoader(vectorized,
+                                         batch_size=batch_size,
+                                         sampler=sampler,
+                                         collate_fn=dataset.NETSDataset
+                                         .batchify)
+    batches = list()
+    for ex in dataset.DevicePrefetcher(loader, device):
+        batches.append(ex)
+        if len(batches) == n_batches:
+            break
+    return batches
+
+
+def get_week_batches(vectorized, config, n_weeks, device):
+    # the first n_weeks weeks, one per batch, as forward_weeks batches and
+    # as the equivalent forward batches
+    weeks = dataset.group_weeks(vectorized.examples)[:n_weeks]
+    week_vectorized = dataset.WeekVectorize(weeks, config)
+    week_batches = [dataset.NETSDataset.batchify_weeks([week_vectorized[i]])
+                    for i in range(len(weeks))]
+    example_batches = list()
+    start = 0
+    for week in weeks:
+        end = start + len(week[2])
+        example_batches.append(dataset.NETSDataset.batchify(
+            [vectorized[i] for i in range(start, end)]))
+        start = end
+    return (list(dataset.DevicePrefetcher(week_batches, device)),
+            list(dataset.DevicePrefetcher(example_batches, device)))
+
+
+def bench_forward(model, batches, batch_size, use_cuda, prefix='forward'):
+    results = dict()
+    with torch.no_grad():
+        # warm up allocator and cudnn
+        model(*batches[0][:-1])
+
+        PROFILER.clear()
+        PROFILER.configure(enabled=True, sync_device=use_cuda)
+        for ex in batches:
+            model(*ex[:-1])
+        PROFILER.configure(enabled=False)
+
+    for path, summary in PROFILER.report().items():
+        results['%s_bs%d/%s' % (prefix, batch_size, path)] = summary
+    PROFILER.clear()
+    return results
+
+
+def bench_metrics(model, batch_size, repeat):
+    outputs = torch.randn(batch_size, model.n_classes)
+    targets = torch.randint(0, model.n_classes, (batch_size,),
+                            dtype=torch.long)
+    return time_calls(lambda: get_metrics(outputs, targets, model.n_day_slots,
+                                          model.n_classes), repeat)
+
+
+def compare(results, baseline, threshold, key='mean'):
+    # returns the names of benchmarks slower than baseline by > threshold
+    regressions = list()
+    print('%-70s %10s %10s %8s' % ('benchmark (%s ms)' % key,
+                                   'baseline', 'current', 'ratio'))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        base = baseline[name][key]
+        curr = results[name][key]
+        ratio = curr / base if base > 0 else float('inf')
+        flag = ''
+        if ratio > 1. + threshold:
+            regressions.append(name)
+            flag = ' <- regression'
+        print('%-70s %10.3f %10.3f %8.2f%s' % (name, base, curr, ratio, flag))
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--work_dir', type=str, default='./data/bench')
+    arg_parser.add_argument('--output', type=str,
+                            default='./data/bench/results.json')
+    arg_parser.add_argument('--baseline', type=str, default=None,
+                            help='compare against a saved results.json')
+    arg_parser.add_argument('--threshold', type=float, default=0.1,
+                            help='allowed slowdown ratio before flagging')
+    arg_parser.add_argument('--n_users', type=int, default=10)
+    arg_parser.add_argument('--n_weeks', type=int, default=52)
+    arg_parser.add_argument('--events_per_week', type=int, default=10)
+    arg_parser.add_argument('--vocab_size', type=int, default=1000)
+    arg_parser.add_argument('--batch_sizes', type=str, default='1,16,64')
+    arg_parser.add_argument('--n_batches', type=int, default=20)
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--seed', type=int, default=3)
+    arg_parser.add_argument('--yes_cuda', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    batch_sizes = [int(bs) for bs in args.batch_sizes.split(',')]
+    use_cuda = args.yes_cuda > 0 and torch.cuda.is_available()
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    csv_path = os.path.join(args.work_dir, 'synthetic_events.csv')
+    n_rows = write_calendar_csv(csv_path,
+                                n_users=args.n_users,
+                                n_weeks=args.n_weeks,
+                                events_per_week=args.events_per_week,
+                                vocab_size=args.vocab_size,
+                                seed=args.seed)
+
+    config = BenchConfig(csv_path)
+    config.yes_cuda = args.yes_cuda
+    pretrained_dict = make_dictionary(n_users=args.n_users,
+                                      vocab_size=args.vocab_size,
+                                      word_embed_dim=config.word_embed_dim,
+                                      seed=args.seed)
+    nets_dataset = dataset.NETSDataset(config, pretrained_dict)
+    vectorized = dataset.Vectorize(nets_dataset.test_data, config)
+
+    results = dict()
+    results['process_data'] = bench_process_data(nets_dataset, csv_path,
+                                                 args.repeat)
+    npz_path = os.path.join(args.work_dir, 'synthetic_events.npz')
+    event_record.write_columns(npz_path, event_record.read_csv(csv_path))
+    results['process_data_npz'] = bench_process_data(nets_dataset, npz_path,
+                                                     args.repeat)
+    results.update(bench_vectorize(vectorized, max(batch_sizes),
+                                   args.repeat))
+    array_vectorized = dataset.ArrayVectorize(nets_dataset.test_data, config)
+    results.update(bench_vectorize(array_vectorized, max(batch_sizes),
+                                   args.repeat, prefix='array_'))
+
+    device = torch.device('cuda' if use_cuda else 'cpu')
+    model = NESA(config, nets_dataset.widx2vec,
+                 idx2dur=nets_dataset.idx2dur).to(device).eval()
+    optimized = copy.deepcopy(model).optimize_for_inference()
+    for batch_size in batch_sizes:
+        batches = get_batches(vectorized, batch_size, args.n_batches,
+                              device)
+        results.update(bench_forward(model, batches, batch_size, use_cuda))
+        model.fuse_char_cnn()
+        results.update(bench_forward(model, batches, batch_size, use_cuda,
+                                     prefix='forward_fused'))
+        model.tc_fused = None
+        results.update(bench_forward(optimized, batches, batch_size,
+                                     use_cuda, prefix='forward_optimized'))
+        results['get_metrics_bs%d' % batch_size] = \
+            bench_metrics(model, batch_size, args.repeat * args.n_batches)
+
+    week_batches, example_batches = get_week_batches(
+        vectorized, config, args.n_batches, device)
+    results.update(bench_forward(model, example_batches, 1, use_cuda,
+                                 prefix='forward_week_examples'))
+    results.update(bench_forward(model.forward_weeks, week_batches, 1,
+                                 use_cuda, prefix='forward_weeks'))
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'host': platform.node(),
+            'device': device.type,
+            'n_rows': n_rows,
+            'n_examples': len(vectorized),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Saved', args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('%d regression(s) over %.0f%%' %
+                  (len(regressions), args.threshold * 100))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import csv
+import random
+import string
+
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+MINUTE_NORM = 30
+SLOT_SIZE = 336
+DURATIONS = [30, 30, 60, 60, 60, 90, 120, 45, 15, 180]
+
+
+def make_vocab(vocab_size, seed=0):
+    rng = random.Random(seed)
+    vocab = set()
+    while len(vocab) < vocab_size:
+        vocab.add(''.join(rng.choice(string.ascii_lowercase)
+                          for _ in range(rng.randint(2, 10))))
+    return sorted(vocab)
+
+
+def generate_events(n_users=10, n_weeks=52, events_per_week=10,
+                    vocab_size=1000, first_year=2017, seed=0):
+    """Yields 12-column rows in the format of get_google_calendar_events.py.
+
+    Rows are grouped by user and sorted by (year, week, register sequence),
+    the same order the exporter writes.
+    """
+    rng = random.Random(seed)
+    vocab = make_vocab(vocab_size, seed)
+    # zipf-like word frequencies as in real titles
+    weights = [1. / (rank + 1) for rank in range(len(vocab))]
+    first_monday = date(first_year, 1, 4) - \
+        timedelta(days=date(first_year, 1, 4).weekday())
+
+    for user_idx in range(n_users):
+        user_id = 'user%d@example.com' % user_idx
+        for week_idx in range(n_weeks):
+            monday = first_monday + timedelta(weeks=week_idx)
+            iso_year, iso_week, _ = monday.isocalendar()
+            n_events = max(1, int(rng.gauss(events_per_week,
+                                            events_per_week / 4.)))
+            slots = rng.sample(range(SLOT_SIZE), min(n_events, SLOT_SIZE))
+            events = list()
+            for slot in slots:
+                start_dt = datetime(monday.year, monday.month, monday.day) \
+                    + timedelta(minutes=slot * MINUTE_NORM)
+                register_dt = start_dt - timedelta(
+                    days=rng.randint(0, 20), minutes=rng.randint(1, 600))
+                title = ' '.join(rng.choices(vocab, weights,
+                                             k=rng.randint(1, 5)))
+                events.append((register_dt, start_dt, title, slot))
+
+            # register sequence follows register time within a week
+            events.sort()
+            for reg_seq, (register_dt, start_dt, title, slot) \
+                    in enumerate(events):
+                register_monday = register_dt.date() - \
+                    timedelta(days=register_dt.weekday())
+                yield [user_id,
+                       title,
+                       rng.choice(DURATIONS),
+                       register_dt,
+                       start_dt,
+                       iso_year,
+                       iso_week,
+                       reg_seq,
+                       (monday - register_monday).days // 7,
+                       (start_dt.date() - register_dt.date()).days,
+                       rng.random() < 0.2,
+                       slot]
+
+
+def write_calendar_csv(path, **kwargs):
+    n_rows = 0
+    with open(path, 'w', newline='', encoding='utf-8') as csv_file:
+        event_writer = csv.writer(csv_file, quotechar='"')
+        for evt_features in generate_events(**kwargs):
+            event_writer.writerow(evt_features)
+            n_rows += 1
+    return n_rows
+
+
+def make_dictionary(n_users=10, vocab_size=1000, word_embed_dim=300,
+                    max_duration=720, seed=0):
+    # same keys as dataset_180522_dict.pkl, with random word vectors
+    rng = np.random.RandomState(seed)
+
+    char2idx = {'PAD': 0, 'UNK': 1, 'BOW': 2, 'EOW': 3}
+    for char in string.printable:
+        char2idx[char] = len(char2idx)
+
+    word2idx = {'PAD': 0, 'UNK': 1}
+    for word in make_vocab(vocab_size, seed):
+        word2idx[word] = len(word2idx)
+    widx2vec = rng.uniform(-1., 1., (len(word2idx), word_embed_dim))
+    widx2vec[0] = 0.
+
+    dur2idx = {0: 0}
+    for duration in range(MINUTE_NORM, max_duration + 1, MINUTE_NORM):
+        dur2idx[duration] = len(dur2idx)
+
+    user2idx = {'UNK': 0}
+    for user_idx in range(n_users):
+        user2idx['user%d@example.com' % user_idx] = len(user2idx)
+
+    def reverse(d):
+        return {v: k for k, v in d.items()}
+
+    return {
+        'word2idx': word2idx, 'idx2word': reverse(word2idx),
+        'widx2vec': widx2vec.tolist(),
+        'char2idx': char2idx, 'idx2char': reverse(char2idx),
+        'dur2idx': dur2idx, 'idx2dur': reverse(dur2idx),
+        'user2idx': user2idx, 'idx2user': reverse(user2idx),
+        'config.max_sentlen': 0, 'config.max_wordlen': 0,
+    }
+
+
+class BenchConfig(object):
+    # dataset.Config without the GloVe requirement, plus model settings
+    def __init__(self, test_path):
+        self.test_path = test_path
+        self.glove_type = 840
+        self.word_embed_dim = 300
+        self.batch_size = 16
+        self.max_wordlen = 0
+        self.max_sentlen = 0
+        self.char_vocab_size = 0
+        self.word_vocab_size = 0
+        self.user_size = 0
+        self.dur_size = 0
+        self.class_div = 0
+        self.slot_size = 0
+        self.data_workers = 0
+        self.example_storage_dir = None
+        self.sm_day_num = 7
+        self.sm_slot_num = 24
+
+        self.model_name = 'nesa_bench'
+        self.checkpoint_dir = './results/'
+        self.summary = False
+        self.yes_cuda = 1
+        self.lr = 1e-3
+        self.lr_decay = 1.
+        self.wd = 0.
+        self.no_title = False
+        self.no_intention = False
+        self.no_context = False
+        self.no_context_title = False
+        self.use_duration_scala = 0
+        self.word_embed_req_grad = 0
+        self.char_embed_dim = 15
+        self.user_embed_dim = 30
+        self.dur_embed_dim = 5
+        self.slot_embed_dim = 5
+        self.num_directions = 2
+        self.tc_conv_fn = [10, 30, 40, 50, 60]
+        self.tc_conv_fh = [1, 1, 1, 1, 1]
+        self.tc_conv_fw = [1, 2, 3, 4, 5]
+        self.sm_conv_fn = [16, 32, 32, 64]
+        self.sm_conv_fh = [3, 5]
+        self.sm_conv_fw = [3, 5]
+        self.sm_conv_pd = [1, 2]
+        self.t_rnn_hdim = 100
+        self.t_rnn_ln = 1
+        self.st_rnn_hdim = 50
+        self.st_rnn_ln = 1
+        self.char_dr = 0.
+        self.word_dr = 0.
+        self.user_dr = 0.
+        self.dur_dr = 0.
+        self.slot_dr = 0.
+        self.output_dr = 0.
+        self.t_rnn_dr = 0.
+        self.st_rnn_dr = 0.
+        self.t_rnn_out_dr = 0.
+        self.st_rnn_out_dr = 0.
+        self.ex_pre_events = 0
@@ -0,0 +1,185 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+
+import dataset
+import test
+from model import NESA
+from synthetic import BenchConfig, make_dictionary, write_calendar_csv
+from utils import configure_threads
+
+
+def host_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def format_cores(cores):
+    # in utils.parse_cores format
+    return ','.join(str(core) for core in cores) if cores else None
+
+
+def thread_counts(n_cores):
+    # 1, 2, 4, .. up to n_cores
+    counts = [1]
+    while counts[-1] * 2 <= n_cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != n_cores:
+        counts.append(n_cores)
+    return counts
+
+
+def settings(n_cores, data_workers, inter_op_threads, pin):
+    """Threading policies to time. With pinning, intra-op threads take
+    the first cores and DataLoader workers the ones after them; pinned
+    variants that do not fit the host are skipped.
+    """
+    for intra, inter, workers in itertools.product(
+            thread_counts(n_cores), inter_op_threads, data_workers):
+        yield intra, inter, workers, False
+        if pin and intra + workers <= n_cores:
+            yield intra, inter, workers, True
+
+
+def run_setting(args, intra, inter, workers, pin):
+    # one process per setting: inter-op threads are fixed after first use
+    command = [sys.executable, os.path.abspath(__file__),
+               '--work_dir', args.work_dir,
+               '--n_users', str(args.n_users),
+               '--vocab_size', str(args.vocab_size),
+               '--batch_size', str(args.batch_size),
+               '--week_batches', str(args.week_batches),
+               '--repeat', str(args.repeat),
+               '--seed', str(args.seed),
+               '--run', '%d,%d,%d,%d' % (intra, inter, workers, int(pin))]
+    output = subprocess.check_output(command, universal_newlines=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def time_setting(args, intra, inter, workers, pin):
+    cores = host_cores()
+    main_cores = cores[:intra] if pin else None
+    worker_cores = cores[intra:intra + workers] if pin and workers else None
+    threads = configure_threads(intra, inter, main_cores)
+
+    config = BenchConfig(os.path.join(args.work_dir, 'synthetic_events.csv'))
+    config.yes_cuda = 0
+    config.data_workers = workers
+    config.data_worker_cores = worker_cores
+    pretrained_dict = make_dictionary(n_users=args.n_users,
+                                      vocab_size=args.vocab_size,
+                                      word_embed_dim=config.word_embed_dim,
+                                      seed=args.seed)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        nets_dataset = dataset.NETSDataset(config, pretrained_dict)
+        model = NESA(config, nets_dataset.widx2vec,
+                     idx2dur=nets_dataset.idx2dur).eval()
+        model.fuse_char_cnn()
+
+        # the first pass warms up workers and allocator
+        rates = list()
+        for _ in range(args.repeat + 1):
+            start = time.perf_counter()
+            metrics = test.measure_performance(
+                nets_dataset, model, config, torch.device('cpu'),
+                batch_size=args.batch_size, weeks=args.week_batches > 0)
+            rates.append(metrics['count'] / (time.perf_counter() - start))
+
+    return {'intra_op_threads': threads[0], 'inter_op_threads': threads[1],
+            'data_workers': workers, 'pinned': pin,
+            'cores': format_cores(main_cores),
+            'data_worker_cores': format_cores(worker_cores),
+            'events_per_sec': float(np.median(rates[1:])),
+            'count': metrics['count']}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--work_dir', type=str, default='./data/bench')
+    arg_parser.add_argument('--output', type=str,
+                            default='./data/bench/threads.json')
+    arg_parser.add_argument('--n_users', type=int, default=10)
+    arg_parser.add_argument('--n_weeks', type=int, default=52)
+    arg_parser.add_argument('--events_per_week', type=int, default=10)
+    arg_parser.add_argument('--vocab_size', type=int, default=1000)
+    arg_parser.add_argument('--batch_size', type=int, default=16)
+    arg_parser.add_argument('--week_batches', type=int, default=0)
+    arg_parser.add_argument('--data_workers', type=str, default='0,2,4')
+    arg_parser.add_argument('--inter_op_threads', type=str, default='1,2')
+    arg_parser.add_argument('--pin', type=int, default=1,
+                            help='also time pinned variants')
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--seed', type=int, default=3)
+    arg_parser.add_argument('--run', type=str, default=None,
+                            help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.run is not None:
+        intra, inter, workers, pin = [int(v) for v in args.run.split(',')]
+        print(json.dumps(time_setting(args, intra, inter, workers,
+                                      pin > 0)))
+        return
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    write_calendar_csv(os.path.join(args.work_dir, 'synthetic_events.csv'),
+                       n_users=args.n_users, n_weeks=args.n_weeks,
+                       events_per_week=args.events_per_week,
+                       vocab_size=args.vocab_size, seed=args.seed)
+
+    n_cores = len(host_cores())
+    data_workers = [int(v) for v in args.data_workers.split(',')]
+    inter_op_threads = [int(v) for v in args.inter_op_threads.split(',')]
+    print('%-6s %-6s %-8s %-7s %10s' %
+          ('intra', 'inter', 'workers', 'pinned', 'events/s'))
+    rows = list()
+    for setting in settings(n_cores, data_workers, inter_op_threads,
+                            args.pin > 0):
+        row = run_setting(args, *setting)
+        rows.append(row)
+        print('%-6d %-6d %-8d %-7s %10.1f' %
+              (row['intra_op_threads'], row['inter_op_threads'],
+               row['data_workers'], row['pinned'], row['events_per_sec']))
+
+    best = max(rows, key=lambda r: r['events_per_sec'])
+    flags = '--intra_op_threads %d --inter_op_threads %d --data_workers %d' \
+        % (best['intra_op_threads'], best['inter_op_threads'],
+           best['data_workers'])
+    if best['cores']:
+        flags += ' --cores %s' % best['cores']
+    if best['data_worker_cores']:
+        flags += ' --data_worker_cores %s' % best['data_worker_cores']
+    print('best (%.1f events/s): python3 test.py %s' %
+          (best['events_per_sec'], flags))
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'host': platform.node(),
+            'n_cores': n_cores,
+            'args': vars(args),
+        },
+        'results': rows,
+        'best': best,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('Saved', args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+import argparse
+import csv
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+
+import httplib2
+
+from concurrent.futures import ThreadPoolExecutor
+
+from oauth2client import tools
+
+import get_google_calendar_events as gce
+from calendar_sync import API_ROOT, CalendarClient
+
+
+def spill_run(chunk, tmp_dir):
+    # write one sorted run of (sort_key, evt_features) to a temp file
+    chunk.sort(key=lambda kf: kf[0])
+    with tempfile.NamedTemporaryFile('wb', dir=tmp_dir, suffix='.run',
+                                     delete=False) as f:
+        for key_features in chunk:
+            pickle.dump(key_features, f, pickle.HIGHEST_PROTOCOL)
+        return f.name
+
+
+def read_run(run_path):
+    with open(run_path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+class ExternalSorter(object):
+    """Sorts evt_features by (start_iso_year, start_iso_week, register
+    time) with at most `chunk_size` rows in memory at a time.
+    """
+
+    def __init__(self, tmp_dir, chunk_size=100000):
+        self.tmp_dir = tmp_dir
+        self.chunk_size = chunk_size
+        self.chunk = list()
+        self.runs = list()
+        self.num_rows = 0
+
+    def add(self, evt_features, register_key):
+        # register_key from featurize_events, so naive and aware register
+        # times compare; num_rows breaks ties by fetch order, as the
+        # stable sort in extract_features does
+        key = (evt_features[gce.start_year_idx],
+               evt_features[gce.start_week_idx],
+               register_key,
+               self.num_rows)
+        self.chunk.append((key, evt_features))
+        self.num_rows += 1
+        if len(self.chunk) >= self.chunk_size:
+            self.runs.append(spill_run(self.chunk, self.tmp_dir))
+            self.chunk = list()
+
+    def __iter__(self):
+        # merged rows with week_register_sequence assigned
+        self.chunk.sort(key=lambda kf: kf[0])
+        merged = heapq.merge(*([read_run(r) for r in self.runs] +
+                               [iter(self.chunk)]),
+                             key=lambda kf: kf[0])
+        prev_week = None
+        week_register_sequence = 0
+        for key, evt_features in merged:
+            week = key[:2]
+            if week == prev_week:
+                week_register_sequence += 1
+            else:
+                week_register_sequence = 0  # start with 0
+                prev_week = week
+            evt_features[gce.reg_seq_idx] = week_register_sequence
+            yield evt_features
+
+    def close(self):
+        for run_path in self.runs:
+            os.remove(run_path)
+        self.runs = list()
+        self.chunk = list()
+
+
+class CsvSink(object):
+    """Per-user csv files, or `num_shards` shard files holding whole users.
+
+    A user's rows are written as one contiguous block sorted by (year,
+    week, sequence), the layout NETSDataset.process_data expects. Rows
+    go to a temp file first, so a failed merge leaves no partial block,
+    and the shard lock is held only to append the finished block.
+    """
+
+    def __init__(self, output_dir, num_shards=0, tmp_dir=None):
+        self.output_dir = output_dir
+        self.num_shards = num_shards
+        self.tmp_dir = tmp_dir
+        self.shards = list()
+        self.locks = list()
+        for shard_idx in range(num_shards):
+            self.shards.append(open(self.shard_path(shard_idx), 'w',
+                                    newline='', encoding='utf-8'))
+            self.locks.append(threading.Lock())
+
+    def shard_path(self, shard_idx):
+        return os.path.join(self.output_dir,
+                            'events_shard%04d.csv' % shard_idx)
+
+    def shard_idx(self, user_id):
+        # stable across runs, unlike hash()
+        h = 0
+        for c in user_id.encode('utf-8'):
+            h = (h * 31 + c) & 0xffffffff
+        return h % self.num_shards
+
+    def write(self, user_id, rows):
+        if self.num_shards == 0:
+            output_file = gce.get_output_path(user_id,
+                                              directory=self.output_dir)
+            try:
+                gce.write_csv(output_file + '.tmp', rows)
+                os.replace(output_file + '.tmp', output_file)
+            finally:
+                if os.path.exists(output_file + '.tmp'):
+                    os.remove(output_file + '.tmp')
+            return output_file
+
+        block_file = tempfile.NamedTemporaryFile('w', dir=self.tmp_dir,
+                                                 suffix='.csv', newline='',
+                                                 encoding='utf-8',
+                                                 delete=False)
+        tmp_path = block_file.name
+        try:
+            # the merge runs here, outside the shard lock
+            with block_file:
+                event_writer = csv.writer(block_file, quotechar='"')
+                for evt_features in rows:
+                    event_writer.writerow(evt_features)
+            shard_idx = self.shard_idx(user_id)
+            shard = self.shards[shard_idx]
+            with self.locks[shard_idx], \
+                    open(tmp_path, newline='', encoding='utf-8') as block:
+                start = shard.tell()
+                try:
+                    shutil.copyfileobj(block, shard)
+                    shard.flush()
+                except Exception:
+                    # drop what was appended of this user
+                    shard.seek(start)
+                    shard.truncate()
+                    raise
+        finally:
+            os.remove(tmp_path)
+        return self.shard_path(shard_idx)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+def export_calendar(client, calendar_id, sink, tmp_dir, chunk_size):
+    num_events = 0
+    num_title_chars = 0
+    non_printable_count = 0
+    filtered_events_num = dict()
+    valid_week_evt_cnt_dict = dict()
+    sorter = ExternalSorter(tmp_dir, chunk_size)
+
+    try:
+        # pages are featurized and spilled as they arrive
+        for response in client.iter_pages(calendar_id):
+            events = response.get('items', [])
+            num_events += len(events)
+            valid_events, keys = gce.featurize_events(events, calendar_id,
+                                                      filtered_events_num)
+            for evt_features, register_key in zip(valid_events, keys):
+                gce.dict_count(valid_week_evt_cnt_dict,
+                               evt_features[gce.start_year_idx] * 100 +
+                               evt_features[gce.start_week_idx])
+                if not gce.allow_non_eng_users:
+                    title = evt_features[gce.title_idx]
+                    num_title_chars += len(title)
+                    non_printable_count += gce.count_non_printable(title)
+                sorter.add(evt_features, register_key)
+
+        print('%s: #events %d, #valid_events %d' %
+              (calendar_id, num_events, sorter.num_rows))
+        if gce.filter_user_counts(sorter.num_rows, valid_week_evt_cnt_dict,
+                                  non_printable_count, num_title_chars):
+            return None
+        return sink.write(calendar_id, sorter)
+    finally:
+        sorter.close()
+
+
+def export_calendars(calendar_ids, make_http, output_dir, api_root=API_ROOT,
+                     num_shards=0, workers=8, chunk_size=100000,
+                     tmp_dir=None):
+    """Returns (outputs, failed): the csv path per calendar (None for
+    users filtered out) and {calendar_id: error} for failed exports,
+    whose rows are not in any output.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    sink = CsvSink(output_dir, num_shards, tmp_dir)
+    local = threading.local()
+    failed = dict()
+
+    def export(calendar_id):
+        # one client (and Http object) per worker thread
+        if not hasattr(local, 'client'):
+            local.client = CalendarClient(make_http(), api_root)
+        try:
+            return export_calendar(local.client, calendar_id, sink,
+                                   tmp_dir, chunk_size)
+        except Exception as e:
+            print('%s: export failed (%s)' % (calendar_id, e))
+            failed[calendar_id] = repr(e)
+            return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(export, calendar_ids)), failed
+    finally:
+        sink.close()
+
+
+def read_calendar_ids(path):
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(parents=[tools.argparser])
+    arg_parser.add_argument('--calendar_ids_path', type=str, required=True,
+                            help='text file with one calendar id per line')
+    arg_parser.add_argument('--output_dir', type=str, default=gce.output_dir)
+    arg_parser.add_argument('--num_shards', type=int, default=0,
+                            help='0 writes one csv file per user')
+    arg_parser.add_argument('--workers', type=int, default=8)
+    arg_parser.add_argument('--chunk_size', type=int, default=100000,
+                            help='rows held in memory per calendar')
+    arg_parser.add_argument('--tmp_dir', type=str, default=None)
+    arg_parser.add_argument('--api_root', type=str, default=API_ROOT)
+    args = arg_parser.parse_args()
+
+    if args.api_root == API_ROOT:
+        gce.check_credentials()
+        credentials = gce.get_credentials(args)
+
+        def make_http():
+            return credentials.authorize(httplib2.Http())
+    else:
+        make_http = httplib2.Http
+
+    calendar_ids = read_calendar_ids(args.calendar_ids_path)
+    outputs, failed = export_calendars(calendar_ids, make_http,
+                                       args.output_dir,
+                                       api_root=args.api_root,
+                                       num_shards=args.num_shards,
+                                       workers=args.workers,
+                                       chunk_size=args.chunk_size,
+                                       tmp_dir=args.tmp_dir)
+    print('Exported %d of %d calendars' %
+          (sum(o is not None for o in outputs), len(calendar_ids)))
+    if failed:
+        print('Failed (%d): %s' % (len(failed), ', '.join(sorted(failed))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import argparse
+import base64
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+# Local stand-in for the parts of the Google Calendar API v3 used by
+# calendar_sync.py: calendarList.list and events.list with page tokens
+# and sync tokens. Serves http://127.0.0.1:<port>/calendar/v3
+API_PREFIX = '/calendar/v3'
+
+
+class CalendarStub(object):
+    def __init__(self, calendars=None, page_size=250):
+        # calendars: {calendar_id: [event, ...]}, the first one is primary
+        self.page_size = page_size
+        self.version = 0
+        self.min_sync_version = 0
+        self.calendars = dict()
+        self.primary_id = None
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+        self.num_requests = 0
+
+        for calendar_id, events in (calendars or {}).items():
+            self.add_calendar(calendar_id)
+            for event in events:
+                self.put_event(calendar_id, event)
+
+    def add_calendar(self, calendar_id):
+        with self.lock:
+            if self.primary_id is None:
+                self.primary_id = calendar_id
+            self.calendars.setdefault(calendar_id, dict())
+
+    def put_event(self, calendar_id, event):
+        with self.lock:
+            self.version += 1
+            event = dict(event)
+            event.setdefault('status', 'confirmed')
+            self.calendars[calendar_id][event['id']] = (self.version, event)
+
+    def delete_event(self, calendar_id, event_id):
+        with self.lock:
+            self.version += 1
+            self.calendars[calendar_id][event_id] = \
+                (self.version, {'id': event_id, 'status': 'cancelled'})
+
+    def expire_sync_tokens(self):
+        # clients holding older tokens get 410 and must resync fully
+        with self.lock:
+            self.min_sync_version = self.version
+
+    def list_calendars(self):
+        with self.lock:
+            items = [{'id': calendar_id,
+                      'primary': calendar_id == self.primary_id}
+                     for calendar_id in self.calendars]
+        return 200, {'items': items}
+
+    def list_events(self, calendar_id, params):
+        with self.lock:
+            if calendar_id == 'primary':
+                calendar_id = self.primary_id
+            if calendar_id not in self.calendars:
+                return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+
+            page_token = params.get('pageToken')
+            if page_token is not None:
+                page = json.loads(base64.urlsafe_b64decode(
+                    page_token.encode()).decode())
+            else:
+                sync_token = params.get('syncToken')
+                since = 0
+                if sync_token is not None:
+                    since = int(sync_token)
+                    if since < self.min_sync_version:
+                        return 410, {'error': {'code': 410,
+                                               'message': 'Gone'}}
+                page = {'since': since, 'until': self.version, 'offset': 0,
+                        'deleted': sync_token is not None}
+
+            max_results = int(params.get('maxResults', self.page_size))
+            # versions are unique, so events are ordered by last change
+            events = sorted(
+                ((v, e) for v, e in self.calendars[calendar_id].values()
+                 if page['since'] < v <= page['until']
+                 and (page['deleted'] or e['status'] != 'cancelled')),
+                key=lambda ve: ve[0])
+            offset = page['offset']
+            items = [e for _, e in events[offset:offset + max_results]]
+
+            body = {'items': items}
+            if offset + max_results < len(events):
+                page['offset'] = offset + max_results
+                body['nextPageToken'] = base64.urlsafe_b64encode(
+                    json.dumps(page).encode()).decode()
+            else:
+                body['nextSyncToken'] = str(page['until'])
+            return 200, body
+
+    def handle(self, path, params):
+        self.num_requests += 1
+        if not path.startswith(API_PREFIX):
+            return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+        parts = [unquote(p) for p in path[len(API_PREFIX):].split('/') if p]
+        if parts == ['users', 'me', 'calendarList']:
+            return self.list_calendars()
+        if len(parts) == 3 and parts[0] == 'calendars' \
+                and parts[2] == 'events':
+            return self.list_events(parts[1], params)
+        return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+
+    def start(self, port=0):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                status, body = stub.handle(url.path, params)
+                content = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self.api_root()
+
+    def api_root(self):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_address[1],
+                                          API_PREFIX)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--events_json', type=str, required=True,
+                            help='{calendar_id: [event resource, ...]}')
+    arg_parser.add_argument('--port', type=int, default=8080)
+    arg_parser.add_argument('--page_size', type=int, default=250)
+    args = arg_parser.parse_args()
+
+    with open(args.events_json, encoding='utf-8') as f:
+        calendar_stub = CalendarStub(json.load(f), page_size=args.page_size)
+    print('Serving', calendar_stub.start(args.port))
+    try:
+        calendar_stub.thread.join()
+    except KeyboardInterrupt:
+        calendar_stub.stop()
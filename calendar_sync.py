@@ -0,0 +1,271 @@
+import argparse
+import csv
+import json
+import os
+import tempfile
+
+import httplib2
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode
+
+from oauth2client import tools
+
+import get_google_calendar_events as gce
+
+API_ROOT = 'https://www.googleapis.com/calendar/v3'
+
+
+class SyncTokenExpired(Exception):
+    # HTTP 410: the stored sync token is no longer valid
+    pass
+
+
+class CalendarClient(object):
+    """Minimal REST client for calendarList.list and events.list.
+
+    Talks to API_ROOT or to a local stand-in (calendar_stub.py). Each
+    client owns its Http object, since httplib2 is not thread-safe.
+    """
+
+    def __init__(self, http, api_root=API_ROOT, page_size=2500):
+        self.http = http
+        self.api_root = api_root.rstrip('/')
+        self.page_size = page_size
+
+    def get(self, path, params):
+        url = self.api_root + path + '?' + urlencode(params)
+        response, content = self.http.request(url, 'GET')
+        if response.status == 410:
+            raise SyncTokenExpired(url)
+        if response.status != 200:
+            raise RuntimeError('%s %d %s' % (url, response.status, content))
+        return json.loads(content.decode('utf-8'))
+
+    def get_primary_calendar_id(self):
+        params = dict()
+        while True:
+            calendar_list = self.get('/users/me/calendarList', params)
+            for calendar_list_entry in calendar_list['items']:
+                if calendar_list_entry.get('primary') is True:
+                    return calendar_list_entry['id']
+            if not calendar_list.get('nextPageToken'):
+                return None
+            params['pageToken'] = calendar_list['nextPageToken']
+
+    def iter_pages(self, calendar_id, sync_token=None):
+        # responses of a full (sync_token=None) or incremental listing;
+        # the last one carries nextSyncToken
+        path = '/calendars/%s/events' % quote(calendar_id, safe='')
+        params = {'singleEvents': 'true', 'maxResults': self.page_size}
+        if sync_token is not None:
+            params['syncToken'] = sync_token
+
+        while True:
+            response = self.get(path, params)
+            yield response
+            if not response.get('nextPageToken'):
+                return
+            params['pageToken'] = response['nextPageToken']
+
+    def list_events(self, calendar_id, sync_token=None):
+        # returns (events, next_sync_token)
+        events = list()
+        response = dict()
+        for response in self.iter_pages(calendar_id, sync_token):
+            events.extend(response.get('items', []))
+        return events, response.get('nextSyncToken')
+
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(state, state_path):
+    fd, tmp_path = tempfile.mkstemp(
+        suffix='.tmp', dir=os.path.dirname(state_path) or '.')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def get_week_key(event):
+    week = gce.get_start_week(event)
+    return None if week is None else list(week)
+
+
+def update_csv_weeks(csv_path, weeks, valid_events):
+    """Replaces the rows of the given weeks in a sorted events csv.
+
+    Rows of other weeks are copied through without being parsed, apart
+    from their (year, week) columns.
+    """
+    weeks = sorted(set(tuple(w) for w in weeks))
+    week_rows = dict()
+    for evt_features in gce.sort_events(valid_events):
+        week = (evt_features[gce.start_year_idx],
+                evt_features[gce.start_week_idx])
+        week_rows.setdefault(week, list()).append(evt_features)
+
+    fd, tmp_path = tempfile.mkstemp(
+        suffix='.tmp', dir=os.path.dirname(csv_path) or '.')
+    try:
+        with os.fdopen(fd, 'w', newline='', encoding='utf-8') as dst, \
+                open(csv_path, 'r', newline='', encoding='utf-8') as src:
+            event_reader = csv.reader(src, quotechar='"')
+            event_writer = csv.writer(dst, quotechar='"')
+            week_idx = 0
+            for row in event_reader:
+                week = (int(row[gce.start_year_idx]),
+                        int(row[gce.start_week_idx]))
+                while week_idx < len(weeks) and weeks[week_idx] < week:
+                    event_writer.writerows(
+                        week_rows.get(weeks[week_idx], []))
+                    week_idx += 1
+                if week_idx < len(weeks) and weeks[week_idx] == week:
+                    continue
+                event_writer.writerow(row)
+            for week in weeks[week_idx:]:
+                event_writer.writerows(week_rows.get(week, []))
+        os.replace(tmp_path, csv_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def full_sync(client, calendar_id, user_id, csv_path, state_path):
+    events, sync_token = client.list_events(calendar_id)
+    store = dict()
+    for event in events:
+        if event.get('status') != 'cancelled':
+            store[event['id']] = {'event': event,
+                                  'week': get_week_key(event)}
+
+    filtered_events_num = dict()
+    valid_week_evt_cnt_dict = dict()
+    valid_events = gce.extract_features(
+        [s['event'] for s in store.values()], user_id,
+        filtered_events_num, valid_week_evt_cnt_dict)
+    print('%s: #events %d, #valid_events %d' %
+          (calendar_id, len(events), len(valid_events)))
+    if gce.filter_user(valid_events, gce.title_idx, valid_week_evt_cnt_dict):
+        return None
+
+    gce.write_csv(csv_path, gce.sort_events(valid_events))
+    save_state({'calendar_id': calendar_id, 'user_id': user_id,
+                'sync_token': sync_token, 'events': store}, state_path)
+    return len(events)
+
+
+def incremental_sync(client, state, csv_path, state_path):
+    calendar_id = state['calendar_id']
+    changed, sync_token = client.list_events(calendar_id,
+                                             sync_token=state['sync_token'])
+    store = state['events']
+    weeks = set()
+    for event in changed:
+        old = store.pop(event['id'], None)
+        if old is not None and old['week'] is not None:
+            weeks.add(tuple(old['week']))
+        if event.get('status') != 'cancelled':
+            new = {'event': event, 'week': get_week_key(event)}
+            store[event['id']] = new
+            if new['week'] is not None:
+                weeks.add(tuple(new['week']))
+
+    if weeks:
+        # features of a week depend only on the events in that week
+        week_events = [s['event'] for s in store.values()
+                       if s['week'] is not None and tuple(s['week']) in weeks]
+        valid_events = gce.extract_features(week_events, state['user_id'])
+        update_csv_weeks(csv_path, weeks, valid_events)
+
+    state['sync_token'] = sync_token
+    save_state(state, state_path)
+    print('%s: #changed %d, #updated_weeks %d' %
+          (calendar_id, len(changed), len(weeks)))
+    return len(changed)
+
+
+def sync_calendar(calendar_id, make_http, api_root=API_ROOT, full=False,
+                  user_id=None):
+    client = CalendarClient(make_http(), api_root)
+    if user_id is None:
+        user_id = calendar_id
+        if calendar_id == 'primary':
+            user_id = client.get_primary_calendar_id()
+
+    csv_path = gce.get_output_path(user_id)
+    state_path = gce.get_output_path(user_id, '_sync.json')
+    state = None if full else load_state(state_path)
+    if state is not None and os.path.exists(csv_path):
+        try:
+            return incremental_sync(client, state, csv_path, state_path)
+        except SyncTokenExpired:
+            print('%s: sync token expired, resyncing' % calendar_id)
+    return full_sync(client, calendar_id, user_id, csv_path, state_path)
+
+
+def sync_calendars(calendar_ids, make_http, api_root=API_ROOT, full=False,
+                   workers=4):
+    """Syncs calendars concurrently, one client per calendar.
+
+    'primary' is resolved up front, and an id naming a user already
+    being synced (e.g. 'primary' and the primary calendar's own id)
+    shares that sync, so no two threads write the same user's files.
+    Returns one result per given id.
+    """
+    primary_id = None
+    if 'primary' in calendar_ids:
+        client = CalendarClient(make_http(), api_root)
+        primary_id = client.get_primary_calendar_id()
+    user_ids = [primary_id if calendar_id == 'primary' else calendar_id
+                for calendar_id in calendar_ids]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict()
+        for calendar_id, user_id in zip(calendar_ids, user_ids):
+            if user_id not in futures:
+                futures[user_id] = executor.submit(
+                    sync_calendar, calendar_id, make_http, api_root, full,
+                    user_id)
+        return [futures[user_id].result() for user_id in user_ids]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(parents=[tools.argparser])
+    arg_parser.add_argument('--calendar_ids', type=str, default='primary',
+                            help='comma separated calendar ids')
+    arg_parser.add_argument('--workers', type=int, default=4)
+    arg_parser.add_argument('--full', action='store_true',
+                            help='ignore stored sync tokens')
+    arg_parser.add_argument('--api_root', type=str, default=API_ROOT,
+                            help='e.g. a local calendar_stub.py server')
+    args = arg_parser.parse_args()
+
+    if not os.path.exists(gce.output_dir):
+        os.makedirs(gce.output_dir)
+
+    if args.api_root == API_ROOT:
+        gce.check_credentials()
+        credentials = gce.get_credentials(args)
+
+        def make_http():
+            return credentials.authorize(httplib2.Http())
+    else:
+        make_http = httplib2.Http
+
+    sync_calendars(args.calendar_ids.split(','), make_http,
+                   api_root=args.api_root, full=args.full,
+                   workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import pickle
+
+import torch
+import torch.nn.functional as F
+
+import dataset
+import recommend
+import test
+from checkpoint import atomic_save
+
+
+def collect_outputs(model, loader, dvc, weeks=False):
+    forward = model.forward_weeks if weeks else model
+    outputs = list()
+    targets = list()
+    with torch.no_grad():
+        for ex in dataset.DevicePrefetcher(loader, dvc):
+            outputs.append(forward(*ex[:-1]))
+            targets.append(ex[-1])
+    return torch.cat(outputs), torch.cat(targets)
+
+
+def describe(outputs, targets, temperature):
+    probs = recommend.calibrated_probs(outputs, temperature)
+    nll = F.cross_entropy(outputs / temperature, targets).item()
+    ece = recommend.calibration_error(probs, targets)
+    print('temperature %.4f: nll %.4f, ece %.4f, mean confidence %.4f' %
+          (temperature, nll, ece,
+           recommend.confidence(probs).mean().item()))
+    return {'nll': nll, 'ece': ece}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--model_path', type=str,
+                            default='./data/nesa_180522_0.pth')
+    arg_parser.add_argument('--output_path', type=str, default=None,
+                            help='defaults to updating --model_path')
+    arg_parser.add_argument('--input_path', type=str, required=True,
+                            help='validation events, not used in training')
+    arg_parser.add_argument('--trained_dict_path', type=str,
+                            default='./data/dataset_180522_dict.pkl')
+    arg_parser.add_argument('--batch_size', type=int, default=32)
+    arg_parser.add_argument('--week_batches', type=int, default=0)
+    arg_parser.add_argument('--yes_cuda', type=int, default=1)
+    args = arg_parser.parse_args()
+
+    use_cuda = args.yes_cuda > 0 and torch.cuda.is_available()
+    device = torch.device('cuda' if use_cuda else 'cpu')
+
+    config = dataset.Config()
+    config.test_path = args.input_path
+    nets_dictionary = pickle.load(open(args.trained_dict_path, 'rb'))
+    valid_set = dataset.NETSDataset(config, nets_dictionary)
+    assert len(valid_set.test_data) > 0, 'no events'
+    weeks = args.week_batches > 0
+    _, _, valid_loader = valid_set.get_dataloader(
+        batch_size=args.batch_size, shuffle=False, weeks=weeks)
+
+    model, _ = test.get_model(valid_set.widx2vec, args.model_path, device,
+                              valid_set.idx2dur, args)
+    model.eval()
+    outputs, targets = collect_outputs(model, valid_loader, device, weeks)
+
+    before = describe(outputs, targets, 1.)
+    temperature = recommend.fit_temperature(outputs, targets)
+    after = describe(outputs, targets, temperature)
+
+    # the rest of the checkpoint (optimizer, scheduler) is kept as is
+    checkpoint = torch.load(args.model_path, map_location='cpu')
+    checkpoint['temperature'] = temperature
+    checkpoint['calibration'] = {'input_path': args.input_path,
+                                 'count': targets.size(0),
+                                 'before': before, 'after': after}
+    output_path = args.output_path or args.model_path
+    atomic_save(checkpoint, output_path)
+    print('saved %s' % output_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+import os
+import queue
+import random
+import re
+import threading
+
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    # recursively copy tensors to cpu so that the training loop can keep
+    # updating the live parameters while the snapshot is being written
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    elif isinstance(obj, dict):
+        return type(obj)((k, to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, list):
+        return [to_cpu(v) for v in obj]
+    elif isinstance(obj, tuple):
+        return tuple(to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(state, filename):
+    # write to a temp file in the same directory, then rename over the
+    # target; a crash mid-write leaves the previous file untouched
+    ckpt_dir = os.path.dirname(filename)
+    if ckpt_dir:
+        os.makedirs(ckpt_dir, exist_ok=True)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def get_rng_state():
+    rng_state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        rng_state['cuda'] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+
+def set_rng_state(rng_state):
+    random.setstate(rng_state['python'])
+    np.random.set_state(rng_state['numpy'])
+    torch.set_rng_state(rng_state['torch'])
+    if 'cuda' in rng_state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+
+
+# ReduceLROnPlateau has no state_dict before torch 1.0
+PLATEAU_STATE = ('best', 'num_bad_epochs', 'cooldown_counter', 'last_epoch')
+
+
+def get_scheduler_state(scheduler):
+    if hasattr(scheduler, 'state_dict'):
+        return scheduler.state_dict()
+    return {key: getattr(scheduler, key) for key in PLATEAU_STATE
+            if hasattr(scheduler, key)}
+
+
+def set_scheduler_state(scheduler, state):
+    if hasattr(scheduler, 'load_state_dict'):
+        scheduler.load_state_dict(state)
+    else:
+        for key in PLATEAU_STATE:
+            if key in state:
+                setattr(scheduler, key, state[key])
+
+
+class CheckpointManager(object):
+    """Writes checkpoints in a background thread with atomic renames.
+
+    Keeps the last `keep_last` step checkpoints plus the best one by MRR
+    as <model_name>_best.pth. Checkpoints are snapshotted to CPU before
+    save() returns, so the caller may continue training immediately.
+    """
+
+    def __init__(self, checkpoint_dir, model_name, keep_last=3,
+                 async_write=True):
+        self.checkpoint_dir = checkpoint_dir
+        self.model_name = model_name
+        self.keep_last = keep_last
+        self.async_write = async_write
+        self.best_mrr = None
+        self.error = None
+
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+        self.step_pattern = re.compile(
+            '^' + re.escape(model_name) + r'_step(\d+)\.pth$')
+        self.queue = queue.Queue(maxsize=2)
+        self.writer = None
+        if self.async_write:
+            self.writer = threading.Thread(target=self._write_loop,
+                                           daemon=True)
+            self.writer.start()
+
+        best = self.best_path()
+        if os.path.exists(best):
+            self.best_mrr = torch.load(best, map_location='cpu').get('mrr')
+
+    def step_path(self, step):
+        return os.path.join(self.checkpoint_dir,
+                            '%s_step%d.pth' % (self.model_name, step))
+
+    def best_path(self):
+        return os.path.join(self.checkpoint_dir, self.model_name + '_best.pth')
+
+    def list_steps(self):
+        steps = list()
+        for filename in os.listdir(self.checkpoint_dir):
+            m = self.step_pattern.match(filename)
+            if m is not None:
+                steps.append(int(m.group(1)))
+        return sorted(steps)
+
+    def latest_path(self):
+        steps = self.list_steps()
+        if len(steps) == 0:
+            return None
+        return self.step_path(steps[-1])
+
+    def save(self, state, step, mrr=None):
+        if self.error is not None:
+            raise self.error
+
+        state = to_cpu(state)
+        state['step'] = step
+        state['mrr'] = mrr
+        is_best = mrr is not None and \
+            (self.best_mrr is None or mrr > self.best_mrr)
+        if is_best:
+            self.best_mrr = mrr
+
+        if self.async_write:
+            # blocks only when two writes are already pending
+            self.queue.put((state, step, is_best))
+        else:
+            self._write(state, step, is_best)
+
+    def _write(self, state, step, is_best):
+        filename = self.step_path(step)
+        print('\t-> save checkpoint %s' % filename)
+        atomic_save(state, filename)
+        if is_best:
+            atomic_save(state, self.best_path())
+        self._prune()
+
+    def _prune(self):
+        steps = self.list_steps()
+        for step in steps[:max(0, len(steps) - self.keep_last)]:
+            os.remove(self.step_path(step))
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def wait(self):
+        # block until every pending checkpoint is on disk
+        if self.async_write:
+            self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+        if self.error is not None:
+            raise self.error
+
+    def load(self, filename=None, map_location='cpu'):
+        if filename is None:
+            filename = self.latest_path()
+            if filename is None:
+                return None
+        print('\t-> load checkpoint %s' % filename)
+        return torch.load(filename, map_location=map_location)
+
+
+def get_training_state(model, sampler=None, num_consumed=0, **extra):
+    # everything needed to resume a preempted job where it stopped
+    state = {
+        'state_dict': model.state_dict(),
+        'optimizer': model.optimizer.state_dict(),
+        'scheduler': get_scheduler_state(model.scheduler),
+        'config': model.config,
+        'rng': get_rng_state(),
+    }
+    if sampler is not None:
+        state['sampler'] = sampler.state_dict(num_consumed)
+    state.update(extra)
+    return state
+
+
+def restore_training_state(model, state, sampler=None):
+    model.load_state_dict(state['state_dict'])
+    model.optimizer.load_state_dict(state['optimizer'])
+    if 'scheduler' in state:
+        set_scheduler_state(model.scheduler, state['scheduler'])
+    if sampler is not None and 'sampler' in state:
+        sampler.load_state_dict(state['sampler'])
+    if 'rng' in state:
+        set_rng_state(state['rng'])
+    return state.get('step', 0)
@@ -1,4 +1,4 @@
-import csv
+import inspect
 import math
 import nltk
 import numpy as np
@@ -6,17 +6,91 @@ import os
 import pprint
 import pickle
 import string
+import tempfile
 import torch
 
 from torch.utils.data import Dataset
 from torch.utils.data.sampler import Sampler
 
+from event_record import DATASET_FIELDS, describe_source, \
+    iter_column_batches
+from utils import DataWorkerInit
+
 if not os.path.exists(os.path.join(os.path.expanduser('~'), 'nltk_data')):
     nltk.download('punkt')
 
 
+def slots_to_grid(slots, grid_size):
+    grid = np.zeros(grid_size, dtype=bool)
+    grid[slots] = True
+    return grid
+
+
+def pack_grid(grid):
+    # bool occupancy grid -> bytes, 1 bit per slot (21 bytes for 168 slots)
+    assert len(grid) % 8 == 0
+    return np.packbits(grid).tobytes()
+
+
+def unpack_grids(packed_grids):
+    # list of packed grids -> float tensor of [batch, grid_size]
+    packed = np.frombuffer(b''.join(packed_grids), dtype=np.uint8)
+    bits = np.unpackbits(packed.reshape(len(packed_grids), -1), axis=1)
+    return torch.from_numpy(bits).float()
+
+
+def group_weeks(examples):
+    """Groups consecutive examples whose contexts extend one another.
+
+    Examples of a week have the prefixes of one event list as contexts.
+    Returns [input_user, week_context, week_targets] per group, where
+    week_context is the longest context and week_targets holds
+    [input_title, input_duration, n_context, input_grid, target_slot].
+    """
+    weeks = list()
+    for example in examples:
+        input_user, input_context = example[0], example[3]
+        week = weeks[-1] if weeks else None
+        if week is None or week[0] != input_user or \
+                len(input_context) < len(week[1]) or \
+                not all(a is b or a == b
+                        for a, b in zip(week[1], input_context)):
+            week = [input_user, input_context, list()]
+            weeks.append(week)
+        week[1] = input_context
+        week[2].append([example[1], example[2], len(input_context),
+                        example[4], example[5]])
+    return weeks
+
+
+class SplitData(object):
+    """Attribute holding the examples of a split. Assigning it bumps
+    <name>_version, which keys the caches derived from the examples;
+    after editing the examples in place, assign them again.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        # datasets pickled before SplitData keep the plain attribute
+        return obj.__dict__.get('_' + self.name, obj.__dict__.get(self.name))
+
+    def __set__(self, obj, examples):
+        obj.__dict__['_' + self.name] = examples
+        version = self.name + '_version'
+        obj.__dict__[version] = obj.__dict__.get(version, 0) + 1
+
+
 class NETSDataset(object):
-    def __init__(self, _config, pretrained_dict):
+    train_data = SplitData('train_data')
+    valid_data = SplitData('valid_data')
+    test_data = SplitData('test_data')
+
+    def __init__(self, _config, pretrained_dict, test_records=None):
+        # test_records: EventRecords to use instead of config.test_path
         self.config = _config
 
         # initial, predefined settings
@@ -62,6 +136,8 @@ class NETSDataset(object):
         self.initial_word_dict = {}
         self.invalid_weeks = set()
         self.user_event_cnt = {}
+        self.char_table = None
+        self.char_table_size = 0
 
         assert pretrained_dict is not None
 
@@ -96,10 +172,14 @@ class NETSDataset(object):
         # only for stats
         self.week_key_set = set()
 
+        # see get_split_dataset
+        self.split_datasets = dict()
+
         self.train_data = None
         self.valid_data = None
         self.test_data = self.process_data(
-                self.config.test_path)
+                self.config.test_path if test_records is None
+                else test_records)
 
         self.train_ptr = 0
         self.valid_ptr = 0
@@ -143,8 +223,92 @@ class NETSDataset(object):
                     output.append(dictionary[self.word2idx[self.UNK]])
         return output
     
-    def build_word_dict(self, path, update=True):
-        print('### build word dict %s' % path)
+    def tokenize(self, what):
+        what_split = nltk.word_tokenize(what)
+        if self.config.glove_type == 6:
+            what_split = [word.lower() for word in what_split]
+        return what_split
+
+    def encode_title(self, what):
+        # [sentchar, sentword, length] of a single title
+        what_split = self.tokenize(what)
+        sentchar = list()
+        for word in what_split:
+            sentchar.append([self.char2idx[self.BOW]] +
+                            self.map_dictionary(word, self.char2idx) +
+                            [self.char2idx[self.EOW]])
+        sentword = self.map_dictionary(what_split, self.word2idx)
+        assert len(sentword) == len(sentchar)
+        return [sentchar, sentword, len(sentword)]
+
+    def get_char_table(self):
+        # code point -> char id, rebuilt when char2idx grows
+        if self.char_table is None or \
+                self.char_table_size != len(self.char2idx):
+            chars = [c for c in self.char2idx
+                     if isinstance(c, str) and len(c) == 1]
+            # the last entry catches code points past the table
+            table_len = max([ord(c) for c in chars] + [255]) + 2
+            self.char_table = np.full(table_len, self.char2idx[self.UNK],
+                                      dtype=np.int64)
+            for c in chars:
+                self.char_table[ord(c)] = self.char2idx[c]
+            self.char_table_size = len(self.char2idx)
+        return self.char_table
+
+    def encode_titles(self, titles):
+        """Encodes titles into flat char and word id arrays.
+
+        Returns (char_ids, char_offsets, word_ids, word_offsets). The chars
+        of word j, wrapped with BOW and EOW, are
+        char_ids[char_offsets[j]:char_offsets[j + 1]] and the words of
+        title i are word_ids[word_offsets[i]:word_offsets[i + 1]].
+        """
+        words = list()
+        word_offsets = [0]
+        for what in titles:
+            words += self.tokenize(what)
+            word_offsets.append(len(words))
+        word_offsets = np.array(word_offsets, dtype=np.int64)
+
+        unk_widx = self.word2idx[self.UNK]
+        word_ids = np.array([self.word2idx.get(word, unk_widx)
+                             for word in words], dtype=np.int64)
+
+        # all chars at once, then BOW/EOW around each word
+        char_table = self.get_char_table()
+        code_points = np.frombuffer(
+            ''.join(words).encode('utf-32-le', 'surrogatepass'),
+            dtype=np.uint32)
+        chars = char_table[np.minimum(code_points, len(char_table) - 1)]
+        word_lens = np.array([len(word) for word in words], dtype=np.int64)
+        char_offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum(word_lens + 2, out=char_offsets[1:])
+        char_ids = np.empty(char_offsets[-1], dtype=np.int64)
+        char_ids[char_offsets[:-1]] = self.char2idx[self.BOW]
+        char_ids[char_offsets[1:] - 1] = self.char2idx[self.EOW]
+        char_ids[np.arange(len(chars)) + 1 +
+                 2 * np.repeat(np.arange(len(words)), word_lens)] = chars
+        return char_ids, char_offsets, word_ids, word_offsets
+
+    @staticmethod
+    def split_titles(char_ids, char_offsets, word_ids, word_offsets):
+        # flat arrays of encode_titles -> [sentchar, sentword, length] lists
+        char_ids = char_ids.tolist()
+        char_offsets = char_offsets.tolist()
+        word_ids = word_ids.tolist()
+        word_offsets = word_offsets.tolist()
+        encoded = list()
+        for w_start, w_end in zip(word_offsets[:-1], word_offsets[1:]):
+            sentchar = [char_ids[char_offsets[w]:char_offsets[w + 1]]
+                        for w in range(w_start, w_end)]
+            encoded.append([sentchar, word_ids[w_start:w_end],
+                            w_end - w_start])
+        return encoded
+
+    def build_word_dict(self, source, update=True):
+        # source: csv/.npz/.parquet path, pyarrow Table or EventRecords
+        print('### build word dict %s' % describe_source(source))
 
         def check_printable(text, w_key):
             for char in text:
@@ -164,18 +328,13 @@ class NETSDataset(object):
                     return False
             return True
 
-        with open(path, 'r', newline='', encoding='utf-8') as f:
-            calendar_data = csv.reader(f, quotechar='"')
-            prev_what_list = list()
-            prev_week_key = ''
-            for k, features in enumerate(calendar_data):
-                assert len(features) == self.feature_len 
-                what = features[1]
-                user_id = features[0]
-                st_year = features[5]
-                st_week = features[6]
-                reg_seq = int(features[7])
-                week_key = '_'.join([user_id, st_year, st_week])
+        prev_what_list = list()
+        prev_week_key = ''
+        fields = ['user_id', 'title', 'start_year', 'start_week', 'reg_seq']
+        for columns in iter_column_batches(source, fields):
+            for user_id, what, st_year, st_week, reg_seq in zip(
+                    *[columns[field].tolist() for field in fields]):
+                week_key = '_'.join([user_id, str(st_year), str(st_week)])
 
                 if reg_seq == 0:
                     assert prev_week_key != week_key
@@ -206,7 +365,7 @@ class NETSDataset(object):
                     assert prev_week_key == week_key
                     if prev_week_key in self.invalid_weeks:
                         continue
-                    
+                
                     # event title should be printable
                     if check_printable(what, prev_week_key) \
                             and check_maxlen(what, prev_week_key):
@@ -241,101 +400,109 @@ class NETSDataset(object):
         print('dictionary change', len(self.initial_word_dict),
               'to', len(self.word2idx), len(self.idx2word), end='\n\n')
 
-    def process_data(self, path, update_dict=False):
-        print('### processing %s' % path)
+    def process_data(self, source, update_dict=False):
+        # source: csv/.npz/.parquet path, pyarrow Table or EventRecords
+        print('### processing %s' % describe_source(source))
         total_data = list()
         max_wordlen = max_sentlen = max_dur = max_context = 0
         min_dur = float("inf")
-        max_slot_idx = (self.slot_size // self.class_div) - 1
-
-        with open(path, 'r', newline='', encoding='utf-8') as f:
-            """
-            Each line consists of features below:
-                0: user id
-                1: what
-                2: duration (minute)
-                3: register time
-                4: start time
-                5: start year
-                6: start week
-                7: register sequence in the week
-                8: register start week distance
-                9: register start day distance
-                10: is recurrent?
-                11: start time slot (y)
-            """
-            prev_user = ''
-            prev_st_yw = ('', '')
-            saved_context = list()
-            calendar_data = csv.reader(f, quotechar='"')
-
-            for k, features in enumerate(calendar_data):
-                assert len(features) == self.feature_len
-                user_id = features[0]
-                what = features[1]
-                duration = int(features[2])
-                # reg_time = features[3]
-                # st_time = features[4]
-                st_year = features[5]
-                st_week = features[6]
-                reg_seq = int(features[7])
-                reg_st_week_dist = int(features[8])
-                # reg_st_day_dist = int(features[9])
-                is_recurrent = features[10]
-                st_slot = int(features[11])
-
-                # remove unprintable weeks
-                week_key = '_'.join([user_id, st_year, st_week])
-                if week_key in self.invalid_weeks:
-                    continue
-
-                # ready for one week data
-                curr_user = user_id
-                curr_st_yw = (st_year, st_week)
+        grid_size = self.slot_size // self.class_div
+        max_slot_idx = grid_size - 1
+
+        """
+        Each line consists of features below:
+            0: user id
+            1: what
+            2: duration (minute)
+            3: register time
+            4: start time
+            5: start year
+            6: start week
+            7: register sequence in the week
+            8: register start week distance
+            9: register start day distance
+            10: is recurrent?
+            11: start time slot (y)
+        """
+        saved_context = list()
+        # slots covered by saved_context (the last slot is never marked)
+        saved_grid = np.zeros(grid_size, dtype=bool)
+        prev_week_key = ''
+
+        for columns in iter_column_batches(source, DATASET_FIELDS):
+            users = columns['user_id'].tolist()
+            week_keys = ['_'.join([user_id, str(st_year), str(st_week)])
+                         for user_id, st_year, st_week
+                         in zip(users, columns['start_year'].tolist(),
+                                columns['start_week'].tolist())]
+
+            # remove unprintable weeks
+            valid = np.array([week_key not in self.invalid_weeks
+                              for week_key in week_keys], dtype=bool)
+
+            # a row starts a new week iff its reg_seq is 0
+            valid_keys = np.array(week_keys, dtype=object)[valid]
+            if len(valid_keys) > 0:
+                prev_keys = np.concatenate(
+                    [np.array([prev_week_key], dtype=object),
+                     valid_keys[:-1]])
+                assert np.array_equal(valid_keys != prev_keys,
+                                      columns['reg_seq'][valid] == 0)
+                prev_week_key = valid_keys[-1]
+
+            # ignore data that was written in future
+            reg_st_week_dists = columns['reg_st_week_dist']
+            rows = np.flatnonzero(valid & (reg_st_week_dists >= 0))
+
+            # filter by register distance & recurrent
+            targets = ((reg_st_week_dists <= self.max_rs_dist)
+                       & ~columns['is_recurrent']).tolist()
+
+            titles = columns['title'].tolist()
+            durations = columns['duration'].tolist()
+            reg_seqs = columns['reg_seq'].tolist()
+            st_slots = columns['start_slot'].tolist()
+
+            # with fixed dictionaries, titles are encoded once per batch
+            if not update_dict:
+                unique_titles = list(dict.fromkeys(
+                    [titles[idx] for idx in rows.tolist()]))
+                encoded_titles = dict(zip(unique_titles, self.split_titles(
+                    *self.encode_titles(unique_titles))))
+
+            for idx in rows.tolist():
+                user_id = users[idx]
+                what = titles[idx]
+                duration = durations[idx]
+                reg_seq = reg_seqs[idx]
+                st_slot = st_slots[idx]
+                week_key = week_keys[idx]
 
                 # filter user by event count
-                if user_id in self.user_event_cnt:
-                    if self.user_event_cnt[user_id] > self.max_event_cnt:
-                        prev_user = curr_user
-                        prev_st_yw = curr_st_yw
-                        continue
-
-                # ignore data that was written in future
-                if reg_st_week_dist < 0:
-                    prev_user = curr_user
-                    prev_st_yw = curr_st_yw
+                if self.user_event_cnt.get(user_id, 0) > self.max_event_cnt:
                     continue
 
                 input_user = self.user2idx[self.UNK]
 
                 # process title feature
-                what_split = nltk.word_tokenize(what)
-                if self.config.glove_type == 6:
-                    what_split = [word.lower() for word in what_split]
-                for word in what_split:
+                if update_dict:
+                    for char in what:
+                        self.update_dictionary(char, 'c')
+                    input_title = self.encode_title(what)
+                else:
+                    input_title = encoded_titles[what]
+                for word_chars in input_title[0]:
+                    word_len = len(word_chars) - 2  # BOW, EOW
                     max_wordlen = \
-                        len(word) if len(word) > max_wordlen else max_wordlen
+                        word_len if word_len > max_wordlen else max_wordlen
                 max_sentlen = \
-                    len(what_split) if len(what_split) > max_sentlen \
+                    input_title[2] if input_title[2] > max_sentlen \
                     else max_sentlen
 
-                if update_dict:
-                    for char in what:
-                        self.update_dictionary(char, 'c')
                 if max_wordlen > self.config.max_wordlen:
                     self.config.max_wordlen = max_wordlen
                 if max_sentlen > self.config.max_sentlen:
                     self.config.max_sentlen = max_sentlen
-                
-                sentchar = list()
-                for word in what_split:
-                    sentchar.append([self.char2idx[self.BOW]] +
-                                    self.map_dictionary(word, self.char2idx) +
-                                    [self.char2idx[self.EOW]])
-                sentword = self.map_dictionary(what_split, self.word2idx)
-                length = len(sentword)
-                assert len(sentword) == len(sentchar)
-                input_title = [sentchar, sentword, length]
 
                 # process duration feature
                 max_dur = max_dur if max_dur > duration else duration
@@ -359,16 +526,15 @@ class NETSDataset(object):
                 assert st_slot < self.slot_size
                 input_slot = st_slot // self.class_div
                 target_slot = st_slot // self.class_div
-                
+            
                 # process context
+                # context slots w/ durations are packed into a slot grid
                 if reg_seq == 0:  # start of a new week
-                    assert curr_user != prev_user or curr_st_yw != prev_st_yw
-                    prev_user = curr_user
-                    prev_st_yw = curr_st_yw
                     input_context = list()
                     saved_context = [[input_title, fine_duration, input_slot]]
+                    saved_grid[:] = False
+                    input_grid = pack_grid(saved_grid)
                 else:  # same as the prev week
-                    assert curr_user == prev_user and curr_st_yw == prev_st_yw
                     # input_context = copy.deepcopy(saved_context)
                     prev_grid = [svs[2] for svs in saved_context]
                     if input_slot in prev_grid:
@@ -376,29 +542,21 @@ class NETSDataset(object):
                     input_context = saved_context[:]
                     saved_context.append(
                         [input_title, fine_duration, input_slot])
+                    input_grid = pack_grid(saved_grid)
 
-                # transform context features into slot grid
-                # context slots w/ durations
-
-                input_grid = set()
-                for ips in input_context:
-                    n_slots = int(math.ceil(ips[1] / (30 * self.class_div)))
-                    for slot_idx in range(n_slots):
-                        slot = ips[2] + slot_idx
-                        if slot >= max_slot_idx:
-                            break
-                        input_grid.add(slot)
+                n_slots = int(math.ceil(fine_duration /
+                                        (30 * self.class_div)))
+                saved_grid[input_slot:min(input_slot + n_slots,
+                                          max_slot_idx)] = True
 
                 # filter by register distance & max_context & recurrent
-                if (reg_st_week_dist <= self.max_rs_dist
-                        and len(input_context) <= self.max_context
-                        and 'False' == is_recurrent):
+                if targets[idx] and len(input_context) <= self.max_context:
                     max_context = max_context \
                         if max_context > len(input_context) \
                         else len(input_context)
                     total_data.append(
                         [input_user, input_title, input_duration,
-                         input_context, list(input_grid), target_slot])
+                         input_context, input_grid, target_slot])
 
                     if user_id not in self.user_event_cnt:
                         self.user_event_cnt[user_id] = 1
@@ -424,54 +582,98 @@ class NETSDataset(object):
 
         return total_data
 
-    def get_dataloader(self, batch_size=None, shuffle=True):
+    def get_split_dataset(self, examples, split):
+        """ArrayVectorize of a split's examples.
+
+        With config.example_storage_dir the arrays are memory-mapped and
+        kept until the split is assigned again (SplitData), so later
+        loaders, and processes forked or unpickled from this dataset,
+        reuse the store instead of flattening the examples again.
+        """
+        # configs pickled before example_storage_dir existed lack it
+        storage_root = getattr(self.config, 'example_storage_dir', None)
+        if storage_root is None:
+            return ArrayVectorize(examples, self.config)
+
+        version = getattr(self, split + '_data_version', 0)
+        split_datasets = getattr(self, 'split_datasets', None)
+        if split_datasets is None:  # old pickles
+            split_datasets = self.split_datasets = dict()
+        cached = split_datasets.get(split)
+        if cached is not None and cached[0] == version and \
+                examples is getattr(self, split + '_data', None):
+            return cached[1]
+        split_dataset = ArrayVectorize(examples, self.config,
+                                       os.path.join(storage_root, split))
+        if examples is getattr(self, split + '_data', None):
+            split_datasets[split] = (version, split_dataset)
+        return split_dataset
+
+    def get_split_loader(self, examples, split, batch_size, shuffle):
+        # examples live in numpy arrays (memory-mapped with
+        # config.example_storage_dir), so workers do not copy them
+        split_dataset = self.get_split_dataset(examples, split)
+        if examples is self.train_data:
+            # targets for class counts and weights, without another pass
+            self.train_arrays = (getattr(self, 'train_data_version', 0),
+                                 split_dataset.arrays['users'],
+                                 split_dataset.arrays['targets'])
+        split_sampler = SortedBatchSampler(split_dataset.lengths(),
+                                           batch_size,
+                                           shuffle=shuffle)
+
+        # keep workers alive across epochs (torch >= 1.7)
+        loader_kwargs = dict()
+        if self.config.data_workers > 0 and 'persistent_workers' in \
+                inspect.signature(torch.utils.data.DataLoader).parameters:
+            loader_kwargs['persistent_workers'] = True
+
+        return torch.utils.data.DataLoader(
+            split_dataset,
+            batch_size=batch_size,
+            sampler=split_sampler,
+            num_workers=self.config.data_workers,
+            collate_fn=self.batchify,
+            pin_memory=True,
+            worker_init_fn=self.worker_init_fn(),
+            **loader_kwargs
+        )
+
+    def get_week_loader(self, examples, split, batch_size, shuffle):
+        # batches of batch_size weeks, for NESA.forward_weeks
+        return torch.utils.data.DataLoader(
+            WeekVectorize(group_weeks(examples), self.config),
+            batch_size=batch_size,
+            shuffle=shuffle,
+            num_workers=self.config.data_workers,
+            collate_fn=self.batchify_weeks,
+            pin_memory=True,
+            worker_init_fn=self.worker_init_fn()
+        )
+
+    def worker_init_fn(self):
+        # configs pickled before data_worker_cores existed lack it
+        cores = getattr(self.config, 'data_worker_cores', None)
+        return DataWorkerInit(cores) if cores else None
+
+    def get_dataloader(self, batch_size=None, shuffle=True, weeks=False):
         if batch_size is None:
             batch_size = self.config.batch_size
+        get_loader = self.get_week_loader if weeks else self.get_split_loader
 
         if self.train_data:
-            train_dataset = Vectorize(self.train_data, self.config)
-            train_sampler = SortedBatchSampler(train_dataset.lengths(),
-                                               batch_size,
-                                               shuffle=shuffle)
-            train_loader = torch.utils.data.DataLoader(
-                train_dataset,
-                batch_size=batch_size,
-                sampler=train_sampler,
-                num_workers=self.config.data_workers,
-                collate_fn=self.batchify,
-                pin_memory=True
-            )
+            train_loader = get_loader(self.train_data, 'train', batch_size,
+                                      shuffle)
         else:
             train_loader = None
 
         if self.valid_data:
-            valid_dataset = Vectorize(self.valid_data, self.config)
-            valid_sampler = SortedBatchSampler(valid_dataset.lengths(),
-                                               batch_size,
-                                               shuffle=False)
-            valid_loader = torch.utils.data.DataLoader(
-                valid_dataset,
-                batch_size=batch_size,
-                sampler=valid_sampler,
-                num_workers=self.config.data_workers,
-                collate_fn=self.batchify,
-                pin_memory=True
-            )
+            valid_loader = get_loader(self.valid_data, 'valid', batch_size,
+                                      False)
         else:
             valid_loader = None
 
-        test_dataset = Vectorize(self.test_data, self.config)
-        test_sampler = SortedBatchSampler(test_dataset.lengths(),
-                                          batch_size,
-                                          shuffle=False)
-        test_loader = torch.utils.data.DataLoader(
-            test_dataset,
-            batch_size=batch_size,
-            sampler=test_sampler,
-            num_workers=self.config.data_workers,
-            collate_fn=self.batchify,
-            pin_memory=True
-        )
+        test_loader = get_loader(self.test_data, 'test', batch_size, False)
 
         return train_loader, valid_loader, test_loader
 
@@ -487,71 +689,111 @@ class NETSDataset(object):
         stls = [example[7] for example in batch]
         sdurs = [example[8] for example in batch]
         sslots = [example[9] for example in batch]
-        grids = torch.cat([example[10].unsqueeze(0) for example in batch])
+        grids = unpack_grids([example[10] for example in batch])
         targets = torch.cat([example[11] for example in batch])
 
         return (users, durs, tcs, tws, tls,
                 stcs, stws, stls, sdurs, sslots, grids, targets)
 
+    @staticmethod
+    def batchify_weeks(batch):
+        # targets are flattened, week contexts kept once per week
+        users = torch.cat([week[0] for week in batch])
+        durs = torch.cat([week[1] for week in batch])
+        tcs = [tc for week in batch for tc in week[2]]
+        tws = [tw for week in batch for tw in week[3]]
+        tls = [tl for week in batch for tl in week[4]]
+        stcs = [week[5] for week in batch]
+        stws = [week[6] for week in batch]
+        stls = [week[7] for week in batch]
+        sdurs = [week[8] for week in batch]
+        sslots = [week[9] for week in batch]
+        n_contexts = [week[10] for week in batch]
+        grids = unpack_grids([grid for week in batch for grid in week[11]])
+        targets = torch.cat([week[12] for week in batch])
+
+        return (users, durs, tcs, tws, tls, stcs, stws, stls, sdurs, sslots,
+                n_contexts, grids, targets)
+
+    def get_train_arrays(self):
+        """(users, targets) of train_data as int64 arrays.
+
+        Cached until train_data is assigned again (see SplitData).
+        """
+        key = getattr(self, 'train_data_version', 0)  # 0 in old pickles
+        cache = getattr(self, 'train_arrays', None)  # None in old pickles
+        if cache is None or cache[0] != key:
+            num_examples = len(self.train_data)
+            users = np.fromiter((td[0] for td in self.train_data),
+                                np.int64, num_examples)
+            targets = np.fromiter((td[5] for td in self.train_data),
+                                  np.int64, num_examples)
+            cache = self.train_arrays = (key, users, targets)
+        return cache[1], cache[2]
+
     def get_train_class_counts(self):
-        cnt_list = [0] * (self.slot_size // self.class_div)
-        for td in self.train_data:
-            cnt_list[td[5]] += 1
+        _, targets = self.get_train_arrays()
+        cnt_list = np.bincount(
+            targets, minlength=self.slot_size // self.class_div).tolist()
 
         assert len(self.train_data) == sum(cnt_list)
 
         return cnt_list
 
-    def get_class_weights(self):
-        cnt_list = self.get_train_class_counts()
+    def get_class_weights(self, smoothing=1.):
+        """Balanced class weights as a FloatTensor for
+        nn.CrossEntropyLoss(weight=...).
+
+        Empty classes count as `smoothing` examples instead of dividing
+        by zero; the other weights are unchanged.
+        """
+        key = (getattr(self, 'train_data_version', 0), smoothing)
+        cache = getattr(self, 'class_weights', None)
+        if cache is not None and cache[0] == key:
+            return cache[1]
+
+        cnt_list = np.array(self.get_train_class_counts(), dtype=np.float64)
 
         # http://scikit-learn.org/stable/modules/generated/sklearn.utils.class_weight.compute_class_weight.html
         n_classes = self.slot_size // self.class_div
-        n_samples = sum(cnt_list)
+        n_samples = cnt_list.sum()
 
         assert len(cnt_list) == n_classes
 
-        return [n_samples / (n_classes * cnt) for cnt in cnt_list]
+        cnt_list[cnt_list == 0] = smoothing
+        class_weights = torch.from_numpy(
+            n_samples / (n_classes * cnt_list)).float()
+        self.class_weights = (key, class_weights)
+        return class_weights
 
-    def get_train_user_class_dist(self):
-        user_prob_dist_dict = dict()
+    def get_user_prior(self):
+        """[user_size, n_classes] float32 slot distribution per user.
 
-        # unknown/global
+        Row UNK holds the distribution over all training events and is
+        also used for users without training events. Training events
+        must not belong to UNK.
+        """
+        n_classes = self.slot_size // self.class_div
         unknown_user_idx = self.user2idx[self.UNK]
-        user_prob_dist_dict[unknown_user_idx] = \
-            [0.] * (self.slot_size // self.class_div)
-
-        for td in self.train_data:
-            user_idx = td[0]
-            assert user_idx != unknown_user_idx
-
-            target = td[5]
-            u_prob_dist = user_prob_dist_dict.get(user_idx)
-            if u_prob_dist is None:
-                u_prob_dist = [0.] * (self.slot_size // self.class_div)
-                u_prob_dist[target] += 1.
-                user_prob_dist_dict[user_idx] = u_prob_dist
-            else:
-                u_prob_dist[target] += 1.
-
-            # unknown/global
-            user_prob_dist_dict[unknown_user_idx][target] += 1.
+        users, targets = self.get_train_arrays()
+        assert not np.any(users == unknown_user_idx)
 
-        # normalize
-        for uidx in user_prob_dist_dict:
-            user_prob_dist = user_prob_dist_dict[uidx]
-            num_u_events = sum(user_prob_dist)
-            user_prob_dist_dict[uidx] = \
-                [cnt/num_u_events for cnt in user_prob_dist]
-            # print(uidx, user_prob_dist_dict[uidx][:24])
+        counts = np.zeros((len(self.user2idx), n_classes), dtype=np.float32)
+        np.add.at(counts, (users, targets), 1.)
+        counts[unknown_user_idx] = np.bincount(targets, minlength=n_classes)
 
-        # handle unseen users
-        for uidx in self.idx2user:
-            if uidx not in user_prob_dist_dict:
-                user_prob_dist_dict[uidx] = \
-                    user_prob_dist_dict[unknown_user_idx]
+        # normalize, handle unseen users
+        num_u_events = counts.sum(1)
+        seen = num_u_events > 0
+        counts[seen] /= num_u_events[seen, None]
+        counts[~seen] = counts[unknown_user_idx]
+        return counts
 
-        return user_prob_dist_dict
+    def get_train_user_class_dist(self):
+        # {user_idx: slot distribution} for every user in idx2user; as
+        # before, users without training events get the UNK (global) one
+        user_prior = self.get_user_prior()
+        return {uidx: user_prior[uidx].tolist() for uidx in self.idx2user}
 
 
 class Vectorize(Dataset):
@@ -591,10 +833,12 @@ class Vectorize(Dataset):
             sdur.append(event[1])
             sslot.append(event[2])
 
-        # Grid
-        grid = torch.zeros(self.config.sm_day_num * self.config.sm_slot_num)
-        if len(example[4]) > 0:
-            grid[example[4]] = 1
+        # Grid (packed, unpacked per batch in batchify)
+        grid = example[4]
+        if isinstance(grid, list):  # datasets pickled with slot lists
+            grid = pack_grid(
+                slots_to_grid(grid, self.config.sm_day_num *
+                              self.config.sm_slot_num))
 
         # Target
         target = torch.LongTensor([example[5]])
@@ -611,6 +855,232 @@ class Vectorize(Dataset):
                 for example in self.examples]
 
 
+class ArrayVectorize(Dataset):
+    """Vectorize over examples kept in flat numpy arrays.
+
+    Each distinct title is stored once and referenced by index from the
+    examples and their contexts. With a storage_dir the arrays are saved
+    as .npy files and memory-mapped, so DataLoader workers share the same
+    pages (and only the directory is pickled for spawned workers) instead
+    of each holding a copy of the example lists.
+    """
+
+    def __init__(self, examples, cfg, storage_dir=None):
+        self.config = cfg
+        self.storage_dir = storage_dir
+        self.title_cache = dict()
+        self.title_cache_size = 20000
+        self.arrays = self.flatten(examples)
+        if storage_dir is not None:
+            self.save_arrays(self.arrays, storage_dir)
+            self.arrays = self.load_arrays(storage_dir)
+
+    @staticmethod
+    def save_arrays(arrays, storage_dir):
+        # written to unique temp files and renamed into place: memmaps
+        # opened by earlier loaders or other processes keep the old files
+        os.makedirs(storage_dir, exist_ok=True)
+        for name, array in arrays.items():
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=storage_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, array)
+                os.replace(tmp_path, os.path.join(storage_dir, name + '.npy'))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    @staticmethod
+    def load_arrays(storage_dir):
+        arrays = dict()
+        for filename in os.listdir(storage_dir):
+            if filename.endswith('.npy'):
+                arrays[filename[:-4]] = np.load(
+                    os.path.join(storage_dir, filename), mmap_mode='r')
+        return arrays
+
+    def flatten(self, examples):
+        grid_size = self.config.sm_day_num * self.config.sm_slot_num
+        titles = list()
+        title_ids = dict()  # id(input_title) -> title index
+        title_keys = dict()  # encoded title -> title index
+
+        def title_index(title):
+            if id(title) not in title_ids:
+                key = (tuple(title[1]), tuple(tuple(c) for c in title[0]))
+                if key not in title_keys:
+                    title_keys[key] = len(titles)
+                    titles.append(title)
+                title_ids[id(title)] = title_keys[key]
+            return title_ids[id(title)]
+
+        title_idx = list()
+        grids = list()
+        context_offsets = [0]
+        context_title = list()
+        context_dur = list()
+        context_slot = list()
+        for example in examples:
+            title_idx.append(title_index(example[1]))
+            for event in example[3]:
+                context_title.append(title_index(event[0]))
+                context_dur.append(event[1])
+                context_slot.append(event[2])
+            context_offsets.append(len(context_title))
+            grid = example[4]
+            if isinstance(grid, list):  # datasets pickled with slot lists
+                grid = pack_grid(slots_to_grid(grid, grid_size))
+            grids.append(grid)
+
+        title_word_offsets = [0]
+        char_offsets = [0]
+        word_ids = list()
+        char_ids = list()
+        for sentchar, sentword, _ in titles:
+            word_ids += sentword
+            title_word_offsets.append(len(word_ids))
+            for word_chars in sentchar:
+                char_ids += word_chars
+                char_offsets.append(len(char_ids))
+
+        def int_array(values):
+            return np.array(values, dtype=np.int64)
+
+        return {
+            'users': int_array([example[0] for example in examples]),
+            'durs': int_array([example[2] for example in examples]),
+            'targets': int_array([example[5] for example in examples]),
+            'grids': np.frombuffer(b''.join(grids), dtype=np.uint8)
+            .reshape(len(examples), grid_size // 8),
+            'title_idx': int_array(title_idx),
+            'context_offsets': int_array(context_offsets),
+            'context_title': int_array(context_title),
+            'context_dur': int_array(context_dur),
+            'context_slot': int_array(context_slot),
+            'title_word_offsets': int_array(title_word_offsets),
+            'word_ids': int_array(word_ids),
+            'char_offsets': int_array(char_offsets),
+            'char_ids': int_array(char_ids),
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['title_cache'] = dict()
+        if self.storage_dir is not None:
+            state['arrays'] = None  # reopened by the worker
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.arrays is None:
+            self.arrays = self.load_arrays(self.storage_dir)
+
+    def __len__(self):
+        return len(self.arrays['users'])
+
+    def get_title(self, title_idx):
+        # [sentchar, sentword, length] of a stored title; the first
+        # title_cache_size titles are decoded once per worker process
+        title = self.title_cache.get(title_idx)
+        if title is None:
+            arrays = self.arrays
+            w_start, w_end = \
+                arrays['title_word_offsets'][title_idx:title_idx + 2].tolist()
+            offsets = arrays['char_offsets'][w_start:w_end + 1].tolist()
+            chars = arrays['char_ids'][offsets[0]:offsets[-1]].tolist()
+            sentchar = [chars[s - offsets[0]:e - offsets[0]]
+                        for s, e in zip(offsets[:-1], offsets[1:])]
+            sentword = arrays['word_ids'][w_start:w_end].tolist()
+            title = [sentchar, sentword, w_end - w_start]
+            if len(self.title_cache) < self.title_cache_size:
+                self.title_cache[title_idx] = title
+        return title
+
+    def __getitem__(self, index):
+        arrays = self.arrays
+
+        # user and duration
+        user = torch.LongTensor([int(arrays['users'][index])])
+        dur = torch.LongTensor([int(arrays['durs'][index])])
+
+        # Title (char, word, length)
+        tc, tw, tl = self.get_title(int(arrays['title_idx'][index]))
+
+        # context (title, duration, slot)
+        c_start, c_end = \
+            arrays['context_offsets'][index:index + 2].tolist()
+        stc = list()
+        stw = list()
+        stl = list()
+        for title_idx in arrays['context_title'][c_start:c_end].tolist():
+            stitle = self.get_title(title_idx)
+            stc.append(stitle[0])
+            stw.append(stitle[1])
+            stl.append(stitle[2])
+        sdur = arrays['context_dur'][c_start:c_end].tolist()
+        sslot = arrays['context_slot'][c_start:c_end].tolist()
+
+        # Grid (packed, unpacked per batch in batchify)
+        grid = arrays['grids'][index].tobytes()
+
+        # Target
+        target = torch.LongTensor([int(arrays['targets'][index])])
+
+        return user, dur, tc, tw, tl, stc, stw, stl, sdur, sslot, grid, target
+
+    def lengths(self):
+        arrays = self.arrays
+        title_lens = np.diff(arrays['title_word_offsets'])
+        context_counts = np.diff(arrays['context_offsets'])
+        max_context_lens = np.zeros(len(self), dtype=np.int64)
+        np.maximum.at(max_context_lens,
+                      np.repeat(np.arange(len(self)), context_counts),
+                      title_lens[arrays['context_title']])
+        return list(zip(title_lens[arrays['title_idx']].tolist(),
+                        max_context_lens.tolist()))
+
+
+class WeekVectorize(Dataset):
+    """Weeks from group_weeks, each context event listed once."""
+
+    def __init__(self, weeks, cfg):
+        self.weeks = weeks
+        self.config = cfg
+
+    def __len__(self):
+        return len(self.weeks)
+
+    def __getitem__(self, index):
+        input_user, week_context, week_targets = self.weeks[index]
+
+        # per target: user, duration, title, n_context, grid and target
+        users = torch.LongTensor([input_user] * len(week_targets))
+        durs = torch.LongTensor([t[1] for t in week_targets])
+        tc = [t[0][0] for t in week_targets]
+        tw = [t[0][1] for t in week_targets]
+        tl = [t[0][2] for t in week_targets]
+        n_context = [t[2] for t in week_targets]
+        grids = list()
+        for t in week_targets:
+            grid = t[3]
+            if isinstance(grid, list):  # datasets pickled with slot lists
+                grid = pack_grid(
+                    slots_to_grid(grid, self.config.sm_day_num *
+                                  self.config.sm_slot_num))
+            grids.append(grid)
+        targets = torch.LongTensor([t[4] for t in week_targets])
+
+        # per week: context (title, duration, slot)
+        stc = [event[0][0] for event in week_context]
+        stw = [event[0][1] for event in week_context]
+        stl = [event[0][2] for event in week_context]
+        sdur = [event[1] for event in week_context]
+        sslot = [event[2] for event in week_context]
+
+        return (users, durs, tc, tw, tl, stc, stw, stl, sdur, sslot,
+                n_context, grids, targets)
+
+
 class SortedBatchSampler(Sampler):
 
     def __init__(self, lengths, batch_size, shuffle=True):
@@ -619,21 +1089,92 @@ class SortedBatchSampler(Sampler):
         self.batch_size = batch_size
         self.shuffle = shuffle
 
+        # order of the current epoch, kept for resuming
+        self.order = None
+        self.offset = 0
+        self.last_order = None
+
     def __iter__(self):
-        lengths = np.array(
-            [(l[0], l[1], np.random.random()) for l in self.lengths],
-            dtype=[('l1', np.int_), ('l2', np.int_), ('rand', np.float_)]
-        )
-        indices = np.argsort(lengths, order=('l2', 'l1', 'rand'))
-        batches = [indices[i:i + self.batch_size]
-                   for i in range(0, len(indices), self.batch_size)]
-        if self.shuffle:
-            np.random.shuffle(batches)
-        return iter([i for batch in batches for i in batch])
+        if self.order is None:
+            lengths = np.array(
+                [(l[0], l[1], np.random.random()) for l in self.lengths],
+                dtype=[('l1', np.int_), ('l2', np.int_), ('rand', np.float_)]
+            )
+            indices = np.argsort(lengths, order=('l2', 'l1', 'rand'))
+            batches = [indices[i:i + self.batch_size]
+                       for i in range(0, len(indices), self.batch_size)]
+            if self.shuffle:
+                np.random.shuffle(batches)
+            self.order = [i for batch in batches for i in batch]
+        self.last_order = self.order
+        order = self.order[self.offset:]
+
+        # the next epoch draws a new order
+        self.order = None
+        self.offset = 0
+        return iter(order)
 
     def __len__(self):
         return len(self.lengths)
 
+    def state_dict(self, num_consumed=0):
+        # num_consumed: examples of the current epoch already trained on
+        # (DataLoader workers prefetch, so the sampler cannot count them)
+        return {'order': self.last_order, 'offset': num_consumed}
+
+    def load_state_dict(self, state):
+        self.order = state['order']
+        self.offset = state['offset']
+
+
+class DevicePrefetcher(object):
+    """Iterates a DataLoader, yielding batches whose tensors are on device.
+
+    On CUDA the next batch is copied on a side stream while the current
+    one is used, so host-to-device copies overlap with compute (the
+    loaders pin memory). List features pass through unchanged.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = None
+        if device.type == 'cuda':
+            self.stream = torch.cuda.Stream(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch):
+        return tuple(feature.to(self.device, non_blocking=True)
+                     if torch.is_tensor(feature) else feature
+                     for feature in batch)
+
+    def preload(self, batches):
+        batch = next(batches, None)
+        if batch is None:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self.to_device(batch)
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield self.to_device(batch)
+            return
+
+        batches = iter(self.loader)
+        next_batch = self.preload(batches)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            batch = next_batch
+            for feature in batch:
+                if torch.is_tensor(feature):
+                    # memory is used on the compute stream from now on
+                    feature.record_stream(torch.cuda.current_stream())
+            next_batch = self.preload(batches)
+            yield batch
+
 
 class Config(object):
     def __init__(self):
@@ -659,6 +1200,8 @@ class Config(object):
         self.class_div = 0
         self.slot_size = 0
         self.data_workers = 4
+        self.data_worker_cores = None  # e.g. [12, 13, 14, 15]
+        self.example_storage_dir = None  # e.g. './data/examples'
         self.save_dataset = False
         self.sm_day_num = 7
         self.sm_slot_num = 24
@@ -694,7 +1237,7 @@ if __name__ == '__main__':
     class_counts = dataset.get_train_class_counts()
     print('class_counts', 'min', min(class_counts), 'max', max(class_counts))
     w = dataset.get_class_weights()
-    print('class_weights', 'min', min(w), 'max', max(w))
+    print('class_weights', 'min', w.min().item(), 'max', w.max().item())
 
     for d_idx, ex in enumerate(dataset.get_dataloader(batch_size=32)[0]):
         if d_idx % 1000 == 0:
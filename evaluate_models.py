@@ -0,0 +1,159 @@
+import argparse
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+
+import dataset
+import test
+from utils import configure_threads
+
+ABLATIONS = ['no_title', 'no_context', 'no_intention', 'no_context_title']
+
+# set before the workers start, shared with them by fork
+_test_set = None
+
+
+def core_subsets(n_workers, cores_per_worker=0):
+    """Disjoint subsets of the cores this process may run on; fewer than
+    n_workers if the cores do not go around.
+    """
+    cores = sorted(os.sched_getaffinity(0)) \
+        if hasattr(os, 'sched_getaffinity') else \
+        list(range(os.cpu_count() or 1))
+    if cores_per_worker <= 0:
+        cores_per_worker = max(1, len(cores) // n_workers)
+    if cores_per_worker > len(cores):
+        raise ValueError('%d cores per worker, but only %d cores' %
+                         (cores_per_worker, len(cores)))
+    n_workers = min(n_workers, len(cores) // cores_per_worker)
+    return [cores[i * cores_per_worker:(i + 1) * cores_per_worker]
+            for i in range(n_workers)]
+
+
+def init_worker(cores_queue, serialized_data_path):
+    global _test_set
+    configure_threads(cores=cores_queue.get())
+    if _test_set is None:  # spawned rather than forked
+        with open(serialized_data_path, 'rb') as f:
+            _test_set = pickle.load(f)
+
+
+def evaluate(model_path, batch_size, week_batches, fuse_char_cnn, seed):
+    test.set_seed_all(seed)
+    device = torch.device('cpu')
+    args = argparse.Namespace(yes_cuda=0)
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        model, conf = test.get_model(_test_set.widx2vec, model_path, device,
+                                     _test_set.idx2dur, args)
+        if fuse_char_cnn:
+            model.fuse_char_cnn()
+        start = time.time()
+        metrics = test.measure_performance(_test_set, model, conf, device,
+                                           batch_size=batch_size,
+                                           weeks=week_batches)
+        seconds = time.time() - start
+
+    metrics['model'] = os.path.basename(model_path)
+    metrics['ablation'] = ','.join(name for name in ABLATIONS
+                                   if getattr(conf, name, False)) or '-'
+    metrics['seconds'] = seconds
+    metrics['events_per_sec'] = metrics['count'] / seconds
+    metrics['threads'] = torch.get_num_threads()
+    return metrics
+
+
+def print_table(rows):
+    print('%-28s %-18s %8s %8s %8s %8s %8s %10s' %
+          ('model', 'ablation', 'recall@1', 'recall@5', 'mrr', 'ieuc',
+           '#events', 'events/s'))
+    for row in rows:
+        print('%-28s %-18s %8.4f %8.4f %8.4f %8.4f %8d %10.1f' %
+              (row['model'], row['ablation'], row['recall1'],
+               row['recall5'], row['mrr'], row['ieuc'], row['count'],
+               row['events_per_sec']))
+
+
+def main():
+    global _test_set
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--model_paths', type=str,
+                            default='./data/nesa_*.pth',
+                            help='comma-separated paths or glob patterns')
+    arg_parser.add_argument('--input_path', type=str,
+                            default='./data/sample_data.csv')
+    arg_parser.add_argument('--serialized_data_path', type=str,
+                            default='./data/preprocess_test.pkl')
+    arg_parser.add_argument('--trained_dict_path', type=str,
+                            default='./data/dataset_180522_dict.pkl')
+    arg_parser.add_argument('--example_storage_dir', type=str,
+                            default='./data/examples_eval',
+                            help='test set arrays memory-mapped by workers')
+    arg_parser.add_argument('--workers', type=int, default=2)
+    arg_parser.add_argument('--cores_per_worker', type=int, default=0,
+                            help='0 splits the available cores evenly')
+    arg_parser.add_argument('--batch_size', type=int, default=1)
+    arg_parser.add_argument('--week_batches', type=int, default=0)
+    arg_parser.add_argument('--fuse_char_cnn', type=int, default=1)
+    arg_parser.add_argument('--seed', type=int, default=3)
+    arg_parser.add_argument('--output', type=str, default=None,
+                            help='also write the rows as json')
+    args = arg_parser.parse_args()
+
+    model_paths = list()
+    for pattern in args.model_paths.split(','):
+        model_paths += sorted(glob.glob(pattern)) or [pattern]
+    assert len(model_paths) > 0, 'no checkpoints'
+
+    # preprocess once; workers read the same dataset
+    config = dataset.Config()
+    config.test_path = args.input_path
+    config.preprocess_save_path = args.serialized_data_path
+    config.example_storage_dir = args.example_storage_dir
+    _test_set = test.get_dataset(config, args.trained_dict_path)
+    assert _test_set is not None
+
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context(
+        'fork' if 'fork' in methods else None)
+    if args.week_batches == 0:
+        # flattened into the memory-mapped store once, for all workers
+        _test_set.get_split_dataset(_test_set.test_data, 'test')
+        if 'fork' not in methods:
+            with open(args.serialized_data_path, 'wb') as f:
+                pickle.dump(_test_set, f)
+
+    subsets = core_subsets(min(args.workers, len(model_paths)),
+                           args.cores_per_worker)
+    n_workers = len(subsets)
+    cores_queue = context.Queue()
+    for cores in subsets:
+        cores_queue.put(cores)
+
+    print('Evaluating %d checkpoints with %d workers..' %
+          (len(model_paths), n_workers))
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=context,
+                             initializer=init_worker,
+                             initargs=(cores_queue,
+                                       args.serialized_data_path)) as pool:
+        futures = [pool.submit(evaluate, model_path, args.batch_size,
+                               args.week_batches > 0,
+                               args.fuse_char_cnn > 0, args.seed)
+                   for model_path in model_paths]
+        rows = [future.result() for future in futures]
+
+    print_table(rows)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
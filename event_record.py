@@ -0,0 +1,153 @@
+import csv
+import numpy as np
+
+from collections import namedtuple
+from itertools import islice
+
+# The 12 event features written by get_google_calendar_events.py, in csv
+# column order. register_time and start_time are datetimes when records
+# come from the exporter and strings when read from csv; NETSDataset does
+# not use them.
+EVENT_FIELDS = ['user_id', 'title', 'duration', 'register_time',
+                'start_time', 'start_year', 'start_week', 'reg_seq',
+                'reg_st_week_dist', 'reg_st_day_dist', 'is_recurrent',
+                'start_slot']
+
+EventRecord = namedtuple('EventRecord', EVENT_FIELDS)
+
+# the columns NETSDataset reads
+DATASET_FIELDS = ['user_id', 'title', 'duration', 'start_year', 'start_week',
+                  'reg_seq', 'reg_st_week_dist', 'is_recurrent', 'start_slot']
+
+COLUMN_DTYPES = {
+    'user_id': object,
+    'title': object,
+    'duration': np.int64,
+    'register_time': object,
+    'start_time': object,
+    'start_year': np.int64,
+    'start_week': np.int64,
+    'reg_seq': np.int64,
+    'reg_st_week_dist': np.int64,
+    'reg_st_day_dist': np.int64,
+    'is_recurrent': bool,
+    'start_slot': np.int64,
+}
+
+
+def from_csv_row(features):
+    assert len(features) == len(EVENT_FIELDS)
+    return EventRecord(
+        user_id=features[0],
+        title=features[1],
+        duration=int(features[2]),
+        register_time=features[3],
+        start_time=features[4],
+        start_year=int(features[5]),
+        start_week=int(features[6]),
+        reg_seq=int(features[7]),
+        reg_st_week_dist=int(features[8]),
+        reg_st_day_dist=int(features[9]),
+        # anything but 'False' was treated as recurrent
+        is_recurrent=features[10] != 'False',
+        start_slot=int(features[11]))
+
+
+def read_csv(path):
+    # yields EventRecords from a 12-column events csv
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        for features in csv.reader(f, quotechar='"'):
+            yield from_csv_row(features)
+
+
+def write_csv(path, records):
+    # records may also be plain 12-feature lists
+    with open(path, 'w', newline='', encoding='utf-8') as csv_file:
+        event_writer = csv.writer(csv_file, quotechar='"')
+        for record in records:
+            event_writer.writerow(record)
+
+
+def iter_records(source):
+    # a csv path or an iterable of EventRecords / 12-feature lists
+    if isinstance(source, str):
+        return read_csv(source)
+    return (r if isinstance(r, EventRecord) else EventRecord._make(r)
+            for r in source)
+
+
+def describe_source(source):
+    return source if isinstance(source, str) else '<records>'
+
+
+def to_columns(records, fields=EVENT_FIELDS):
+    # records -> {field: np.ndarray}
+    records = list(iter_records(records))
+    columns = dict()
+    for field in fields:
+        field_idx = EVENT_FIELDS.index(field)
+        columns[field] = np.array([r[field_idx] for r in records],
+                                  dtype=COLUMN_DTYPES[field])
+    return columns
+
+
+def from_arrow(table, fields):
+    # pyarrow Table or RecordBatch -> {field: np.ndarray}
+    return {field: np.asarray(
+                table.column(field).to_numpy(zero_copy_only=False),
+                dtype=COLUMN_DTYPES[field])
+            for field in fields}
+
+
+def iter_column_batches(source, fields=EVENT_FIELDS, batch_size=65536):
+    """Yields {field: np.ndarray} batches of at most batch_size rows.
+
+    source is a csv, .npz or .parquet path, a pyarrow Table, a dict of
+    columns or an iterable of records. Columnar sources load only `fields`.
+    """
+    if isinstance(source, str) and source.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('pyarrow is required to read %s' % source)
+        parquet_file = pq.ParquetFile(source)
+        for batch in parquet_file.iter_batches(batch_size=batch_size,
+                                               columns=fields):
+            yield from_arrow(batch, fields)
+        return
+
+    if isinstance(source, str) and source.endswith('.npz'):
+        with np.load(source) as npz:
+            source = {field: npz[field] for field in fields}
+    elif hasattr(source, 'column_names'):
+        source = from_arrow(source, fields)
+
+    if isinstance(source, dict):
+        num_rows = len(source[fields[0]])
+        for start in range(0, num_rows, batch_size):
+            yield {field: np.asarray(source[field][start:start + batch_size],
+                                     dtype=COLUMN_DTYPES[field])
+                   for field in fields}
+        return
+
+    records = iter_records(source)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield to_columns(batch, fields)
+
+
+def write_columns(path, records, fields=EVENT_FIELDS):
+    # columnar sink: .parquet (needs pyarrow) or .npz
+    columns = to_columns(records, fields)
+    if path.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        pq.write_table(pa.table({field: columns[field].tolist()
+                                 for field in fields}), path)
+    else:
+        # strings are stored as unicode arrays, so no pickling on load
+        np.savez(path, **{field: columns[field].astype(str)
+                          if columns[field].dtype == object
+                          else columns[field] for field in fields})
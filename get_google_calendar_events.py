@@ -1,8 +1,9 @@
 import argparse
-import csv
 from dateutil.parser import parse
 import httplib2
+import numpy as np
 import os
+import re
 import string
 import sys
 
@@ -11,9 +12,11 @@ from oauth2client import client
 from oauth2client import tools
 from oauth2client.file import Storage
 
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta, timezone
 from operator import itemgetter
 
+from event_record import EventRecord, write_csv
+
 # Based on https://developers.google.com/google-apps/calendar/quickstart/python
 CLIENT_SECRET_FILE = 'client_secret.json'  # Use your secret file
 calendarId = 'primary'  # Use calendar 'ID' unless primary
@@ -23,20 +26,38 @@ print_valid_events = False
 allow_non_eng_users = True
 allow_inactive_users = True
 
-if not os.path.exists(
-        os.path.join(
-            os.path.join(os.path.expanduser('~'), '.credentials'),
-            'calendar-python-quickstart.json')) \
-        and not os.path.exists(CLIENT_SECRET_FILE):
-    print(
-        'Not found client_secret.json and credentials. See '
-        'https://developers.google.com/google-apps/calendar/quickstart/python')
-    sys.exit(1)
-
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-
-flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
+# fixed-format RFC3339 timestamps as returned by the Calendar API
+RFC3339_PATTERN = re.compile(
+    r'(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)\Z')
+US_PER_MINUTE = 60 * 10 ** 6
+US_PER_DAY = 24 * 60 * US_PER_MINUTE
+UTC = timezone.utc
+
+# one pattern for all rules of the original filter_title
+INVALID_TITLE_PATTERN = re.compile(
+    r'\s*\Z'
+    r'|NULL\Z|\(No title\)\Z|New Event\Z'
+    r'|✔ '
+    r'|(?i:cancell?ed)'
+    r'|Call From |Call To |Missed Call From '
+    r'|Flight to |Stay at '
+    r'|I entered http://|I exited http://')
+
+
+def check_credentials():
+    if not os.path.exists(
+            os.path.join(
+                os.path.join(os.path.expanduser('~'), '.credentials'),
+                'calendar-python-quickstart.json')) \
+            and not os.path.exists(CLIENT_SECRET_FILE):
+        print(
+            'Not found client_secret.json and credentials. See '
+            'https://developers.google.com/google-apps/calendar/quickstart/'
+            'python')
+        sys.exit(1)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
 
 # If modifying these scopes, delete your previously saved credentials
@@ -45,7 +66,7 @@ SCOPES = 'https://www.googleapis.com/auth/calendar.readonly'
 APPLICATION_NAME = 'Google Calendar Events Fetching & Preprocessing'
 
 
-def get_credentials():
+def get_credentials(flags=None):
     """Gets valid user credentials from storage.
 
     If nothing has been stored, or if the stored credentials are invalid,
@@ -75,22 +96,7 @@ def get_credentials():
 
 
 def filter_title(title):
-    title_lc = title.lower()
-    return title is None \
-        or '' == title.strip() \
-           or 'NULL' == title \
-           or '(No title)' == title \
-           or 'New Event' == title \
-           or title.startswith('✔ ') \
-           or title_lc.startswith('cancelled') \
-           or title_lc.startswith('canceled') \
-           or title.startswith('Call From ') \
-           or title.startswith('Call To ') \
-           or title.startswith('Missed Call From ') \
-           or title.startswith('Flight to ') \
-           or title.startswith('Stay at ') \
-           or title.startswith('I entered http://') \
-           or title.startswith('I exited http://')
+    return title is None or INVALID_TITLE_PATTERN.match(title) is not None
 
 
 def is_valid_duration(duration):
@@ -120,6 +126,14 @@ def get_week_distance(dt1, dt2):
     return (monday2 - monday1).days // 7
 
 
+def count_non_printable(title):
+    _non_printable_count = 0
+    for c in title:
+        if c not in string.printable:
+            _non_printable_count += 1
+    return _non_printable_count
+
+
 def filter_user(events, title_idx, valid_week_evt_cnt_dict,
                 min_num_events=100, active_avg_num_week_events=1.75,
                 max_allow_non_eng_rate=0.02):
@@ -129,15 +143,26 @@ def filter_user(events, title_idx, valid_week_evt_cnt_dict,
         for evt in _events:
             title = evt[_title_idx]
             _num_title_chars += len(title)
-            for c in title:
-                if c not in string.printable:
-                    _non_printable_count += 1
+            _non_printable_count += count_non_printable(title)
         return _non_printable_count, _num_title_chars
 
+    non_printable_count = num_title_chars = None
     if not allow_non_eng_users:
-        # non english rate > 0.02
         non_printable_count, num_title_chars = \
             get_non_eng_rate(events, title_idx)
+    return filter_user_counts(len(events), valid_week_evt_cnt_dict,
+                              non_printable_count, num_title_chars,
+                              min_num_events, active_avg_num_week_events,
+                              max_allow_non_eng_rate)
+
+
+def filter_user_counts(num_valid_events, valid_week_evt_cnt_dict,
+                       non_printable_count=None, num_title_chars=None,
+                       min_num_events=100, active_avg_num_week_events=1.75,
+                       max_allow_non_eng_rate=0.02):
+    # same as filter_user, from counts gathered while streaming events
+    if not allow_non_eng_users:
+        # non english rate > 0.02
         non_eng_rate = non_printable_count / num_title_chars
         if non_eng_rate > max_allow_non_eng_rate:
             print('Please run for English users: non_eng_rate=%.2f'
@@ -145,14 +170,14 @@ def filter_user(events, title_idx, valid_week_evt_cnt_dict,
             return True
 
     # event num < 100 -> inactive or very new
-    if len(events) < min_num_events:
+    if num_valid_events < min_num_events:
         print('Please run for more active users: #events=%d'
-              % len(events), '<', min_num_events)
+              % num_valid_events, '<', min_num_events)
         return True
 
     if not allow_inactive_users:
         # average week event num < 1.75 -> inactive
-        avg_num_week_events = len(events) / len(valid_week_evt_cnt_dict)
+        avg_num_week_events = num_valid_events / len(valid_week_evt_cnt_dict)
         if avg_num_week_events < active_avg_num_week_events:
             print('Please run for more active users: avg_num_week_events=%.2f'
                   % avg_num_week_events, '<', active_avg_num_week_events)
@@ -168,23 +193,7 @@ def delete_invalid_chars_4_filename(file_name, invalid_chars):
     return valid_file_name
 
 
-def write_csv(_output_csv_path, events):
-    with open(_output_csv_path, 'w', newline='', encoding='utf-8') as csv_file:
-        event_writer = csv.writer(csv_file, quotechar='"')
-        for evt_features in events:
-            event_writer.writerow(evt_features)
-
-
-def main():
-    """Shows basic usage of the Google Calendar API.
-
-    Creates a Google Calendar API service object and outputs a list of the next
-    10 events on the user's calendar.
-    """
-    credentials = get_credentials()
-    http = credentials.authorize(httplib2.Http())
-    service = discovery.build('calendar', 'v3', http=http)
-
+def get_primary_calendar_id(service):
     primary_calendar_id = None
     page_token = None
     while True:
@@ -197,12 +206,14 @@ def main():
         page_token = calendar_list.get('nextPageToken')
         if not page_token:
             break
+    return primary_calendar_id
 
-    print('Getting calendar events of', primary_calendar_id)
+
+def fetch_events(service, calendar_id):
     # from datetime import datetime
     # now = datetime.utcnow().isoformat() + 'Z'  # UTC
     request = service.events().list(
-        calendarId=calendarId,
+        calendarId=calendar_id,
         # timeMin=now,
         # maxResults=10,
         singleEvents=True,
@@ -210,10 +221,6 @@ def main():
 
     num_events = 0
     events_total = list()
-    valid_events = list()
-    week_sequence_dict = dict()
-    filtered_events_num = dict()
-    valid_week_evt_cnt_dict = dict()
 
     while request is not None:
         response = request.execute()
@@ -228,14 +235,209 @@ def main():
 
         request = service.events().list_next(request, response)
 
-    # sort by register time
-    reg_sorted_events = list()
-    for event in events_total:
-        event['created_dt'] = parse(event['created'])
-        reg_sorted_events.append(event)
-    reg_sorted_events = sorted(reg_sorted_events, key=itemgetter('created_dt'))
-
-    for event in reg_sorted_events:
+    return events_total
+
+
+def get_tz(offset_minutes):
+    if offset_minutes == 0:
+        return UTC
+    return timezone(timedelta(minutes=offset_minutes))
+
+
+def split_rfc3339(value):
+    # (local 'YYYY-MM-DDTHH:MM:SS', microsecond, utc offset in minutes),
+    # or None if value is not in the fixed format
+    m = RFC3339_PATTERN.match(value)
+    if m is None:
+        return None
+    base, frac, tz = m.groups()
+    if not '0001' <= base[:4] <= '9999':
+        return None
+    microsecond = int(frac[1:7].ljust(6, '0')) if frac else 0
+    offset = 0
+    if tz != 'Z':
+        offset = int(tz[1:3]) * 60 + int(tz[4:6])
+        if tz[0] == '-':
+            offset = -offset
+    return base, microsecond, offset
+
+
+def parse_datetime(value):
+    # fixed-format fast path, dateutil for anything else
+    fields = split_rfc3339(value)
+    if fields is None:
+        return parse(value)
+    base, microsecond, offset = fields
+    try:
+        return datetime(int(base[0:4]), int(base[5:7]), int(base[8:10]),
+                        int(base[11:13]), int(base[14:16]), int(base[17:19]),
+                        microsecond, get_tz(offset))
+    except ValueError:
+        return parse(value)
+
+
+def parse_rfc3339_array(values):
+    """Parses timestamps in bulk.
+
+    Returns (local time in microseconds since epoch, utc offset in minutes,
+    ok) arrays. Values that are not in the fixed format have ok=False.
+    """
+    n = len(values)
+    bases = list()
+    microseconds = np.zeros(n, dtype=np.int64)
+    offsets = np.zeros(n, dtype=np.int64)
+    ok = np.ones(n, dtype=bool)
+    for i, value in enumerate(values):
+        fields = split_rfc3339(value)
+        if fields is None:
+            ok[i] = False
+            bases.append('1970-01-01T00:00:00')
+            continue
+        bases.append(fields[0])
+        microseconds[i] = fields[1]
+        offsets[i] = fields[2]
+
+    try:
+        seconds = np.array(bases, dtype='datetime64[s]')
+    except ValueError:
+        # out of range fields, e.g. 2017-02-30; check one by one
+        seconds = np.zeros(n, dtype='datetime64[s]')
+        for i, base in enumerate(bases):
+            try:
+                seconds[i] = np.datetime64(base, 's')
+            except ValueError:
+                ok[i] = False
+    local_us = seconds.astype(np.int64) * 10 ** 6 + microseconds
+    return local_us, offsets, ok
+
+
+def get_start_week(event):
+    # (start_iso_year, start_iso_week) of a timed event, None if all-day
+    start = event.get('start', {}).get('dateTime')
+    if start is None:
+        return None
+    start_dt = parse_datetime(start)
+    return date(start_dt.year, start_dt.month, start_dt.day).isocalendar()[:2]
+
+
+# MUST modify if you update orders of event features
+title_idx = 1
+start_year_idx = 5
+start_week_idx = 6
+reg_seq_idx = 7
+
+
+def get_event_features(event, user_id, filtered_events_num):
+    """Derives the 12 event features of a single event.
+
+    Returns None if the event is filtered out. week_register_sequence is
+    left as None; it is assigned once the events of a week are sorted by
+    register time (see extract_features).
+    """
+    # filtering: invalid titles
+    if event.get('summary') is None:
+        dict_count(filtered_events_num, 'no title')
+        return None
+    elif filter_title(event['summary']):
+        dict_count(filtered_events_num, 'invalid title')
+        return None
+
+    # filtering: skip all-day events
+    if event['start'].get('dateTime') is None:
+        dict_count(filtered_events_num, 'all-day')
+        return None
+
+    # filtering: year 0 is out of range
+    created = event['created']
+    if '0000' == created[:4] or '1900' == created[:4]:
+        dict_count(filtered_events_num, 'year 0 or 1900')
+        return None
+
+    register_dt = parse_datetime(created)
+
+    start = event['start'].get('dateTime', event['start'].get('date'))
+    start_dt = parse_datetime(start)
+
+    # filtering: a past
+    if start_dt.toordinal() < register_dt.toordinal():
+        dict_count(filtered_events_num, 'past')
+        return None
+
+    end = event['end'].get('dateTime', event['end'].get('date'))
+    end_dt = parse_datetime(end)
+
+    # filtering: phone call or too long duration
+    duration = end_dt - start_dt
+    if not is_valid_duration(duration):
+        dict_count(filtered_events_num, 'invalid duration')
+        return None
+
+    start_iso_year, start_iso_week_num, _ = \
+        date(start_dt.year, start_dt.month, start_dt.day).isocalendar()
+
+    register_start_week_distance = get_week_distance(
+        register_dt, start_dt)
+    day_distance = \
+        date(start_dt.year, start_dt.month, start_dt.day) - \
+        date(register_dt.year, register_dt.month, register_dt.day)
+
+    recurring_event_id = event.get('recurringEventId')
+    is_recurrent = recurring_event_id is not None
+
+    # y
+    start_time_slot = \
+        start_dt.minute // MINUTE_NORM \
+        + start_dt.hour * int(60 / MINUTE_NORM) \
+        + start_dt.weekday() * int((60 * 24) / MINUTE_NORM)
+
+    # If you change the order of event features,
+    # check itemgetter parameters below.
+    evt_features = list()
+    evt_features.append(user_id)  # originally, user id
+    # evt_features.append(event['iCalUID'])
+
+    # title, duration, register time, start time
+    evt_features.append(event['summary'])
+    evt_features.append(duration.seconds // 60)  # minute
+    evt_features.append(register_dt)
+    evt_features.append(start_dt)
+
+    # sort by year, week, register sequence in a week
+    evt_features.append(start_iso_year)
+    evt_features.append(start_iso_week_num)
+    evt_features.append(None)  # week_register_sequence
+
+    # distance between register and start
+    evt_features.append(register_start_week_distance)
+    evt_features.append(day_distance.days)
+
+    # is recurrent?
+    evt_features.append(is_recurrent)
+
+    # y
+    evt_features.append(start_time_slot)
+
+    return evt_features
+
+
+def get_register_key(register_dt):
+    # register time in utc microseconds, the order of aware datetimes
+    if register_dt.tzinfo is None:
+        register_dt = register_dt.replace(tzinfo=UTC)
+    return (register_dt - datetime(1970, 1, 1, tzinfo=UTC)) \
+        // timedelta(microseconds=1)
+
+
+def featurize_events(events, user_id, filtered_events_num):
+    """Vectorized get_event_features over a list of events.
+
+    Timestamps in the fixed RFC3339 format are parsed in bulk and all
+    derived features are computed with numpy; other events go through
+    get_event_features. Returns (evt_features list, register time keys)
+    of the valid events in input order.
+    """
+    candidates = list()
+    for event in events:
         # filtering: invalid titles
         if event.get('summary') is None:
             dict_count(filtered_events_num, 'no title')
@@ -255,117 +457,236 @@ def main():
             dict_count(filtered_events_num, 'year 0 or 1900')
             continue
 
-        register_dt = parse(created)
+        candidates.append(event)
+
+    n = len(candidates)
+    if n == 0:
+        return list(), list()
+
+    reg_local, reg_offset, reg_ok = parse_rfc3339_array(
+        [event['created'] for event in candidates])
+    st_local, st_offset, st_ok = parse_rfc3339_array(
+        [event['start']['dateTime'] for event in candidates])
+    end_local, end_offset, end_ok = parse_rfc3339_array(
+        [event['end'].get('dateTime', event['end'].get('date'))
+         for event in candidates])
+    fast = reg_ok & st_ok & end_ok
+
+    reg_utc = reg_local - reg_offset * US_PER_MINUTE
+    st_utc = st_local - st_offset * US_PER_MINUTE
+    end_utc = end_local - end_offset * US_PER_MINUTE
+    reg_day = reg_local // US_PER_DAY
+    st_day = st_local // US_PER_DAY
+
+    # filtering: a past
+    past = fast & (st_day < reg_day)
+
+    # filtering: phone call or too long duration
+    # (same as is_valid_duration on timedelta days and seconds)
+    duration = end_utc - st_utc
+    duration_days = duration // US_PER_DAY
+    duration_seconds = (duration - duration_days * US_PER_DAY) // 10 ** 6
+    invalid_duration = fast & ~past & (
+        (duration_seconds % 60 > 0)
+        | (duration_days > 0) | (duration_seconds > 3600 * 12)
+        | (duration_seconds // 60 <= 0) | (duration_days < 0))
+
+    if past.any():
+        filtered_events_num['past'] = \
+            filtered_events_num.get('past', 0) + int(past.sum())
+    if invalid_duration.any():
+        filtered_events_num['invalid duration'] = \
+            filtered_events_num.get('invalid duration', 0) + \
+            int(invalid_duration.sum())
+    valid = fast & ~past & ~invalid_duration
+
+    # 1970-01-01 is a thursday; monday is 0
+    st_weekday = (st_day + 3) % 7
+    reg_weekday = (reg_day + 3) % 7
+
+    # iso year and week from the thursday of the same week
+    thursday = st_day - st_weekday + 3
+    start_iso_year = thursday.astype('datetime64[D]') \
+        .astype('datetime64[Y]').astype(np.int64) + 1970
+    jan1 = (start_iso_year - 1970).astype('datetime64[Y]') \
+        .astype('datetime64[D]').astype(np.int64)
+    start_iso_week_num = (thursday - jan1) // 7 + 1
+
+    # get_week_distance: mondays keep their microseconds and are compared
+    # as aware datetimes, i.e. in utc
+    reg_monday = reg_local - (reg_local % US_PER_DAY) \
+        + (reg_local % 10 ** 6) - reg_weekday * US_PER_DAY \
+        - reg_offset * US_PER_MINUTE
+    st_monday = st_local - (st_local % US_PER_DAY) \
+        + (st_local % 10 ** 6) - st_weekday * US_PER_DAY \
+        - st_offset * US_PER_MINUTE
+    register_start_week_distance = \
+        ((st_monday - reg_monday) // US_PER_DAY) // 7
+    day_distance = st_day - reg_day
+
+    # y
+    start_time_slot = (st_local % US_PER_DAY) // (MINUTE_NORM *
+                                                  US_PER_MINUTE) \
+        + st_weekday * ((60 * 24) // MINUTE_NORM)
+
+    valid_idxes = np.flatnonzero(valid)
+    register_dts = reg_local[valid_idxes].astype('datetime64[us]') \
+        .astype(object)
+    start_dts = st_local[valid_idxes].astype('datetime64[us]') \
+        .astype(object)
+    columns = zip(valid_idxes.tolist(),
+                  register_dts, reg_offset[valid_idxes].tolist(),
+                  start_dts, st_offset[valid_idxes].tolist(),
+                  (duration_seconds[valid_idxes] // 60).tolist(),
+                  start_iso_year[valid_idxes].tolist(),
+                  start_iso_week_num[valid_idxes].tolist(),
+                  register_start_week_distance[valid_idxes].tolist(),
+                  day_distance[valid_idxes].tolist(),
+                  start_time_slot[valid_idxes].tolist(),
+                  reg_utc[valid_idxes].tolist())
+
+    rows = [None] * n
+    keys = [None] * n
+    for (idx, register_dt, reg_off, start_dt, st_off, duration_minute,
+         iso_year, iso_week, week_dist, day_dist, slot, key) in columns:
+        event = candidates[idx]
+        # same column order as get_event_features
+        rows[idx] = [user_id,
+                     event['summary'],
+                     duration_minute,
+                     register_dt.replace(tzinfo=get_tz(reg_off)),
+                     start_dt.replace(tzinfo=get_tz(st_off)),
+                     iso_year,
+                     iso_week,
+                     None,  # week_register_sequence
+                     week_dist,
+                     day_dist,
+                     event.get('recurringEventId') is not None,
+                     slot]
+        keys[idx] = key
+
+    # events in other formats
+    for idx in np.flatnonzero(~fast).tolist():
+        evt_features = get_event_features(candidates[idx], user_id,
+                                          filtered_events_num)
+        if evt_features is not None:
+            rows[idx] = evt_features
+            keys[idx] = get_register_key(evt_features[3])
+
+    return [r for r in rows if r is not None], \
+        [k for k in keys if k is not None]
+
+
+def extract_features(events, user_id, filtered_events_num=None,
+                     valid_week_evt_cnt_dict=None):
+    """Filters events and derives the 12 event features.
+
+    Features of an event depend only on the events starting in the same
+    week, so any set of whole weeks can be processed independently.
+    """
+    if filtered_events_num is None:
+        filtered_events_num = dict()
+    if valid_week_evt_cnt_dict is None:
+        valid_week_evt_cnt_dict = dict()
+
+    rows, keys = featurize_events(events, user_id, filtered_events_num)
+    if len(rows) == 0:
+        return list()
+
+    # sort by register time (stable, as sorting by parsed 'created')
+    order = np.argsort(np.array(keys, dtype=np.int64), kind='stable')
+    yw = np.array([rows[idx][start_year_idx] * 100 +
+                   rows[idx][start_week_idx] for idx in order.tolist()],
+                  dtype=np.int64)
+
+    # week_register_sequence: rank in register order within each week
+    week_order = np.argsort(yw, kind='stable')
+    sorted_yw = yw[week_order]
+    positions = np.arange(len(yw))
+    is_first = np.ones(len(yw), dtype=bool)
+    is_first[1:] = sorted_yw[1:] != sorted_yw[:-1]
+    week_start = np.maximum.accumulate(np.where(is_first, positions, 0))
+    sequences = np.empty(len(yw), dtype=np.int64)
+    sequences[week_order] = positions - week_start
+
+    for week, cnt in zip(*np.unique(yw, return_counts=True)):
+        valid_week_evt_cnt_dict[int(week)] = \
+            valid_week_evt_cnt_dict.get(int(week), 0) + int(cnt)
+
+    valid_events = list()
+    for idx, week_register_sequence in zip(order.tolist(),
+                                           sequences.tolist()):
+        evt_features = rows[idx]
+        evt_features[reg_seq_idx] = week_register_sequence
+        valid_events.append(evt_features)
+
+        if print_valid_events:
+            print(evt_features)
 
-        start = event['start'].get('dateTime', event['start'].get('date'))
-        start_dt = parse(start)
+    return valid_events
 
-        # filtering: a past
-        if start_dt.toordinal() < register_dt.toordinal():
-            dict_count(filtered_events_num, 'past')
-            continue
 
-        end = event['end'].get('dateTime', event['end'].get('date'))
-        end_dt = parse(end)
+def sort_events(valid_events):
+    # sort by year, week, and register_sequence
+    return sorted(valid_events, key=itemgetter(start_year_idx,
+                                               start_week_idx,
+                                               reg_seq_idx))
 
-        # filtering: phone call or too long duration
-        duration = end_dt - start_dt
-        if not is_valid_duration(duration):
-            dict_count(filtered_events_num, 'invalid duration')
-            continue
 
-        start_iso_year, start_iso_week_num, _ = \
-            date(start_dt.year, start_dt.month, start_dt.day).isocalendar()
-
-        yw = start_iso_year * 100 + start_iso_week_num
-        if yw in valid_week_evt_cnt_dict:
-            valid_week_evt_cnt_dict[yw] += 1
-        else:
-            valid_week_evt_cnt_dict[yw] = 1
-
-        week_register_sequence = week_sequence_dict.get(
-            (start_iso_year, start_iso_week_num))
-        if week_register_sequence is None:
-            week_register_sequence = 0  # start with 0
-        else:
-            week_register_sequence += 1
-        week_sequence_dict[(start_iso_year, start_iso_week_num)] = \
-            week_register_sequence
-
-        register_start_week_distance = get_week_distance(
-            register_dt, start_dt)
-        day_distance = \
-            date(start_dt.year, start_dt.month, start_dt.day) - \
-            date(register_dt.year, register_dt.month, register_dt.day)
-
-        recurring_event_id = event.get('recurringEventId')
-        is_recurrent = recurring_event_id is not None
-
-        # y
-        start_time_slot = \
-            start_dt.minute // MINUTE_NORM \
-            + start_dt.hour * int(60 / MINUTE_NORM) \
-            + start_dt.weekday() * int((60 * 24) / MINUTE_NORM)
-
-        # If you change the order of event features,
-        # check itemgetter parameters below.
-        evt_features = list()
-        evt_features.append(primary_calendar_id)  # originally, user id
-        # evt_features.append(event['iCalUID'])
-
-        # title, duration, register time, start time
-        evt_features.append(event['summary'])
-        evt_features.append(duration.seconds // 60)  # minute
-        evt_features.append(register_dt)
-        evt_features.append(start_dt)
-
-        # sort by year, week, register sequence in a week
-        evt_features.append(start_iso_year)
-        evt_features.append(start_iso_week_num)
-        evt_features.append(week_register_sequence)
-
-        # distance between register and start
-        evt_features.append(register_start_week_distance)
-        evt_features.append(day_distance.days)
-
-        # is recurrent?
-        evt_features.append(is_recurrent)
-
-        # y
-        evt_features.append(start_time_slot)
+def to_records(valid_events):
+    # EventRecords in csv row order, e.g. for NETSDataset(test_records=...)
+    return [EventRecord._make(evt_features)
+            for evt_features in sort_events(valid_events)]
 
-        valid_events.append(evt_features)
 
-        if print_valid_events:
-            print(evt_features)
+def get_output_path(calendar_id, suffix='_events.csv', directory=None):
+    # Unix, Windows
+    invalid_chars = ['\0', '\\', '/', '*', '?', '"', '<', '>', '|']
+    valid_file_name = delete_invalid_chars_4_filename(calendar_id,
+                                                      invalid_chars)
+    if directory is None:
+        directory = output_dir
+    return directory + '/' + valid_file_name + suffix
+
+
+def main(flags=None):
+    """Shows basic usage of the Google Calendar API.
+
+    Creates a Google Calendar API service object and outputs a list of the next
+    10 events on the user's calendar.
+    """
+    check_credentials()
+    credentials = get_credentials(flags)
+    http = credentials.authorize(httplib2.Http())
+    service = discovery.build('calendar', 'v3', http=http)
+
+    primary_calendar_id = get_primary_calendar_id(service)
+
+    print('Getting calendar events of', primary_calendar_id)
+    events_total = fetch_events(service, calendarId)
+    num_events = len(events_total)
+
+    filtered_events_num = dict()
+    valid_week_evt_cnt_dict = dict()
+    valid_events = extract_features(events_total, primary_calendar_id,
+                                    filtered_events_num,
+                                    valid_week_evt_cnt_dict)
 
     print('\n#events', num_events)
     print('#valid_events', len(valid_events))
     for fek in filtered_events_num:
         print('#filtered_events (%s)' % fek, filtered_events_num.get(fek))
 
-    # MUST modify if you update orders of event features
-    title_idx = 1
-    start_year_idx = 5
-    start_week_idx = 6
-    reg_seq_idx = 7
     if filter_user(valid_events, title_idx, valid_week_evt_cnt_dict):
         return
 
     # write events to .csv
-    # Unix, Windows
-    invalid_chars = ['\0', '\\', '/', '*', '?', '"', '<', '>', '|']
-    valid_file_name = delete_invalid_chars_4_filename(primary_calendar_id,
-                                                      invalid_chars)
-    output_file = output_dir + '/' + valid_file_name + '_events.csv'
-
-    # sort by year, week, and register_sequence
-    write_csv(
-        output_file, sorted(valid_events, key=itemgetter(start_year_idx,
-                                                         start_week_idx,
-                                                         reg_seq_idx)))
+    records = to_records(valid_events)
+    output_file = get_output_path(primary_calendar_id)
+    write_csv(output_file, records)
     print('Saved', output_file)
+    return records
 
 
 if __name__ == '__main__':
-    main()
+    main(argparse.ArgumentParser(parents=[tools.argparser]).parse_args())
@@ -7,9 +7,134 @@ import numpy as np
 import math
 import os
 from tensorboardX import SummaryWriter
+from checkpoint import CheckpointManager, atomic_save, \
+    get_training_state, restore_training_state, set_scheduler_state
 from utils import Profile
 
 
+class FusedCharCNN(nn.Module):
+    """All tc_conv filter widths as one Conv1d.
+
+    Narrower filters are zero-padded on the right to the widest one, the
+    input is padded so every filter sees all of its original positions,
+    and positions a filter did not have in the separate convolutions are
+    masked before max-over-width. BatchNorm runs once over all channels,
+    or is folded into the conv weights (inference only).
+    """
+
+    def __init__(self, in_channels, out_channels, widths, fold_bn=False):
+        super(FusedCharCNN, self).__init__()
+        self.widths = list(widths)
+        self.min_width = min(self.widths)
+        self.max_width = max(self.widths)
+        self.out_channels = sum(out_channels)
+        self.conv = nn.Conv1d(in_channels, self.out_channels, self.max_width)
+        self.bn = None if fold_bn else nn.BatchNorm1d(self.out_channels)
+        self.register_buffer('channel_widths', torch.LongTensor(
+            [w for fn, w in zip(out_channels, self.widths)
+             for _ in range(fn)]))
+
+    @classmethod
+    def from_convs(cls, convs, bns, fold_bn=False):
+        # convs: Conv2d of height 1, each followed by its BatchNorm2d
+        assert all(conv.kernel_size[0] == 1 for conv in convs)
+        fused = cls(convs[0].in_channels,
+                    [conv.out_channels for conv in convs],
+                    [conv.kernel_size[1] for conv in convs],
+                    fold_bn=fold_bn)
+        fused.to(convs[0].weight.device)
+        with torch.no_grad():
+            weight = fused.conv.weight.data
+            weight.zero_()
+            c_start = 0
+            for conv, bn in zip(convs, bns):
+                c_end = c_start + conv.out_channels
+                w = conv.weight.data[:, :, 0, :]
+                b = conv.bias.data
+                if fold_bn:
+                    scale = bn.weight.data / torch.sqrt(bn.running_var +
+                                                        bn.eps)
+                    w = w * scale.view(-1, 1, 1)
+                    b = (b - bn.running_mean) * scale + bn.bias.data
+                else:
+                    fused.bn.weight.data[c_start:c_end] = bn.weight.data
+                    fused.bn.bias.data[c_start:c_end] = bn.bias.data
+                    fused.bn.running_mean[c_start:c_end] = bn.running_mean
+                    fused.bn.running_var[c_start:c_end] = bn.running_var
+                    fused.bn.eps = bn.eps
+                weight[c_start:c_end, :, :w.size(2)] = w
+                fused.conv.bias.data[c_start:c_end] = b
+                c_start = c_end
+        return fused
+
+    def forward(self, x):
+        # (N, max_wordlen, char_embed_dim) -> (N, sum(tc_conv_fn))
+        x = F.pad(x.transpose(1, 2), (0, self.max_width - self.min_width))
+        out = self.conv(x)
+        if self.bn is not None:
+            out = self.bn(out)
+        out = torch.tanh(out)
+
+        # position p of a width-w filter exists iff p <= wordlen - w
+        wordlen = x.size(2) - (self.max_width - self.min_width)
+        positions = torch.arange(out.size(2), device=out.device)
+        invalid = positions.view(1, -1) > \
+            (wordlen - self.channel_widths).view(-1, 1)
+        out = out.masked_fill(invalid.unsqueeze(0), float('-inf'))
+        return torch.max(out, 2)[0]
+
+
+def fuse_convs(convs, bn=None):
+    """One Conv2d computing torch.cat([conv(x) for conv in convs], 1).
+
+    Kernels are zero-padded, centered, to the largest one, which keeps
+    outputs aligned since every conv pads by (kernel - 1) / 2. A
+    BatchNorm2d applied to the concatenation is folded in (eval only).
+    """
+    kernel_size = (max(conv.kernel_size[0] for conv in convs),
+                   max(conv.kernel_size[1] for conv in convs))
+    for conv in convs:
+        assert conv.stride == (1, 1)
+        assert 2 * conv.padding[0] == conv.kernel_size[0] - 1
+        assert 2 * conv.padding[1] == conv.kernel_size[1] - 1
+    fused = nn.Conv2d(convs[0].in_channels,
+                      sum(conv.out_channels for conv in convs),
+                      kernel_size,
+                      padding=((kernel_size[0] - 1) // 2,
+                               (kernel_size[1] - 1) // 2))
+    fused.to(convs[0].weight.device)
+    with torch.no_grad():
+        weight = fused.weight.data
+        weight.zero_()
+        c_start = 0
+        for conv in convs:
+            c_end = c_start + conv.out_channels
+            top = (kernel_size[0] - conv.kernel_size[0]) // 2
+            left = (kernel_size[1] - conv.kernel_size[1]) // 2
+            weight[c_start:c_end, :,
+                   top:top + conv.kernel_size[0],
+                   left:left + conv.kernel_size[1]] = conv.weight.data
+            fused.bias.data[c_start:c_end] = conv.bias.data
+            c_start = c_end
+        if bn is not None:
+            scale = bn.weight.data / torch.sqrt(bn.running_var + bn.eps)
+            weight.mul_(scale.view(-1, 1, 1, 1))
+            fused.bias.data = \
+                (fused.bias.data - bn.running_mean) * scale + bn.bias.data
+    return fused
+
+
+def fuse_linears(linears):
+    # one Linear whose output is the concatenation of the linears' outputs
+    fused = nn.Linear(linears[0].in_features,
+                      sum(linear.out_features for linear in linears))
+    fused.to(linears[0].weight.device)
+    with torch.no_grad():
+        fused.weight.data = torch.cat([l.weight.data for l in linears], 0)
+        fused.bias.data = torch.cat([l.bias.data for l in linears], 0)
+    return fused
+
+
 class NESA(nn.Module):
     def __init__(self, config, widx2vec, idx2dur=None, class_weight=None,
                  idx=None):
@@ -88,6 +213,29 @@ class NESA(nn.Module):
             [nn.BatchNorm2d(num_tc_conv_f)
              for num_tc_conv_f in config.tc_conv_fn])
         self.tc_conv_min_dim = len(config.tc_conv_fn) + 1
+        self.tc_fused = None  # see fuse_char_cnn
+        self.temperature = 1.  # set from the checkpoint, see calibrate.py
+        # see set_user_prior
+        self.user_prior = None
+        self.user_log_prior = None
+        self.prior_weight = 0.
+
+        # see empty_context
+        self.empty_context_cache = dict()
+        self.empty_context_key = None
+
+        # see get_context_base
+        self.context_base = None
+        self.context_base_key = None
+
+        # see save_training_state, created on first use
+        self.checkpoints = None
+
+        # set by optimize_for_inference
+        self.inference_only = False
+        self.sm_conv_fused = None
+        self.it_fused = None
+        self.mt_fused = None
 
         if not config.no_context:
             self.sm_conv1 = nn.ModuleList([nn.Conv2d(
@@ -300,12 +448,13 @@ class NESA(nn.Module):
                              p=rnn_out_dr,
                              training=self.training)
 
-    @Profile(__name__)
+    @Profile()
     def title_layer(self, tc, tw, tl, mode='t'):
         # it's context size if mode='st'
-        tl = torch.LongTensor(tl).to(self.device)
+        seqlens = [int(seqlen) for seqlen in tl]
+        tl = torch.LongTensor(seqlens).to(self.device)
         batch_size = tl.size(0)  # B
-        batch_max_seqlen = tl.max()  # L
+        batch_max_seqlen = max(seqlens)  # L
         batch_max_wordlen = -1
         for tc_words in tc:
             for tc_word in tc_words:
@@ -318,26 +467,23 @@ class NESA(nn.Module):
         if batch_max_wordlen < self.tc_conv_min_dim:
             batch_max_wordlen = self.tc_conv_min_dim
 
+        # padded on the host and copied to the device once
         # assure that dataset.char2idx[self.PAD] is 0
         # (B, L (batch_max_seqlen), max_wordlen)
-        tc_tensor = torch.zeros((batch_size,
-                                 batch_max_seqlen,
-                                 batch_max_wordlen), dtype=torch.long) \
-            .to(self.device)
-        for b_idx, (seq, seqlen) in enumerate(zip(tc, tl)):
+        tc_array = np.zeros((batch_size, batch_max_seqlen, batch_max_wordlen),
+                            dtype=np.int64)
+        for b_idx, (seq, seqlen) in enumerate(zip(tc, seqlens)):
             for w_idx in range(seqlen):
                 word_chars = seq[w_idx]
-                tc_tensor[b_idx, w_idx, :len(word_chars)] = \
-                    torch.LongTensor(word_chars).to(self.device)
+                tc_array[b_idx, w_idx, :len(word_chars)] = word_chars
+        tc_tensor = torch.from_numpy(tc_array).to(self.device)
 
         # assure that dataset.word2idx[self.PAD] is 0
         # (B, L (batch_max_seqlen))
-        tw_tensor = torch.zeros((batch_size,
-                                 batch_max_seqlen), dtype=torch.long) \
-            .to(self.device)
-        for idx, (seq, seqlen) in enumerate(zip(tw, tl)):
-            tw_tensor[idx, :seqlen] = \
-                torch.LongTensor(seq[:seqlen]).to(self.device)
+        tw_array = np.zeros((batch_size, batch_max_seqlen), dtype=np.int64)
+        for idx, (seq, seqlen) in enumerate(zip(tw, seqlens)):
+            tw_array[idx, :seqlen] = seq[:seqlen]
+        tw_tensor = torch.from_numpy(tw_array).to(self.device)
 
         # sort tc_tensor and tw_tensor by seq len
         tl, perm_idxes = tl.sort(dim=0, descending=True)
@@ -355,25 +501,14 @@ class NESA(nn.Module):
             tc_embed = F.dropout(tc_embed,
                                  p=self.config.char_dr, training=self.training)
 
-        # unsqueeze dim 2 and transpose
-        # (B * L (batch_max_seqlen), char_embed_dim, 1, max_wordlen)
-        tc_embed = torch.transpose(torch.unsqueeze(tc_embed, 2), 1, 3)
-
-        # tc conv
-        # (N, channels, height, width)
-        conv_result = list()
-        for i, (conv, conv_bn) in enumerate(zip(self.tc_conv, self.tc_conv_bn)):
-            tc_conv = conv(tc_embed)
-
-            tc_mp = torch.max(torch.tanh(conv_bn(tc_conv)), 3)[0]
-
-            # (B, L, tc_conv_fn[i])
-            tc_mp = tc_mp.view(-1, batch_max_seqlen, tc_mp.size(1))
-
-            conv_result.append(tc_mp)
-
-        # (B, L, sum(tc_conv_fn))
-        conv_result = torch.cat(conv_result, dim=2)
+        if self.tc_fused is not None and not self.training:
+            # (B, L, sum(tc_conv_fn))
+            conv_result = self.tc_fused(tc_embed).view(
+                -1, batch_max_seqlen, self.tc_fused.out_channels)
+        else:
+            # BatchNorm statistics must only see each filter's own
+            # positions in training, so filters run separately here
+            conv_result = self.char_cnn(tc_embed, batch_max_seqlen)
 
         # word embedding for title
         # (B, L, word_embed_dim)
@@ -423,18 +558,132 @@ class NESA(nn.Module):
         else:
             raise ValueError('Invalid mode %s' % mode)
 
-    @Profile(__name__)
+    def char_cnn(self, tc_embed, batch_max_seqlen):
+        # unsqueeze dim 2 and transpose
+        # (B * L (batch_max_seqlen), char_embed_dim, 1, max_wordlen)
+        tc_embed = torch.transpose(torch.unsqueeze(tc_embed, 2), 1, 3)
+
+        # tc conv
+        # (N, channels, height, width)
+        conv_result = list()
+        for i, (conv, conv_bn) in enumerate(zip(self.tc_conv,
+                                                self.tc_conv_bn)):
+            tc_conv = conv(tc_embed)
+
+            tc_mp = torch.max(torch.tanh(conv_bn(tc_conv)), 3)[0]
+
+            # (B, L, tc_conv_fn[i])
+            tc_mp = tc_mp.view(-1, batch_max_seqlen, tc_mp.size(1))
+
+            conv_result.append(tc_mp)
+
+        # (B, L, sum(tc_conv_fn))
+        return torch.cat(conv_result, dim=2)
+
+    def fuse_char_cnn(self, fold_bn=True):
+        # eval-mode title_layer runs tc_conv/tc_conv_bn as one fused
+        # Conv1d built from their current weights; train() drops it
+        if self.inference_only:
+            return self.tc_fused  # tc_conv was folded away
+        tc_fused = FusedCharCNN.from_convs(self.tc_conv, self.tc_conv_bn,
+                                           fold_bn=fold_bn)
+        tc_fused.eval()
+        # not a submodule, so state_dict() stays the same; see _apply
+        self._modules.pop('tc_fused', None)
+        object.__setattr__(self, 'tc_fused', tc_fused)
+        return tc_fused
+
+    def set_user_prior(self, user_prior, prior_weight=0.):
+        """Per-user slot distribution (NETSDataset.get_user_prior).
+
+        With prior_weight > 0, forward adds prior_weight * log(prior) of
+        each event's user to the outputs. The prior is also what
+        recommend.recommend(use_prior=True) falls back to.
+        """
+        self.user_prior = torch.as_tensor(user_prior).float() \
+            .to(self.device)
+        assert self.user_prior.size(1) == self.n_classes
+        self.user_log_prior = torch.log(self.user_prior.clamp(min=1e-6))
+        self.prior_weight = prior_weight
+
+    def fuse_prior(self, output, user):
+        if self.user_prior is None or self.prior_weight == 0:
+            return output
+        return output + self.prior_weight * self.user_log_prior[user]
+
+    def optimize_for_inference(self):
+        """Folds BatchNorm into the convs and fuses layers, in place.
+
+        The char-CNN, sm_conv1 + sm_conv1_bn and sm_conv2 + sm_conv2_bn
+        each become one conv, and it_nonl/it_gate and mt_nonl/mt_gate
+        each become one Linear with a split output. The replaced layers
+        are removed, so the model can no longer be trained. Calling this
+        on a freshly built model gives the layout of a saved optimized
+        state_dict.
+        """
+        self.eval()
+        # registered here: optimized checkpoints hold tc_fused.*
+        self.tc_fused = self.fuse_char_cnn(fold_bn=True)
+        del self.tc_conv, self.tc_conv_bn
+        if not self.config.no_context:
+            self.sm_conv_fused = nn.ModuleList([
+                fuse_convs(self.sm_conv1, self.sm_conv1_bn),
+                fuse_convs(self.sm_conv2, self.sm_conv2_bn)])
+            del self.sm_conv1, self.sm_conv1_bn
+            del self.sm_conv2, self.sm_conv2_bn
+        if not self.config.no_intention:
+            self.it_fused = fuse_linears([self.it_nonl, self.it_gate])
+            del self.it_nonl, self.it_gate
+        self.mt_fused = fuse_linears([self.mt_nonl, self.mt_gate])
+        del self.mt_nonl, self.mt_gate
+        self.inference_only = True
+        return self
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to() and .cuda() also move a tc_fused kept out of _modules
+        if self.tc_fused is not None and 'tc_fused' not in self._modules:
+            self.tc_fused._apply(fn)
+        return super(NESA, self)._apply(fn, *args, **kwargs)
+
+    def train(self, mode=True):
+        if mode and self.inference_only:
+            raise RuntimeError('model was optimized for inference')
+        if mode:
+            self.clear_caches()
+        if mode and self.tc_fused is not None:
+            self.tc_fused = None  # stale once tc_conv is trained
+        return super(NESA, self).train(mode)
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        self.clear_caches()
+        return super(NESA, self).load_state_dict(state_dict, *args, **kwargs)
+
+    def clear_caches(self):
+        # eval caches derived from the weights (empty_context,
+        # get_context_base). Their keys miss .data writes, which is how
+        # torch 0.4.1 optimizers and load_state_dict update parameters.
+        self.empty_context_cache = dict()
+        self.empty_context_key = None
+        self.context_base = None
+        self.context_base_key = None
+
+    @Profile()
     def intention_layer(self, user, dur, title):
         # Highway network on concat
         if not self.config.no_title:
             concat = torch.cat((user, dur, title), 1)
         else:
             concat = torch.cat((user, dur), 1)
-        nonl = F.rrelu(self.it_nonl(concat))
-        gate = torch.sigmoid(self.it_gate(concat))
+        if self.it_fused is not None:
+            nonl, gate = self.it_fused(concat).chunk(2, 1)
+            nonl = F.rrelu(nonl)
+            gate = torch.sigmoid(gate)
+        else:
+            nonl = F.rrelu(self.it_nonl(concat))
+            gate = torch.sigmoid(self.it_gate(concat))
         return torch.mul(gate, nonl) + torch.mul(1 - gate, concat)
 
-    @Profile(__name__)
+    @Profile()
     def context_title_layer(self, stc, stw, stl):
         stacked_tc = []
         stacked_tw = []
@@ -442,11 +691,26 @@ class NESA(nn.Module):
         split_idx = [0]
         split_titles = []
 
-        # Stack context features
+        # Stack context features. Examples of the same week share their
+        # context titles, so in eval mode each distinct title is stacked
+        # once. Training keeps every copy, as BatchNorm and dropout in
+        # title_layer see the whole stack.
+        dedup = not self.training
+        title_ids = dict()
+        title_idx = []
         for tc, tw, tl in zip(stc, stw, stl):
-            stacked_tc += tc
-            stacked_tw += tw
-            stacked_tl += tl
+            for c, w, l in zip(tc, tw, tl):
+                # word ids alone would merge titles with different unknowns
+                key = (tuple(w), tuple(map(tuple, c))) if dedup else None
+                idx = title_ids.get(key)
+                if idx is None:
+                    idx = len(stacked_tw)
+                    if dedup:
+                        title_ids[key] = idx
+                    stacked_tc.append(c)
+                    stacked_tw.append(w)
+                    stacked_tl.append(l)
+                title_idx.append(idx)
             split_idx += [len(tc)]
         split_idx = np.cumsum(np.array(split_idx))
 
@@ -454,6 +718,9 @@ class NESA(nn.Module):
         if len(stacked_tc) > 0:
             context_titles = self.title_layer(
                 stacked_tc, stacked_tw, stacked_tl, mode='st')
+            if len(stacked_tc) < len(title_idx):
+                context_titles = context_titles[
+                    torch.LongTensor(title_idx).to(self.device)]
         else:
             context_titles = self.empty_st_rnn_output
 
@@ -466,21 +733,33 @@ class NESA(nn.Module):
 
         return split_titles
 
-    @Profile(__name__)
-    def context_layer(self, user_embed, stitle, sdur, sslot):
+    @Profile()
+    def context_layer(self, user_embed, stitle, sdur, sslot, user=None):
         # # test
         # return torch.zeros(user_embed.size(0), self.context_odim) \
         #     .to(self.device)
 
+        # in eval, events without context are served by empty_context
+        empty_reps = dict()
+        if user is not None and not self.training:
+            empty = [i for i, dur in enumerate(sdur) if len(dur) == 0]
+            if empty:
+                empty_reps = dict(zip(empty, self.empty_context(
+                    user[torch.LongTensor(empty).to(self.device)])))
+
         context_rep_list = list()
         if not self.config.no_context_title:
-            for usr_emb, title, dur, slot \
-                    in zip(user_embed, stitle, sdur, sslot):
+            for i, (usr_emb, title, dur, slot) \
+                    in enumerate(zip(user_embed, stitle, sdur, sslot)):
                 # if 0 == len(dur):
                 #     context_rep_list.append(
                 #         torch.zeros(1, self.context_odim).to(self.device))
                 # else:
 
+                if i in empty_reps:
+                    context_rep_list.append(empty_reps[i].unsqueeze(0))
+                    continue
+
                 if 0 == len(dur):
                     dur = self.emtpy_long
                 else:
@@ -496,12 +775,17 @@ class NESA(nn.Module):
                     self.context_layer_core(usr_emb, title, dur, slot)
                 context_rep_list.append(context_rep)
         else:
-            for usr_emb, dur, slot in zip(user_embed, sdur, sslot):
+            for i, (usr_emb, dur, slot) \
+                    in enumerate(zip(user_embed, sdur, sslot)):
                 # if 0 == len(dur):
                 #     context_rep_list.append(
                 #         torch.zeros(1, self.context_odim).to(self.device))
                 # else:
 
+                if i in empty_reps:
+                    context_rep_list.append(empty_reps[i].unsqueeze(0))
+                    continue
+
                 if 0 == len(dur):
                     dur = self.emtpy_long
                 else:
@@ -518,7 +802,153 @@ class NESA(nn.Module):
                 context_rep_list.append(context_rep)
         return torch.cat(context_rep_list, dim=0)
 
-    @Profile(__name__)
+    @Profile()
+    def week_context_layer(self, user_embed, stitle, sdur, sslot, n_context,
+                           user=None):
+        # in eval, targets without context are served by empty_context
+        use_cache = user is not None and not self.training
+        context_rep_list = list()
+        rep_idx = list()
+        empty_idx = list()
+        start = 0
+        for week_idx, counts in enumerate(n_context):
+            end = start + len(counts)
+            week_user_embed = user_embed[start:end]
+            if use_cache and min(counts) == 0:
+                empty_idx += [start + j for j, c in enumerate(counts)
+                              if c == 0]
+                target_idx = [start + j for j, c in enumerate(counts)
+                              if c > 0]
+                counts = [c for c in counts if c > 0]
+                week_user_embed = \
+                    user_embed[torch.LongTensor(target_idx).to(self.device)]
+            else:
+                target_idx = list(range(start, end))
+            if counts:
+                context_rep_list.append(self.week_context_core(
+                    week_user_embed,
+                    None if stitle is None else stitle[week_idx],
+                    sdur[week_idx], sslot[week_idx], counts))
+                rep_idx += target_idx
+            start = end
+        assert start == user_embed.size(0)
+
+        if empty_idx:
+            context_rep_list.append(self.empty_context(
+                user[torch.LongTensor(empty_idx).to(self.device)]))
+            rep_idx += empty_idx
+        context_rep = torch.cat(context_rep_list, dim=0)
+        if empty_idx:
+            # back to target order
+            context_rep = context_rep[
+                torch.LongTensor(np.argsort(rep_idx)).to(self.device)]
+        return context_rep
+
+    def empty_context(self, user):
+        """context_mf of events without context, by user index.
+
+        Such a context depends only on the user, so in eval it is
+        computed once per user and cached until any parameter or buffer
+        is moved or updated in place, train() or load_state_dict().
+        """
+        key = tuple((t.data_ptr(), t._version)
+                    for t in list(self.parameters()) + list(self.buffers()))
+        if key != self.empty_context_key:
+            self.empty_context_cache = dict()
+            self.empty_context_key = key
+
+        user_ids = user.tolist()
+        missing = sorted(set(u for u in user_ids
+                             if u not in self.empty_context_cache))
+        if missing:
+            users = torch.LongTensor(missing).to(self.device)
+            context_reps = self.week_context_core(
+                self.user_embed(users), None, [], [], [0] * len(missing))
+            self.empty_context_cache.update(zip(missing, context_reps))
+        return torch.stack([self.empty_context_cache[u] for u in user_ids])
+
+    def week_context_core(self, user_embed, title, dur, slot, counts):
+        """Context maps of one week's targets, built as one masked stack.
+
+        Target j sees the first counts[j] events. Every event is embedded
+        once, and written into the maps of the targets that see it; where
+        events overlap, the later one wins, as in context_layer_core.
+        """
+        total_slots = self.config.sm_day_num * self.config.sm_slot_num
+        n_maps = len(counts)
+
+        # (n_maps, total_slots, sm_conv1_idim) base maps with each
+        # target's user broadcast into every slot
+        context_map = self.get_context_base().unsqueeze(0) \
+            .repeat(n_maps, 1, 1)
+        user_start = 0 if self.config.no_context_title \
+            else self.config.st_rnn_hdim * self.num_directions
+        user_end = user_start + user_embed.size(1)
+        context_map[:, :, user_start:user_end] = user_embed.unsqueeze(1)
+
+        if len(dur) > 0 and max(counts) > 0:
+            assert len(dur) == len(slot), 'd %d, s %d' % (len(dur), len(slot))
+            new_slot, event_idx = self.expand_context_slots(dur, slot)
+            new_slot = np.array(new_slot)
+            event_idx = np.array(event_idx)
+
+            # (map, row) pairs in map then row order; the last row written
+            # to a slot of a map wins
+            map_idx, row_idx = np.nonzero(
+                event_idx[None, :] < np.array(counts)[:, None])
+            flat_idx = map_idx * total_slots + new_slot[row_idx]
+            _, last = np.unique(flat_idx[::-1], return_index=True)
+            keep = len(flat_idx) - 1 - last
+            flat_idx = torch.LongTensor(flat_idx[keep]).to(self.device)
+            row_idx = torch.LongTensor(row_idx[keep]).to(self.device)
+
+            slot_embed = F.dropout(
+                self.slot_embed(torch.LongTensor(new_slot).to(self.device)),
+                p=self.config.slot_dr, training=self.training)
+            context_map = context_map.view(n_maps * total_slots, -1)
+            context_map[flat_idx, user_end:] = slot_embed[row_idx]
+            if not self.config.no_context_title:
+                assert title.size(0) == len(dur), \
+                    't %d, d %d' % (title.size(0), len(dur))
+                event_idx = torch.LongTensor(event_idx).to(self.device)
+                context_map[flat_idx, :user_start] = \
+                    title[event_idx[row_idx]]
+
+        # (n_maps, sm_conv1_idim, sm_day_num, sm_slot_num)
+        context_map = context_map.view(n_maps, self.config.sm_day_num,
+                                       self.config.sm_slot_num,
+                                       self.sm_conv1_idim).permute(0, 3, 1, 2)
+        if self.training and self.sm_conv_fused is None:
+            # BatchNorm statistics stay per map, as in context_layer_core
+            return torch.cat([self.context_conv(context_map[i:i + 1])
+                              for i in range(n_maps)], 0)
+        return self.context_conv(context_map)
+
+    def get_context_base(self):
+        # (total_slots, sm_conv1_idim): zero title and user blocks and the
+        # slot embeddings. Outside training it is cached until slot_embed
+        # is updated or moved.
+        weight = self.slot_embed.weight
+        key = (weight.data_ptr(), weight._version)
+        if not self.training and self.context_base_key == key:
+            return self.context_base
+
+        total_slots = self.config.sm_day_num * self.config.sm_slot_num
+        slot_all = torch.arange(0, total_slots, dtype=torch.long) \
+            .to(weight.device)
+        slot_all_embed = self.slot_embed(slot_all)
+        context_base = torch.cat(
+            (torch.zeros(total_slots,
+                         self.sm_conv1_idim - slot_all_embed.size(1))
+             .to(weight.device), slot_all_embed), 1)
+        if self.training:
+            self.context_base, self.context_base_key = None, None
+        else:
+            self.context_base = context_base.detach()
+            self.context_base_key = key
+        return context_base
+
+    @Profile()
     def context_layer_core(self, user_embed, title, dur, slot):
         new_slot = None
         context_contents = None
@@ -530,98 +960,44 @@ class NESA(nn.Module):
         has_preregistered_events = dur.size(0) > 0
 
         if has_preregistered_events:
-            dur = torch.ceil(dur.float() / (30 * self.config.class_div)) \
-                      .long() - 1
-            new_slot = list()
-
             assert dur.size(0) == slot.size(0), \
                 'd %d, s %d' % (dur.size(0), slot.size(0))
 
+            new_slot, event_idx = \
+                self.expand_context_slots(dur.tolist(), slot.tolist())
+            saved_slot = new_slot
+            new_slot = torch.LongTensor(new_slot).to(self.device)
+            slot_embed = F.dropout(self.slot_embed(new_slot),
+                                   p=self.config.slot_dr,
+                                   training=self.training)
+            slot_embed = slot_embed.view(-1, self.config.slot_embed_dim)
+            # slot_embed = torch.zeros(slot_embed.size()).to(self.device)
+            user_src_embed = user_embed.expand(slot_embed.size(0),
+                                               user_embed.size(1))
+
             if not self.config.no_context_title:
                 assert title is not None
-                new_title = list()
-
                 assert title.size(0) == dur.size(0), \
                     't %d, d %d' % (title.size(0), dur.size(0))
 
-                for i, (d, s) in enumerate(zip(dur, slot)):
-                    if d < 0:
-                        d = 0
-                    new_slot.append(s)
-                    new_title.append(title[i])
-                    for k in range(d):
-                        if s + k + 1 < total_slots:
-                            new_slot.append(s + k + 1)
-                            new_title.append(title[i])
-                new_slot = np.array(new_slot)
-                saved_slot = new_slot[:]
-                new_slot = torch.LongTensor(new_slot).to(self.device)
-                new_title = \
-                    torch.cat(new_title, 0). \
-                    view(-1, self.config.st_rnn_hdim * self.num_directions)
-                slot_embed = F.dropout(self.slot_embed(new_slot),
-                                       p=self.config.slot_dr,
-                                       training=self.training)
-                slot_embed = slot_embed.view(-1, self.config.slot_embed_dim)
-                # slot_embed = torch.zeros(slot_embed.size()).to(self.device)
-                user_src_embed = user_embed.expand(slot_embed.size(0),
-                                                   user_embed.size(1))
+                new_title = title[torch.LongTensor(event_idx).to(self.device)]
                 context_contents = \
                     torch.cat((new_title, user_src_embed, slot_embed), 1)
             else:
-                for i, (d, s) in enumerate(zip(dur, slot)):
-                    new_slot.append(s)
-                    for k in range(d):
-                        if d < 0:
-                            d = 0
-                        if s + k + 1 < total_slots:
-                            new_slot.append(s + k + 1)
-                new_slot = np.array(new_slot)
-                saved_slot = new_slot[:]
-                new_slot = torch.LongTensor(new_slot).to(self.device)
-                slot_embed = F.dropout(self.slot_embed(new_slot),
-                                       p=self.config.slot_dr,
-                                       training=self.training)
-                slot_embed = slot_embed.view(-1, self.config.slot_embed_dim)
-                # slot_embed = torch.zeros(slot_embed.size()).to(self.device)
-                user_src_embed = user_embed.expand(slot_embed.size(0),
-                                                   user_embed.size(1))
                 context_contents = torch.cat((user_src_embed, slot_embed), 1)
 
         saved_slot = torch.LongTensor(saved_slot).to(self.device)
 
-        # ready for slot, user embed (base)
-        slot_all = torch.arange(0, total_slots, dtype=torch.long) \
-            .to(self.device)
-        slot_all_embed = self.slot_embed(slot_all)
-        user_all_embed = user_embed[0].expand(slot_all_embed.size(0),
-                                              user_embed.size(1))
-
-        if not self.config.no_context_title:
-            zero_concat = \
-                torch.zeros(
-                    total_slots,
-                    self.config.st_rnn_hdim * self.num_directions) \
-                .to(self.device)
-            context_base = torch.cat((zero_concat, user_all_embed,
-                                      slot_all_embed), 1)
-        else:
-            context_base = torch.cat((user_all_embed, slot_all_embed), 1)
-
-        # ready for context map (empty)
-        context_map = torch.zeros(total_slots, self.sm_conv1_idim) \
-            .to(self.device)
-
-        index = None
+        # base map with the user broadcast into every slot, then the
+        # contents scattered over it
+        context_map = self.get_context_base().clone()
+        user_start = 0 if self.config.no_context_title \
+            else self.config.st_rnn_hdim * self.num_directions
+        context_map[:, user_start:user_start + user_embed.size(1)] = \
+            user_embed[0]
         if has_preregistered_events:
             index = new_slot.unsqueeze(1)
             index = index.expand_as(context_contents)
-        slot_all = slot_all.unsqueeze(1)
-        slot_all = slot_all.expand_as(context_base)
-
-        # scatter base and then the contents
-        context_map.scatter_(0, slot_all, context_base)
-        if has_preregistered_events:
             context_map.scatter_(0, index, context_contents)
 
         # (sm_day_num, sm_slot_num,
@@ -636,9 +1012,19 @@ class NESA(nn.Module):
         context_map = context_map.permute(2, 0, 1)
 
         # multiple filter conv
-        conv_list = [self.sm_conv1, self.sm_conv2]
         context_mf = torch.unsqueeze(context_map, 0).to(self.device)
+        return self.context_conv(context_mf), saved_slot
 
+    def context_conv(self, context_mf):
+        # (N, sm_conv1_idim, sm_day_num, sm_slot_num) -> (N, context_odim)
+        if self.sm_conv_fused is not None:
+            # BatchNorm folded into the fused convs
+            context_mf = F.rrelu(self.sm_conv_fused[0](context_mf))
+            context_mf = self.sm_conv_fused[1](context_mf)
+            return torch.max(context_mf.view(context_mf.size(0),
+                                             context_mf.size(1), -1), 2)[0]
+
+        conv_list = [self.sm_conv1, self.sm_conv2]
         for layer_idx, sm_conv in enumerate(conv_list):
             conv_result = list()
             for filter_idx, conv in enumerate(sm_conv):
@@ -649,16 +1035,32 @@ class NESA(nn.Module):
                 context_mf = F.rrelu(self.sm_conv1_bn(context_mf))
             else:  # layer_idx == 1
                 context_mf = torch.max(self.sm_conv2_bn(context_mf)
-                                       .view(1, context_mf.size(1), -1), 2)[0]
+                                       .view(context_mf.size(0),
+                                             context_mf.size(1), -1), 2)[0]
 
-        return context_mf, saved_slot
+        return context_mf
 
-    @Profile(__name__)
+    def expand_context_slots(self, dur, slot):
+        # an event covers its start slot and the following slots of its
+        # duration within the week; returns (slot, event index) per
+        # covered slot
+        total_slots = self.config.sm_day_num * self.config.sm_slot_num
+        slot_unit = 30 * self.config.class_div
+        new_slot = list()
+        event_idx = list()
+        for i, (d, s) in enumerate(zip(dur, slot)):
+            n_slots = max(int(math.ceil(d / slot_unit)), 1)
+            covered = [s] + list(range(s + 1, min(s + n_slots, total_slots)))
+            new_slot += covered
+            event_idx += [i] * len(covered)
+        return new_slot, event_idx
+
+    @Profile()
     def matching_layer(self, title, intention, context_mf, grid):
         # Highway network for mf
         concat_seq = list()
         if not self.config.no_context:
-            concat_seq.append(grid.to(self.device))
+            concat_seq.append(grid)
             concat_seq.insert(0, context_mf)
         if not self.config.no_intention:
             concat_seq.insert(0, intention)
@@ -672,31 +1074,21 @@ class NESA(nn.Module):
         else:
             concat = concat_seq[0]
 
-        nonl = F.rrelu(self.mt_nonl(concat))
-        gate = torch.sigmoid(self.mt_gate(concat))
+        if self.mt_fused is not None:
+            nonl, gate = self.mt_fused(concat).chunk(2, 1)
+            nonl = F.rrelu(nonl)
+            gate = torch.sigmoid(gate)
+        else:
+            nonl = F.rrelu(self.mt_nonl(concat))
+            gate = torch.sigmoid(self.mt_gate(concat))
         output = torch.mul(gate, nonl) + torch.mul(1 - gate, concat)
         output = F.dropout(output, p=self.config.output_dr,
                            training=self.training)
 
         return self.output_fc1(output)
 
-    @Profile(__name__)
-    def forward(self, user, dur, tc, tw, tl, stc, stw, stl, sdur, sslot, gr):
-        """
-        11 Features
-            - user: [batch]
-            - dur: [batch]
-            - tc: [batch, sentlen, wordlen]
-            - tw: [batch, sentlen]
-            - tl: [batch]
-            - stc: [batch, snum, sentlen, wordlen]
-            - stw: [batch, snum, sentlen]
-            - stl: [batch, snum]
-            - sdur: [batch, snum]
-            - sslot: [batch, snum]
-            - gr: [batch, snum]
-        """
-
+    def target_layers(self, user, dur, tc, tw, tl):
+        # title, user embedding and intention of the target events
         title_rep = None
         if not self.config.no_title:
             # (B, t_rnn_hdim * num_directions)
@@ -704,7 +1096,7 @@ class NESA(nn.Module):
 
         user_embed = None
         if not self.config.no_intention or not self.config.no_context:
-            user_embed = self.user_embed(user.to(self.device))
+            user_embed = self.user_embed(user)
             # user_embed = torch.zeros(user_embed.size()).to(self.device)
 
             if self.config.user_dr > 0:
@@ -714,7 +1106,7 @@ class NESA(nn.Module):
 
         intention_rep = None
         if not self.config.no_intention:
-            dur_embed = self.dur_embed(dur.to(self.device))
+            dur_embed = self.dur_embed(dur)
             # dur_embed = torch.zeros(dur.size(0), self.config.dur_embed_dim) \
             #     .to(self.device)
 
@@ -727,6 +1119,30 @@ class NESA(nn.Module):
             intention_rep = \
                 self.intention_layer(user_embed, dur_embed, title_rep)
 
+        return title_rep, user_embed, intention_rep
+
+    @Profile()
+    def forward(self, user, dur, tc, tw, tl, stc, stw, stl, sdur, sslot, gr):
+        """
+        11 Features
+            - user: [batch]
+            - dur: [batch]
+            - tc: [batch, sentlen, wordlen]
+            - tw: [batch, sentlen]
+            - tl: [batch]
+            - stc: [batch, snum, sentlen, wordlen]
+            - stw: [batch, snum, sentlen]
+            - stl: [batch, snum]
+            - sdur: [batch, snum]
+            - sslot: [batch, snum]
+            - gr: [batch, snum]
+        """
+        # no-ops for batches already on the device (DevicePrefetcher)
+        user, dur, gr = \
+            user.to(self.device), dur.to(self.device), gr.to(self.device)
+        title_rep, user_embed, intention_rep = \
+            self.target_layers(user, dur, tc, tw, tl)
+
         if not self.config.no_context:
             stitle_rep = None
             if not self.config.no_context_title:
@@ -734,7 +1150,48 @@ class NESA(nn.Module):
                 stitle_rep = self.context_title_layer(stc, stw, stl)
 
             # (B, sum(config.sm_conv_fn[len(config.sm_conv_fn)//2:]))
-            context_mf = self.context_layer(user_embed, stitle_rep, sdur, sslot)
+            context_mf = self.context_layer(user_embed, stitle_rep, sdur,
+                                            sslot, user)
+
+            # (B, config.sm_day_num * config.sm_slot_num)
+            output = \
+                self.matching_layer(title_rep, intention_rep, context_mf, gr)
+        else:
+            output = self.matching_layer(title_rep, intention_rep, None, None)
+
+        assert output.size(1) == \
+            self.config.sm_day_num * self.config.sm_slot_num
+        return self.fuse_prior(output, user)
+
+    @Profile()
+    def forward_weeks(self, user, dur, tc, tw, tl, stc, stw, stl, sdur, sslot,
+                      n_context, gr):
+        """forward() over week batches (dataset.batchify_weeks).
+
+        user, dur, tc, tw, tl and gr are per target as in forward(), with
+        the targets of a week next to each other. stc, stw, stl, sdur and
+        sslot hold each week's context events once, and n_context[w] the
+        number of them each target of week w sees.
+        Outputs match forward() on a batch of the same events. As in
+        forward(), titles are char-padded to the longest word of the batch
+        and the char-CNN max-pools over the padding, so scores depend on
+        the other events in the batch (up to ~0.2 in logits against
+        batch_size=1 on benchmarks/synthetic data).
+        """
+        user, dur, gr = \
+            user.to(self.device), dur.to(self.device), gr.to(self.device)
+        title_rep, user_embed, intention_rep = \
+            self.target_layers(user, dur, tc, tw, tl)
+
+        if not self.config.no_context:
+            stitle_rep = None
+            if not self.config.no_context_title:
+                # (W, (VARIABLE week length, st_rnn_hdim * num_directions))
+                stitle_rep = self.context_title_layer(stc, stw, stl)
+
+            # (B, sum(config.sm_conv_fn[len(config.sm_conv_fn)//2:]))
+            context_mf = self.week_context_layer(user_embed, stitle_rep,
+                                                 sdur, sslot, n_context, user)
 
             # (B, config.sm_day_num * config.sm_slot_num)
             output = \
@@ -744,7 +1201,7 @@ class NESA(nn.Module):
 
         assert output.size(1) == \
             self.config.sm_day_num * self.config.sm_slot_num
-        return output
+        return self.fuse_prior(output, user)
 
     def get_regloss(self, weight_decay=None):
         if weight_decay is None:
@@ -772,9 +1229,7 @@ class NESA(nn.Module):
             filename = os.path.join(self.config.checkpoint_dir,
                                     filename + '.pth')
         print('\t-> save checkpoint %s' % filename)
-        if not os.path.exists(self.config.checkpoint_dir):
-            os.mkdir(self.config.checkpoint_dir)
-        torch.save(state, filename)
+        atomic_save(state, filename)
 
     def load_checkpoint(self, filename=None):
         if filename is None:
@@ -789,8 +1244,31 @@ class NESA(nn.Module):
                                 else 'cpu')
         self.load_state_dict(checkpoint['state_dict'])
         self.optimizer.load_state_dict(checkpoint['optimizer'])
-
-    @Profile(__name__)
+        if 'scheduler' in checkpoint:
+            set_scheduler_state(self.scheduler, checkpoint['scheduler'])
+
+    def get_checkpoint_manager(self, keep_last=3):
+        if self.checkpoints is None:
+            self.checkpoints = CheckpointManager(self.config.checkpoint_dir,
+                                                 self.config.model_name,
+                                                 keep_last=keep_last)
+        return self.checkpoints
+
+    def save_training_state(self, step, mrr=None, sampler=None,
+                            num_consumed=0):
+        # written in the background; keeps the last steps and the best mrr
+        state = get_training_state(self, sampler, num_consumed)
+        self.get_checkpoint_manager().save(state, step, mrr)
+
+    def resume_training_state(self, sampler=None):
+        # step of the latest step checkpoint, 0 without one
+        state = self.get_checkpoint_manager().load(
+            map_location=None if 'cuda' == self.device.type else 'cpu')
+        if state is None:
+            return 0
+        return restore_training_state(self, state, sampler)
+
+    @Profile()
     def write_summary(self, mode, loss, metrics, offset, add_histogram=False):
         if mode != 'tr':
             return
@@ -810,7 +1288,7 @@ class NESA(nn.Module):
         self.summary_writer.close()
 
 
-@Profile(__name__)
+@Profile()
 def get_metrics(outputs, targets, n_day_slots, n_classes, ex_targets=None,
                 topk=5):
     if ex_targets is not None:
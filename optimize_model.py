@@ -0,0 +1,78 @@
+import argparse
+import pickle
+
+import torch
+
+import dataset
+import test
+from checkpoint import atomic_save
+
+
+def check_parity(model, optimized, test_loader, dvc, atol):
+    # both models run on the same batches; outputs are pre-softmax scores
+    max_diff = 0.
+    mismatches = 0
+    count = 0
+    with torch.no_grad():
+        for ex in dataset.DevicePrefetcher(test_loader, dvc):
+            outputs = model(*ex[:-1])
+            opt_outputs = optimized(*ex[:-1])
+            max_diff = max(max_diff,
+                           (outputs - opt_outputs).abs().max().item())
+            mismatches += \
+                (outputs.argmax(1) != opt_outputs.argmax(1)).sum().item()
+            count += outputs.size(0)
+    print('max abs diff %.3g, argmax mismatches %d / %d' %
+          (max_diff, mismatches, count))
+    assert max_diff <= atol, 'max abs diff %g > %g' % (max_diff, atol)
+    return {'max_abs_diff': max_diff, 'argmax_mismatches': mismatches,
+            'count': count}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--model_path', type=str,
+                            default='./data/nesa_180522_0.pth')
+    arg_parser.add_argument('--output_path', type=str,
+                            default='./data/nesa_180522_0_opt.pth')
+    arg_parser.add_argument('--input_path', type=str,
+                            default='./data/sample_data.csv',
+                            help='events checked for output parity')
+    arg_parser.add_argument('--trained_dict_path', type=str,
+                            default='./data/dataset_180522_dict.pkl')
+    arg_parser.add_argument('--yes_cuda', type=int, default=1)
+    arg_parser.add_argument('--atol', type=float, default=1e-3)
+    args = arg_parser.parse_args()
+
+    use_cuda = args.yes_cuda > 0 and torch.cuda.is_available()
+    device = torch.device('cuda' if use_cuda else 'cpu')
+
+    config = dataset.Config()
+    config.test_path = args.input_path
+    nets_dictionary = pickle.load(open(args.trained_dict_path, 'rb'))
+    test_set = dataset.NETSDataset(config, nets_dictionary)
+    assert len(test_set.test_data) > 0, 'no events'
+    _, _, test_loader = test_set.get_dataloader(batch_size=1)
+
+    model, ckpt_config = test.get_model(test_set.widx2vec, args.model_path,
+                                        device, test_set.idx2dur, args)
+    assert not model.inference_only, 'already optimized'
+    model.eval()
+    optimized, _ = test.get_model(test_set.widx2vec, args.model_path,
+                                  device, test_set.idx2dur, args)
+    optimized.optimize_for_inference()
+
+    parity = check_parity(model, optimized, test_loader, device, args.atol)
+    atomic_save({'config': ckpt_config,
+                 'state_dict': optimized.state_dict(),
+                 'inference_only': True,
+                 'temperature': model.temperature,
+                 'user_prior': None if model.user_prior is None
+                 else model.user_prior.cpu(),
+                 'prior_weight': model.prior_weight,
+                 'parity': parity}, args.output_path)
+    print('saved %s' % args.output_path)
+
+
+if __name__ == '__main__':
+    main()
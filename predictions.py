@@ -0,0 +1,140 @@
+import argparse
+import json
+
+import numpy as np
+import torch
+
+# duration buckets (minutes) for slice_metrics
+DURATION_EDGES = [30, 60, 120, 240, 480]
+
+
+def prediction_dtype(k):
+    # one fixed-size record per example
+    return np.dtype([('example_id', np.int64),
+                     ('user', np.int32),
+                     ('duration', np.int32),  # minutes
+                     ('target', np.int16),
+                     ('rank', np.int16),  # 0 if the target scored highest
+                     ('top_slots', np.int16, (k,)),
+                     ('top_scores', np.float32, (k,))])
+
+
+class PredictionWriter(object):
+    """Appends per-example predictions to a flat binary file as batches
+    complete, so memory stays bounded by one batch.
+
+    <path> holds the records (prediction_dtype(k)), <path>.json the k,
+    n_day_slots and record count needed to read them back.
+    """
+
+    def __init__(self, path, k=5, n_day_slots=24):
+        self.path = path
+        self.k = k
+        self.n_day_slots = n_day_slots
+        self.dtype = prediction_dtype(k)
+        self.count = 0
+        self.f = open(path, 'wb')
+
+    def write(self, example_ids, users, durations, targets, outputs):
+        # outputs: [batch, n_classes] scores as used for the metrics
+        outputs = outputs.detach()
+        target_scores = outputs.gather(1, targets.view(-1, 1))
+        ranks = (outputs > target_scores).long().sum(1)
+        top_scores, top_slots = torch.topk(outputs, self.k, 1)
+
+        records = np.zeros(outputs.size(0), dtype=self.dtype)
+        records['example_id'] = example_ids
+        records['user'] = users.cpu().numpy()
+        records['duration'] = durations
+        records['target'] = targets.cpu().numpy()
+        records['rank'] = ranks.cpu().numpy()
+        records['top_slots'] = top_slots.cpu().numpy()
+        records['top_scores'] = top_scores.cpu().numpy()
+        records.tofile(self.f)
+        self.count += len(records)
+
+    def close(self):
+        self.f.close()
+        with open(self.path + '.json', 'w') as f:
+            json.dump({'k': self.k, 'n_day_slots': self.n_day_slots,
+                       'count': self.count}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_predictions(path):
+    # memory-mapped records and their header
+    with open(path + '.json') as f:
+        header = json.load(f)
+    records = np.memmap(path, dtype=prediction_dtype(header['k']), mode='r',
+                        shape=(header['count'],))
+    return records, header
+
+
+def slice_keys(records, by, n_day_slots):
+    if by == 'user':
+        return records['user']
+    elif by == 'weekday':  # of the target slot, 0 is Monday
+        return records['target'] // n_day_slots
+    elif by == 'duration':  # index into DURATION_EDGES
+        return np.digitize(records['duration'], DURATION_EDGES, right=True)
+    raise ValueError(by)
+
+
+def duration_label(bucket):
+    if bucket < len(DURATION_EDGES):
+        return '<=%dmin' % DURATION_EDGES[bucket]
+    return '>%dmin' % DURATION_EDGES[-1]
+
+
+def slice_metrics(records, by, n_day_slots):
+    """{slice: {count, recall1, recall5, mrr, ieuc}}, the measures of
+    test.measure_performance per user, target weekday or duration bucket.
+    """
+    keys = slice_keys(records, by, n_day_slots)
+    ranks = records['rank'].astype(np.float64)
+    top1 = records['top_slots'][:, 0].astype(np.int64)
+    targets = records['target'].astype(np.int64)
+    euc = np.sqrt((top1 // n_day_slots - targets // n_day_slots) ** 2 +
+                  (top1 % n_day_slots - targets % n_day_slots) ** 2)
+    measures = {'recall1': ranks < 1, 'recall5': ranks < 5,
+                'mrr': 1. / (ranks + 1), 'ieuc': 1. / (euc + 1.)}
+
+    uniques, inverse, counts = np.unique(keys, return_inverse=True,
+                                         return_counts=True)
+    metrics = {key: {'count': int(count)}
+               for key, count in zip(uniques.tolist(), counts)}
+    for name, values in measures.items():
+        sums = np.bincount(inverse, weights=values, minlength=len(uniques))
+        for key, total, count in zip(uniques.tolist(), sums, counts):
+            metrics[key][name] = total / count
+    return metrics
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--predictions_path', type=str, required=True,
+                            help='written by test.py --predictions_path')
+    arg_parser.add_argument('--by', type=str, default='weekday',
+                            choices=['user', 'weekday', 'duration'])
+    args = arg_parser.parse_args()
+
+    records, header = read_predictions(args.predictions_path)
+    print('#events', len(records))
+    metrics = slice_metrics(records, args.by, header['n_day_slots'])
+    print('%-10s %8s %9s %9s %9s %9s' %
+          (args.by, 'count', 'recall@1', 'recall@5', 'mrr', 'ieuc'))
+    for key in sorted(metrics):
+        m = metrics[key]
+        label = duration_label(key) if args.by == 'duration' else key
+        print('%-10s %8d %9.4f %9.4f %9.4f %9.4f' %
+              (label, m['count'], m['recall1'], m['recall5'], m['mrr'],
+               m['ieuc']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import torch
+import torch.nn.functional as F
+
+
+def working_hours(n_day_slots, start_hour=9, end_hour=18,
+                  days=(0, 1, 2, 3, 4)):
+    """(7 * n_day_slots) mask of the slots within [start_hour, end_hour)
+    on the given days (0 is Monday), in the output slot order.
+    """
+    slot_hours = 24. / n_day_slots
+    hours = torch.arange(0, n_day_slots).float() * slot_hours
+    in_hours = (hours >= start_hour) & (hours + slot_hours <= end_hour)
+    on_day = torch.Tensor([float(day in days) for day in range(7)]) > 0
+    return (on_day.unsqueeze(1) & in_hours.unsqueeze(0)).view(-1)
+
+
+def duration_slots(durations, slot_minutes):
+    # minutes -> number of slots an event covers (at least one)
+    return torch.ceil(durations.float() / slot_minutes).long().clamp(min=1)
+
+
+def fit_mask(occupancy, n_slots, allowed=None):
+    """Slots where an event of n_slots slots can start.
+
+    occupancy: [batch, slots], nonzero where taken (the gr input)
+    n_slots: [batch] slots covered by each event
+    allowed: [slots] or [batch, slots], nonzero where events may be put
+    The event has to end within the week, on free and allowed slots.
+    """
+    blocked = occupancy != 0
+    if allowed is not None:
+        blocked = blocked | (allowed.to(occupancy.device) == 0)
+    batch_size, total_slots = blocked.size()
+
+    # blocked slots in [s, s + n) for every start s, from prefix sums
+    prefix = torch.cat((blocked.new_zeros(batch_size, 1).long(),
+                        blocked.long().cumsum(1)), 1)
+    starts = torch.arange(0, total_slots, dtype=torch.long) \
+        .to(occupancy.device).unsqueeze(0)
+    ends = starts + n_slots.to(occupancy.device).unsqueeze(1)
+    n_blocked = prefix.gather(1, ends.clamp(max=total_slots)) - \
+        prefix[:, :total_slots]
+    return (n_blocked == 0) & (ends <= total_slots)
+
+
+def top_slots(outputs, mask, k=5):
+    """Top-k (scores, slots) of outputs among the slots in mask.
+
+    Outputs are not modified. Where fewer than k slots are allowed, the
+    remaining entries have -inf scores.
+    """
+    masked = torch.where(mask, outputs,
+                         torch.full_like(outputs, float('-inf')))
+    return torch.topk(masked, k, 1)
+
+
+def fit_temperature(outputs, targets, max_iter=50):
+    """Temperature minimizing the NLL of softmax(outputs / temperature)
+    on held-out outputs and targets (temperature scaling).
+    """
+    outputs = outputs.detach()
+    log_t = torch.zeros(1, device=outputs.device, requires_grad=True)
+    optimizer = torch.optim.LBFGS([log_t], lr=0.1, max_iter=max_iter)
+
+    def closure():
+        optimizer.zero_grad()
+        loss = F.cross_entropy(outputs / log_t.exp(), targets)
+        loss.backward()
+        return loss
+    optimizer.step(closure)
+    return log_t.exp().item()
+
+
+def calibration_error(probs, targets, n_bins=15):
+    # expected calibration error of the top-1 probabilities
+    top_probs, predictions = probs.max(1)
+    correct = (predictions == targets).float()
+    bins = (top_probs * n_bins).long().clamp(max=n_bins - 1)
+    error = 0.
+    for bin_idx in range(n_bins):
+        in_bin = bins == bin_idx
+        count = in_bin.long().sum().item()
+        if count > 0:
+            error += count * abs(top_probs[in_bin].mean().item() -
+                                 correct[in_bin].mean().item())
+    return error / probs.size(0)
+
+
+def calibrated_probs(outputs, temperature=1.):
+    return F.softmax(outputs / temperature, 1)
+
+
+def confidence(probs, mask=None):
+    """1 - normalized entropy: 1 for a single likely slot, 0 for a
+    uniform distribution. With a mask, probs are renormalized over it.
+    """
+    if mask is not None:
+        probs = probs * mask.float()
+        probs = probs / probs.sum(1, keepdim=True).clamp(min=1e-12)
+        n_choices = mask.float().sum(1)
+    else:
+        n_choices = torch.full_like(probs[:, 0], probs.size(1))
+    entropy = -(probs * torch.log(probs.clamp(min=1e-12))).sum(1)
+    confidences = 1. - entropy / torch.log(n_choices.clamp(min=2.))
+    # no confidence without any slot to suggest
+    return confidences.clamp(min=0.) * (n_choices > 0).float()
+
+
+def predict(model, inputs, weeks=False):
+    """Calibrated slot probabilities and confidence for a batch.
+
+    inputs: a loader batch without its targets (ex[:-1]); weeks selects
+    NESA.forward_weeks for get_dataloader(weeks=True) batches. The
+    temperature comes from the checkpoint (see calibrate.py).
+    """
+    with torch.no_grad():
+        outputs = (model.forward_weeks if weeks else model)(*inputs)
+    probs = calibrated_probs(outputs, model.temperature)
+    return probs, confidence(probs)
+
+
+def recommend(model, inputs, durations, allowed=None, k=5, weeks=False,
+              use_prior=False):
+    """Top-k free slots for a batch of events.
+
+    durations: [batch] event durations in minutes
+    allowed: e.g. working_hours(model.n_day_slots)
+    use_prior: score with the users' slot priors (NESA.set_user_prior)
+    instead of running the model, e.g. when it is overloaded; raises
+    ValueError if the model has no prior
+    Returns (probs, slots, confidence): the calibrated probabilities of
+    the top-k slots, and the confidence among the slots that fit.
+    """
+    if use_prior:
+        if model.user_prior is None:
+            raise ValueError('use_prior needs a slot prior in the model; '
+                             'store one with user_prior.py')
+        probs = model.user_prior[inputs[0].to(model.device)]
+    else:
+        probs, _ = predict(model, inputs, weeks)
+    n_slots = duration_slots(durations, 24 * 60 // model.n_day_slots)
+    # plain loader batches are on the cpu
+    mask = fit_mask(inputs[-1].to(model.device), n_slots, allowed)
+    top_probs, slots = top_slots(probs, mask, k)
+    return top_probs, slots, confidence(probs, mask)
@@ -4,8 +4,10 @@ from model import NESA, get_metrics
 import numpy as np
 import os
 import pickle
+from predictions import PredictionWriter
 import random
 import torch
+from utils import PROFILER, configure_threads, parse_cores
 
 
 def get_dataset(cfg, trained_dict_path):
@@ -32,13 +34,25 @@ def get_model(widx2vec, model_path, dvc, idx2dur, arg):
              idx2dur=idx2dur if ckpt_config.use_duration_scala > 0
              else None).to(dvc)
     model.config.checkpoint_dir = model_dir + '/'
-    model.load_checkpoint(filename=model_filename[:-4])  # .pth
+    if checkpoint.get('inference_only'):
+        # written by optimize_model.py; has no optimizer state
+        model.optimize_for_inference()
+        model.load_state_dict(checkpoint['state_dict'])
+    else:
+        model.load_checkpoint(filename=model_filename[:-4])  # .pth
+    model.temperature = checkpoint.get('temperature', 1.)
+    if checkpoint.get('user_prior') is not None:
+        model.set_user_prior(checkpoint['user_prior'],
+                             checkpoint.get('prior_weight', 0.))
     # import pprint
     # pprint.PrettyPrinter().pprint(_model.config.__dict__)
     return model, ckpt_config
 
 
-def measure_performance(test_set, model, conf, dvc, batch_size=1):
+def measure_performance(test_set, model, conf, dvc, batch_size=1,
+                        weeks=False, predictions_path=None, topk=5):
+    # weeks: batch_size weeks per batch, through NESA.forward_weeks
+    # predictions_path: stream per-event records there (predictions.py)
     performance_dict = dict()
     performance_dict['recall1'] = 0.
     performance_dict['recall5'] = 0.
@@ -49,16 +63,37 @@ def measure_performance(test_set, model, conf, dvc, batch_size=1):
 
     model = model.eval()
 
-    _, _, test_loader = test_set.get_dataloader(batch_size=batch_size)
+    _, _, test_loader = test_set.get_dataloader(batch_size=batch_size,
+                                                weeks=weeks)
+    forward = model.forward_weeks if weeks else model
+    writer = None
+    if predictions_path is not None:
+        writer = PredictionWriter(predictions_path, topk, model.n_day_slots)
+        idx2dur = np.zeros(len(test_set.idx2dur), dtype=np.int32)
+        for dur_idx, minutes in test_set.idx2dur.items():
+            idx2dur[dur_idx] = minutes
     with torch.no_grad():
-        for d_idx, ex in enumerate(test_loader):
-            labels = ex[-1].to(dvc)
-            outputs = model(*ex[:-1])
+        for d_idx, ex in enumerate(dataset.DevicePrefetcher(test_loader,
+                                                            dvc)):
+            labels = ex[-1]
+            outputs = forward(*ex[:-1])
             metrics = get_metrics(outputs, labels, model.n_day_slots,
                                   model.n_classes,
-                                  ex_targets=ex[-2].to(device)
+                                  ex_targets=ex[-2]
                                   if conf.ex_pre_events > 0 else None)
 
+            if writer is not None:
+                # ids index test_data; the sorted sampler reorders them
+                n_events = outputs.size(0)
+                start = performance_dict['count']
+                if weeks:
+                    example_ids = np.arange(start, start + n_events)
+                else:
+                    example_ids = test_loader.sampler.last_order[
+                        start:start + n_events]
+                writer.write(example_ids, ex[0],
+                             idx2dur[ex[1].cpu().numpy()], labels, outputs)
+
             performance_dict['recall1'] += metrics[0]
             performance_dict['recall5'] += metrics[1]
             performance_dict['mrr'] += metrics[2]
@@ -69,17 +104,24 @@ def measure_performance(test_set, model, conf, dvc, batch_size=1):
             if d_idx % 1000 == 0 and d_idx > 0:
                 print(d_idx)
 
-    steps = performance_dict['steps']
-    recall1 = performance_dict['recall1'] / steps
-    recall5 = performance_dict['recall5'] / steps
-    mrr = performance_dict['mrr'] / steps
-    ieuc = performance_dict['ieuc'] / steps
+    if writer is not None:
+        writer.close()
+        print('predictions saved to %s' % predictions_path)
+
+    # metrics are summed over the events of each batch
+    count = performance_dict['count']
+    recall1 = performance_dict['recall1'] / count
+    recall5 = performance_dict['recall5'] / count
+    mrr = performance_dict['mrr'] / count
+    ieuc = performance_dict['ieuc'] / count
 
     print('recall@1 %.4f' % recall1)
     print('recall@5 %.4f' % recall5)
     print('mrr      %.4f' % mrr)
     print('ieuc     %.4f' % ieuc)
     print('#events', performance_dict['count'])
+    return {'recall1': recall1, 'recall5': recall5, 'mrr': mrr,
+            'ieuc': ieuc, 'count': count}
 
 
 def set_seed_all(seed):
@@ -103,6 +145,25 @@ if __name__ == '__main__':
                             default='./data/dataset_180522_dict.pkl')
     arg_parser.add_argument("--seed", type=int, default=3)
     arg_parser.add_argument('--yes_cuda', type=int, default=1)
+    arg_parser.add_argument('--fuse_char_cnn', type=int, default=1,
+                            help='run the title char-CNN as one fused conv')
+    arg_parser.add_argument('--week_batches', type=int, default=0,
+                            help='score a week\'s events in one pass')
+    arg_parser.add_argument('--predictions_path', type=str, default=None,
+                            help='stream per-event top-k predictions there')
+    arg_parser.add_argument('--topk', type=int, default=5)
+    arg_parser.add_argument('--intra_op_threads', type=int, default=0,
+                            help='0: len(--cores), or torch\'s default')
+    arg_parser.add_argument('--inter_op_threads', type=int, default=0)
+    arg_parser.add_argument('--cores', type=str, default=None,
+                            help='pin to these cores, e.g. 0-11')
+    arg_parser.add_argument('--data_workers', type=int, default=-1,
+                            help='DataLoader workers; -1 keeps the config')
+    arg_parser.add_argument('--data_worker_cores', type=str, default=None,
+                            help='pin DataLoader workers, e.g. 12-15')
+    arg_parser.add_argument("--profile_path", type=str, default=None,
+                            help='write <path>.json and <path>_trace.json')
+    arg_parser.add_argument("--profile_sample_rate", type=float, default=1.)
     args = arg_parser.parse_args()
 
     use_cuda = args.yes_cuda > 0 and torch.cuda.is_available()
@@ -110,12 +171,26 @@ if __name__ == '__main__':
     print('CUDA device_count {0}'.format(torch.cuda.device_count())
           if use_cuda else 'CPU')
 
+    # before any parallel work, so inter-op threads can still be set
+    threads = configure_threads(args.intra_op_threads, args.inter_op_threads,
+                                parse_cores(args.cores))
+    print('intra-op threads %d, inter-op threads %d' % threads)
+
     set_seed_all(args.seed)
 
+    if args.profile_path is not None:
+        PROFILER.configure(enabled=True,
+                           sample_rate=args.profile_sample_rate,
+                           sync_device=use_cuda,
+                           trace=True)
+
     config = dataset.Config()
     config.test_path = args.input_path
     config.preprocess_save_path = args.serialized_data_path
     config.preprocess_load_path = args.serialized_data_path
+    if args.data_workers >= 0:
+        config.data_workers = args.data_workers
+    config.data_worker_cores = parse_cores(args.data_worker_cores)
 
     print('Loading test dataset..')
     test_dataset = get_dataset(config, args.trained_dict_path)
@@ -124,6 +199,16 @@ if __name__ == '__main__':
     print('Loading NESA model..')
     nesa_model, nesa_conf = get_model(test_dataset.widx2vec, args.model_path,
                                       device, test_dataset.idx2dur, args)
+    if args.fuse_char_cnn > 0:
+        nesa_model.fuse_char_cnn()
 
     print('\nMeasuring NESA performance on test data..')
-    measure_performance(test_dataset, nesa_model, nesa_conf, device)
+    measure_performance(test_dataset, nesa_model, nesa_conf, device,
+                        weeks=args.week_batches > 0,
+                        predictions_path=args.predictions_path,
+                        topk=args.topk)
+
+    if args.profile_path is not None:
+        PROFILER.print_report()
+        PROFILER.dump_json(args.profile_path + '.json')
+        PROFILER.dump_chrome_trace(args.profile_path + '_trace.json')
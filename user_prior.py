@@ -0,0 +1,36 @@
+import argparse
+import pickle
+
+import torch
+
+from checkpoint import atomic_save
+
+
+def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--model_path', type=str,
+                            default='./data/nesa_180522_0.pth')
+    arg_parser.add_argument('--output_path', type=str, default=None,
+                            help='defaults to updating --model_path')
+    arg_parser.add_argument('--dataset_path', type=str, required=True,
+                            help='pickled NETSDataset with train_data')
+    arg_parser.add_argument('--prior_weight', type=float, default=0.,
+                            help='0 keeps the prior for fallback only')
+    args = arg_parser.parse_args()
+
+    nets_dataset = pickle.load(open(args.dataset_path, 'rb'))
+    assert nets_dataset.train_data, 'no training events'
+    user_prior = nets_dataset.get_user_prior()
+    print('user prior', user_prior.shape)
+
+    # stored with the checkpoint; see test.get_model
+    checkpoint = torch.load(args.model_path, map_location='cpu')
+    checkpoint['user_prior'] = torch.from_numpy(user_prior)
+    checkpoint['prior_weight'] = args.prior_weight
+    output_path = args.output_path or args.model_path
+    atomic_save(checkpoint, output_path)
+    print('saved %s' % output_path)
+
+
+if __name__ == '__main__':
+    main()
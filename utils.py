@@ -1,32 +1,302 @@
+import collections
+import json
+import os
+import threading
 import time
 
-# https://stackoverflow.com/a/3620972
-PROF_DATA = {}
+import torch
+
+
+class Histogram(object):
+    """Streaming histogram of nanosecond durations.
+
+    Values are bucketed by their leading `sub_bits + 1` significant bits,
+    so memory is bounded by the value range (not the number of calls) and
+    percentiles have a relative error below 2 ** -sub_bits.
+    """
+
+    def __init__(self, sub_bits=5):
+        self.sub_bits = sub_bits
+        self.buckets = dict()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        shift = value.bit_length() - self.sub_bits - 1
+        if shift > 0:
+            value = (value >> shift) << shift
+        self.buckets[value] = self.buckets.get(value, 0) + 1
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.add(value)
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0.
+        rank = q / 100. * self.count
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen >= rank:
+                # middle of the bucket, clipped by the observed range
+                shift = max(0, key.bit_length() - self.sub_bits - 1)
+                mid = key + ((1 << shift) - 1) / 2.
+                return min(max(mid, self.min), self.max)
+        return float(self.max)
+
+    def summary(self, scale=1e-6):
+        # milliseconds by default
+        return {
+            'count': self.count,
+            'total': self.total * scale,
+            'mean': self.total / max(1, self.count) * scale,
+            'min': (self.min or 0) * scale,
+            'max': (self.max or 0) * scale,
+            'p50': self.percentile(50) * scale,
+            'p95': self.percentile(95) * scale,
+            'p99': self.percentile(99) * scale,
+        }
+
+
+class _ScopeStack(threading.local):
+    def __init__(self):
+        self.stack = list()
+        self.skip = 0
+
+
+class _Scope(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.enter(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.exit()
+        return False
+
+
+class _NullScope(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Profiler(object):
+    """Hierarchical profiler with bounded memory.
+
+    Scopes nest per thread and are keyed by their path, e.g.
+    'forward/context_layer/context_layer_core'. When disabled, Profile
+    wrapped functions cost one attribute check per call.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.period = 1
+        self.sync = None
+        self.trace = False
+        self.stats = dict()
+        self.trace_events = collections.deque(maxlen=100000)
+        self.n_roots = dict()
+        self.local = _ScopeStack()
+        self.null_scope = _NullScope()
+        self.lock = threading.Lock()
+
+    def configure(self, enabled=True, sample_rate=1., sync_device=False,
+                  trace=False, max_trace_events=100000):
+        # sample_rate: fraction of top-level scopes (and their children)
+        #              that are timed
+        # sync_device: synchronize CUDA around every scope so that the
+        #              timings include queued kernels
+        assert 0. < sample_rate <= 1.
+        self.enabled = enabled
+        self.period = max(1, int(round(1. / sample_rate)))
+        self.sync = None
+        if sync_device and torch.cuda.is_available():
+            self.sync = torch.cuda.synchronize
+        self.trace = trace
+        if max_trace_events != self.trace_events.maxlen:
+            self.trace_events = collections.deque(self.trace_events,
+                                                  maxlen=max_trace_events)
+
+    def scope(self, name):
+        if not self.enabled:
+            return self.null_scope
+        return _Scope(self, name)
+
+    def enter(self, name):
+        local = self.local
+        if local.skip > 0:
+            local.skip += 1
+            return
+        stack = local.stack
+        if not stack and self.period > 1:
+            # count per root name so alternating roots are sampled alike
+            n_roots = self.n_roots.get(name, 0) + 1
+            self.n_roots[name] = n_roots
+            if n_roots % self.period != 0:
+                local.skip = 1
+                return
+        path = stack[-1][0] + '/' + name if stack else name
+        if self.sync is not None:
+            self.sync()
+        stack.append((path, time.perf_counter_ns()))
+
+    def exit(self):
+        local = self.local
+        if local.skip > 0:
+            local.skip -= 1
+            return
+        if self.sync is not None:
+            self.sync()
+        end = time.perf_counter_ns()
+        path, start = local.stack.pop()
+        self.record(path, start, end - start)
+
+    def record(self, path, start, elapsed):
+        with self.lock:
+            hist = self.stats.get(path)
+            if hist is None:
+                hist = self.stats[path] = Histogram()
+            hist.record(elapsed)
+            if self.trace:
+                self.trace_events.append(
+                    (path, start, elapsed, threading.get_ident()))
+
+    def clear(self):
+        with self.lock:
+            self.stats = dict()
+            self.trace_events.clear()
+            self.n_roots = dict()
+
+    def report(self):
+        with self.lock:
+            return {path: hist.summary()
+                    for path, hist in sorted(self.stats.items())}
+
+    def print_report(self):
+        report = self.report()
+        if not report:
+            return
+        print('%-60s %8s %10s %9s %9s %9s' %
+              ('scope (ms)', 'count', 'total', 'p50', 'p95', 'p99'))
+        for path, s in report.items():
+            print('%-60s %8d %10.2f %9.3f %9.3f %9.3f' %
+                  (path, s['count'], s['total'],
+                   s['p50'], s['p95'], s['p99']))
+
+    def dump_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def dump_chrome_trace(self, path):
+        # load in chrome://tracing or https://ui.perfetto.dev
+        pid = os.getpid()
+        with self.lock:
+            events = [{'name': scope_path.rsplit('/', 1)[-1],
+                       'cat': scope_path,
+                       'ph': 'X',
+                       'ts': start / 1000.,
+                       'dur': elapsed / 1000.,
+                       'pid': pid,
+                       'tid': tid}
+                      for scope_path, start, elapsed, tid
+                      in self.trace_events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+PROFILER = Profiler()
 
 
 class Profile(object):
-    def __init__(self, prefix):
-        self.prefix = prefix
+    def __init__(self, profiler=None):
+        self.profiler = PROFILER if profiler is None else profiler
 
     def __call__(self, fn):
+        profiler = self.profiler
+        name = fn.__name__
+
         def with_profiling(*args, **kwargs):
-            global PROF_DATA
-            start_time = time.time()
-            ret = fn(*args, **kwargs)
+            if not profiler.enabled:
+                return fn(*args, **kwargs)
+            profiler.enter(name)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profiler.exit()
 
-            elapsed_time = time.time() - start_time
-            key = '[' + self.prefix + '].' + fn.__name__
+        with_profiling.__name__ = name
+        with_profiling.__doc__ = fn.__doc__
+        return with_profiling
 
-            if key not in PROF_DATA:
-                PROF_DATA[key] = [0, list()]
-            PROF_DATA[key][0] += 1
-            PROF_DATA[key][1].append(elapsed_time)
 
-            return ret
+def clear_prof_data():
+    PROFILER.clear()
 
-        return with_profiling
 
+def parse_cores(spec):
+    # '0-3,8' -> [0, 1, 2, 3, 8]; empty or None -> None
+    if not spec:
+        return None
+    cores = list()
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cores += range(int(first), int(last) + 1)
+        else:
+            cores.append(int(part))
+    return cores
 
-def clear_prof_data():
-    global PROF_DATA
-    PROF_DATA = {}
+
+def set_affinity(cores):
+    # Linux only; elsewhere the OS schedules as before
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+
+def configure_threads(intra_op_threads=0, inter_op_threads=0, cores=None):
+    """Pins this process to cores and sets torch's thread pools.
+
+    0 keeps torch's default, except that intra_op_threads defaults to
+    len(cores) when pinned. Inter-op threads can only be set before the
+    first parallel op (and not on torch < 1.2), so call this early.
+    Returns the resulting (intra_op_threads, inter_op_threads).
+    """
+    set_affinity(cores)
+    if intra_op_threads <= 0 and cores:
+        intra_op_threads = len(cores)
+    if intra_op_threads > 0:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads > 0 and hasattr(torch, 'set_num_interop_threads'):
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            print('inter-op threads unchanged: %s' % e)
+    get_interop = getattr(torch, 'get_num_interop_threads', lambda: 0)
+    return torch.get_num_threads(), get_interop()
+
+
+class DataWorkerInit(object):
+    """worker_init_fn pinning DataLoader workers to cores, away from the
+    cores of the intra-op threads. Picklable for spawned workers.
+    """
+
+    def __init__(self, cores):
+        self.cores = cores
+
+    def __call__(self, worker_id):
+        set_affinity(self.cores)
+        torch.set_num_threads(1)